@@ -11,6 +11,7 @@ class AdminToolbar {
     this.isSelecting = false;
     this.highlightedElement = null;
     this.state = "idle"; // idle, selecting, loading, success, error
+    this.currentAiJob = null; // AI edit job whose output is streaming in
     this.init();
   }
 
@@ -221,7 +222,21 @@ class AdminToolbar {
               headers: { 'Content-Type': 'application/json' }
             });
             
-            const result = await response.json();
+            let result = await response.json();
+            
+            // Publishing runs as a background job; poll it until it finishes
+            while (result.success && result.job_id && !['succeeded', 'failed'].includes(result.status)) {
+              await new Promise(resolve => setTimeout(resolve, 1000));
+              const statusResponse = await fetch(`/api/publish/${result.job_id}`);
+              const statusResult = await statusResponse.json();
+              if (!statusResult.success) {
+                result = statusResult;
+                break;
+              }
+              const job = statusResult.job;
+              result = { success: job.status !== 'failed', job_id: job.id, status: job.status, message: job.message, error: job.error };
+              if (job.stage) saveChangesBtn.innerHTML = `Publishing (${job.stage})...`;
+            }
             
             if (result.success) {
               saveChangesBtn.innerHTML = '✅ Published!';
@@ -318,7 +333,32 @@ class AdminToolbar {
         });
         console.log("✅ Added undo functionality to dock button");
       }
-      
+
+      // Ctrl/Cmd+Z undoes the last saved edit, Ctrl/Cmd+Shift+Z redoes it
+      document.addEventListener('keydown', async (e) => {
+        if (!(e.ctrlKey || e.metaKey) || e.key.toLowerCase() !== 'z') return;
+        const active = document.activeElement;
+        if (active && (active.isContentEditable || ['INPUT', 'TEXTAREA'].includes(active.tagName))) return;
+        e.preventDefault();
+
+        const endpoint = e.shiftKey ? '/api/edit-redo' : '/api/edit-undo';
+        try {
+          const response = await fetch(endpoint, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ url: window.location.pathname })
+          });
+          const result = await response.json();
+          if (result.success && result.file) {
+            location.reload(); // Reload page to show the restored content
+          } else if (!result.success) {
+            console.warn('Edit journal:', result.error);
+          }
+        } catch (error) {
+          console.error('Edit journal error:', error);
+        }
+      });
+
     }, 100);
     
     // Add floating dock hover animation effects
@@ -724,6 +764,7 @@ class AdminToolbar {
       element: element,
       tag: element.tagName.toLowerCase(),
       id: element.id || "",
+      lwId: element.dataset.lwId || "", // Server-assigned element address (admin pages only)
       classes: Array.from(element.classList).join(" "),
       text: element.textContent?.trim() || "",
       originalText: element.textContent?.trim() || "",
@@ -936,6 +977,7 @@ class AdminToolbar {
           elementTag: elementInfo.tag,
           elementId: elementInfo.id,
           elementClasses: elementInfo.classes,
+          lwId: elementInfo.lwId,
         }),
       });
 
@@ -1174,6 +1216,7 @@ class AdminToolbar {
   getElementAttributes(element) {
     const attributes = {};
     for (let attr of element.attributes) {
+      if (attr.name === "data-lw-id") continue;
       attributes[attr.name] = attr.value;
     }
     return attributes;
@@ -1253,6 +1296,8 @@ class AdminToolbar {
           elementSelector: this.generateElementSelector(element),
           newText: newText,
           originalText: element.originalText,
+          elementTag: element.tag,
+          lwId: element.lwId,
         }),
       });
 
@@ -1362,7 +1407,7 @@ class AdminToolbar {
     } catch (error) {
       console.error("Error submitting prompt:", error);
       this.setState("error");
-      this.showStatus("Error processing AI request", "error");
+      this.showStatus(error.message || "Error processing AI request", "error");
 
       // Hide processing indicators on error
       const elementsToEdit = isBatchMode
@@ -1495,6 +1540,7 @@ class AdminToolbar {
           elements: this.currentPreview.elementsToEdit.map((el) => ({
             tag: el.tag,
             id: el.id,
+            lwId: el.lwId,
             classes: el.classes,
             text: el.text,
             attributes: el.attributes,
@@ -1683,6 +1729,7 @@ class AdminToolbar {
             text: el.text,
             originalText: el.originalText,
             attributes: el.attributes,
+            lwId: el.lwId,
           })),
           url: window.location.pathname,
           batchMode: isBatchMode,
@@ -1705,13 +1752,75 @@ class AdminToolbar {
         throw new Error(errorMessage);
       }
 
-      return await response.json();
+      const started = await response.json();
+      if (!started.job_id) {
+        return started;
+      }
+
+      // The AI edit runs as a background job; follow its output until it finishes
+      this.currentAiJob = started;
+      try {
+        return await this.followAiEditJob(started);
+      } finally {
+        this.currentAiJob = null;
+      }
     } catch (error) {
       console.error("Error in sendToBackend:", error);
       throw error;
     }
   }
 
+  followAiEditJob(job) {
+    // Resolves with the admin-edit response once the job's event stream reports it done
+    return new Promise((resolve, reject) => {
+      const source = new EventSource(job.events_url);
+      let output = "";
+
+      source.addEventListener("output", (event) => {
+        output += JSON.parse(event.data);
+        const lastLine = output.trim().split("\n").pop() || "";
+        this.showStatus(`AI is writing... ${lastLine.slice(-80)}`, "loading");
+      });
+
+      source.addEventListener("progress", (event) => {
+        const progress = JSON.parse(event.data);
+        if (progress.status === "queued" && progress.queue_position) {
+          this.showStatus(`Waiting for an AI worker (position ${progress.queue_position})...`, "loading");
+        } else if (progress.stage === "parse") {
+          this.showStatus("Reading AI response...", "loading");
+        }
+      });
+
+      source.addEventListener("done", (event) => {
+        source.close();
+        const finished = JSON.parse(event.data);
+        resolve(
+          (finished.result && finished.result.response) || {
+            success: false,
+            error: finished.error || "AI edit failed",
+          }
+        );
+      });
+
+      source.onerror = () => {
+        // EventSource reconnects by itself when a stream ends; only a closed source is fatal
+        if (source.readyState === EventSource.CLOSED) {
+          reject(new Error("Lost connection to AI edit job"));
+        }
+      };
+    });
+  }
+
+  async cancelAiJob() {
+    const job = this.currentAiJob;
+    if (!job) return;
+    try {
+      await fetch(job.cancel_url, { method: "POST" });
+    } catch (error) {
+      console.error("Error cancelling AI edit job:", error);
+    }
+  }
+
   generateElementSelector(element) {
     // Generate a unique selector for the element
     let selector = element.tag;
@@ -1776,10 +1885,11 @@ class AdminToolbar {
       }
     }
 
+    // Cancel stays enabled while processing so a running AI edit job can be stopped
     if (this.cancelAiBtn) {
-      this.cancelAiBtn.disabled = isProcessing;
-      this.cancelAiBtn.style.opacity = isProcessing ? "0.5" : "1";
-      this.cancelAiBtn.style.cursor = isProcessing ? "not-allowed" : "pointer";
+      this.cancelAiBtn.disabled = false;
+      this.cancelAiBtn.style.opacity = "1";
+      this.cancelAiBtn.style.cursor = "pointer";
     }
 
     console.log(
@@ -1817,6 +1927,9 @@ class AdminToolbar {
 
   cancelAiEdit() {
     console.log('❌ AI Cancel button clicked! editingIndex:', this.editingIndex);
+
+    // Stop the model if an AI edit is still running
+    this.cancelAiJob();
     
     // Clear the AI prompt input
     if (this.promptInput) {
@@ -2009,6 +2122,7 @@ class AdminToolbar {
           oldImageSrc: oldSrc,
           newImageSrc: uploadResult.path,
           elementSelector: this.generateElementSelector(currentElement),
+          lwId: currentElement.lwId,
         }),
       });
 
@@ -2071,6 +2185,7 @@ class AdminToolbar {
           url: window.location.pathname,
           imageSrc: imageSrc,
           elementSelector: this.generateElementSelector(currentElement),
+          lwId: currentElement.lwId,
         }),
       });
 
@@ -0,0 +1,106 @@
+"""Offline stand-in for a model, speaking the AI worker protocol used by AI_BACKEND=worker.
+
+Answers every admin-edit prompt with a well-formed element_updates response derived from the
+elements listed in the prompt, so the AI edit path can be exercised and benchmarked without
+a model or network access.
+
+    AI_BACKEND=worker python serve.py                  # the stub is the default worker command
+    AI_BACKEND=worker AI_WORKER_COMMAND="my-model-worker --warm" python serve.py
+
+Protocol: one JSON object per line on stdin and stdout.
+    request   {"id": "...", "prompt": "...", "cwd": "..."}
+    cancel    {"id": "...", "cancel": true}
+    output    {"id": "...", "output": "<chunk of model output>"}
+    finished  {"id": "...", "done": true, "returncode": 0, "stderr": ""}
+Requests may overlap; every reply carries the id of its request. A cancelled request must still
+be finished (any returncode) promptly: the server kills workers that leave a cancel or a
+timed-out request unanswered, and starts a new one for the next prompt.
+
+    python ai_stub_worker.py --once < prompt.txt       # one prompt, CLI style, like `qwen -p`
+
+Environment:
+    AI_STUB_STARTUP   seconds of simulated start-up before the first prompt (default 0)
+    AI_STUB_DELAY     seconds of simulated generation per prompt (default 0)
+    AI_STUB_WEDGED    "1" to ignore cancels, for exercising the server's kill-and-restart path
+"""
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+_ELEMENT_COUNT_RE = re.compile(r"indices 0 to (\d+)")
+_CURRENT_CONTENT_RE = re.compile(r'^- Current Content: "(.*)\.\.\."$', re.M)
+STARTUP_SECONDS = float(os.getenv("AI_STUB_STARTUP", "0"))
+DELAY_SECONDS = float(os.getenv("AI_STUB_DELAY", "0"))
+WEDGED = os.getenv("AI_STUB_WEDGED") == "1"
+CHUNKS = 4
+
+_write_lock = threading.Lock()
+_cancelled = {}
+
+
+def answer(prompt: str) -> str:
+    """Deterministic admin-edit response for prompt"""
+    count = _ELEMENT_COUNT_RE.search(prompt)
+    contents = _CURRENT_CONTENT_RE.findall(prompt)
+    updates = []
+    for index in range(int(count.group(1)) + 1 if count else len(contents)):
+        current = contents[index] if index < len(contents) else ""
+        updates.append({
+            "element_index": index,
+            "new_content": f"{current} (edited)".strip(),
+            "summary": "Stub edit",
+        })
+    return json.dumps({
+        "status": "success",
+        "message": "Stub backend response",
+        "element_updates": updates,
+        "changes_summary": f"Stub edited {len(updates)} element(s)",
+    })
+
+
+def send(message: dict):
+    with _write_lock:
+        sys.stdout.write(json.dumps(message) + "\n")
+        sys.stdout.flush()
+
+
+def handle(request: dict):
+    request_id = request["id"]
+    cancelled = _cancelled.setdefault(request_id, threading.Event())
+    text = answer(request.get("prompt", ""))
+    step = -(-len(text) // CHUNKS)
+    for start in range(0, len(text), step):
+        if cancelled.wait(DELAY_SECONDS / CHUNKS):
+            send({"id": request_id, "done": True, "returncode": -1, "stderr": "cancelled"})
+            break
+        send({"id": request_id, "output": text[start:start + step]})
+    else:
+        send({"id": request_id, "done": True, "returncode": 0, "stderr": ""})
+    _cancelled.pop(request_id, None)
+
+
+def main():
+    if "--once" in sys.argv[1:]:
+        time.sleep(STARTUP_SECONDS + DELAY_SECONDS)
+        print(answer(sys.stdin.read()))
+        return
+
+    time.sleep(STARTUP_SECONDS)
+    for line in sys.stdin:
+        try:
+            request = json.loads(line)
+        except ValueError:
+            continue
+        if request.get("cancel"):
+            if WEDGED:
+                continue
+            _cancelled.setdefault(request.get("id"), threading.Event()).set()
+        elif request.get("id"):
+            threading.Thread(target=handle, args=(request,), daemon=True).start()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,45 @@
 import os
+import re
 import mimetypes
 import logging
 import subprocess
 import json
+import hashlib
+import gzip
+import zlib
+import threading
+import time
+import stat
+import fcntl
+import signal
+import uuid
+import atexit
+import posixpath
+import shutil
+import tarfile
+import shlex
+import sys
+import bisect
+import copy
+import html as html_lib
+from contextlib import contextmanager, nullcontext
+from collections import OrderedDict
+from queue import Empty, Queue
 from pathlib import Path
-from datetime import datetime
-from flask import Flask, send_from_directory, request, jsonify, redirect
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+from flask import Flask, Response, send_file, request, jsonify, redirect
+from werkzeug.exceptions import HTTPException
+from werkzeug.security import safe_join
+from werkzeug.wsgi import wrap_file
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 BASE_DIR = Path(__file__).parent
 PROJECTS_DIR = Path(os.getenv("PROJECTS_DIR", BASE_DIR / "projects")).resolve()
+# The project the single-site endpoints (publish, rollback, history, undo) operate on
+DEFAULT_PROJECT_PATH = PROJECTS_DIR / "jbswebpage"
 
 app = Flask(__name__)
 
@@ -22,7 +50,224 @@ def health():
     return jsonify({"status": "healthy"}), 200
 
 
+class LRUCache:
+    """Thread-safe LRU mapping bounded by the total size (usually bytes) of its values"""
 
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, size: int):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            self._bytes -= entry[1]
+            return entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes, "max_bytes": self.max_bytes}
+
+
+
+
+
+
+
+
+
+
+
+# 🟢 background jobs +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+# Job records live on disk so any worker process (see serve.py) can report on them
+STATE_DIR = Path(os.getenv("STATE_DIR", BASE_DIR / ".state")).resolve()
+JOBS_DIR = STATE_DIR / "jobs"
+JOB_RETENTION_SECONDS = int(os.getenv("JOB_RETENTION_SECONDS", str(24 * 3600)))
+FINISHED_JOB_STATUSES = ("succeeded", "failed", "cancelled")
+
+_JOB_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+
+
+@contextmanager
+def file_lock(lock_path: Path):
+    """Exclusive flock() held across threads and worker processes"""
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(lock_path, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def project_key(project_path) -> str:
+    """Filesystem-safe name for per-project state files"""
+    resolved = str(Path(project_path).resolve())
+    return f"{Path(resolved).name}-{hashlib.sha1(resolved.encode('utf-8')).hexdigest()[:8]}"
+
+
+def _job_path(job_id: str) -> Path:
+    return JOBS_DIR / f"{job_id}.json"
+
+
+def save_job(job: dict):
+    job["updated_at"] = time.time()
+    JOBS_DIR.mkdir(parents=True, exist_ok=True)
+    _write_atomic(_job_path(job["id"]), json.dumps(job).encode("utf-8"))
+
+
+def create_job(kind: str, project_path, stages=()) -> dict:
+    now = time.time()
+    job = {
+        "id": uuid.uuid4().hex,
+        "kind": kind,
+        "project": str(project_path),
+        "status": "queued",
+        "stage": None,
+        "stages": [{"name": name, "status": "pending"} for name in stages],
+        "message": None,
+        "error": None,
+        "result": None,
+        "pid": os.getpid(),
+        "created_at": now,
+    }
+    save_job(job)
+    _prune_jobs(now)
+    return job
+
+
+def load_job(job_id: str):
+    if not _JOB_ID_RE.match(job_id or ""):
+        return None
+    try:
+        job = json.loads(_job_path(job_id).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+    if job["status"] not in FINISHED_JOB_STATUSES and not _job_owner_alive(job):
+        job.update(status="failed", error="Worker process exited before the job finished")
+    return job
+
+
+def _job_owner_alive(job: dict) -> bool:
+    if job.get("pid") == os.getpid():
+        return True
+    try:
+        os.kill(job["pid"], 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+
+def _prune_jobs(now: float):
+    try:
+        for pattern in ("*.json", "*.out", "*.cancel"):
+            for job_file in JOBS_DIR.glob(pattern):
+                if now - job_file.stat().st_mtime > JOB_RETENTION_SECONDS:
+                    job_file.unlink(missing_ok=True)
+    except OSError as e:
+        logger.warning(f"Could not prune old jobs: {e}")
+
+
+def set_job_stage(job: dict, name: str, status: str, message: str = None):
+    """Record progress of one stage; "running" also makes it the job's current stage"""
+    for stage in job["stages"]:
+        if stage["name"] == name:
+            stage["status"] = status
+            stage[f"{status}_at"] = time.time()
+            if message:
+                stage["message"] = message
+    if status == "running":
+        job["stage"] = name
+    save_job(job)
+
+
+def finish_job(job: dict, success: bool, message: str = None, error: str = None, result=None, status: str = None):
+    job.update(
+        status=status or ("succeeded" if success else "failed"),
+        stage=None,
+        message=message,
+        error=error,
+        result=result,
+    )
+    save_job(job)
+
+
+# Job id -> (job, thread) for jobs running in this process, so a stopping worker can wait for them
+_job_threads = {}
+_job_threads_lock = threading.Lock()
+
+
+def start_job_thread(job: dict, target, *args) -> threading.Thread:
+    """Run target(job, *args) on a daemon thread that drain_jobs() knows about"""
+    def run():
+        try:
+            target(job, *args)
+        finally:
+            with _job_threads_lock:
+                _job_threads.pop(job["id"], None)
+
+    thread = threading.Thread(target=run, name=f"{job['kind'].replace('_', '-')}-{job['id'][:8]}", daemon=True)
+    with _job_threads_lock:
+        _job_threads[job["id"]] = (job, thread)
+    thread.start()
+    return thread
+
+
+def drain_jobs(timeout: float) -> list:
+    """Wait up to timeout seconds for this process's jobs, then fail the rest; returns the failed jobs
+
+    A job cut off mid-way may leave git's lock files behind in its project, which would block every
+    later publish or rollback, so those are removed too.
+    """
+    deadline = time.monotonic() + timeout
+    with _job_threads_lock:
+        running = list(_job_threads.values())
+    for job, thread in running:
+        thread.join(max(0.0, deadline - time.monotonic()))
+
+    stuck = [job for job, thread in running if thread.is_alive()]
+    for job in stuck:
+        logger.warning(f"Job {job['id']} ({job['kind']}) still running at shutdown; marking it failed")
+        finish_job(job, False, error="Server shut down before the job finished")
+        git_dir = Path(job["project"]) / ".git"
+        for lock_file in [*git_dir.glob("*.lock"), *git_dir.glob("refs/**/*.lock")]:
+            lock_file.unlink(missing_ok=True)
+            logger.warning(f"Removed {lock_file} left by job {job['id']}")
+    return stuck
+
+# 🟢 background jobs +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 
 
 
@@ -37,7 +282,7 @@ def health():
 def get_next_version_tag():
     """Get the next version tag (v1, v2, v3, etc.)"""
     try:
-        PROJECT_PATH = "projects/jbswebpage"
+        PROJECT_PATH = DEFAULT_PROJECT_PATH
         result = subprocess.run(['git', 'tag', '--list'], capture_output=True, text=True, timeout=10, cwd=PROJECT_PATH)
         if result.returncode != 0:
             return "v1"  # First tag
@@ -90,7 +335,7 @@ def generate_smart_commit_message(project_path):
 # def commit_and_tag_changes(description: str):
 #     """Commit changes and create version tag following git.txt instructions"""
 #     try:
-#         PROJECT_PATH = "projects/jbswebpage"
+#         PROJECT_PATH = DEFAULT_PROJECT_PATH
 #         # Ensure we're on main branch
 #         subprocess.run(['git', 'checkout', 'main'], capture_output=True, text=True, timeout=10, cwd=PROJECT_PATH)
         
@@ -130,61 +375,169 @@ def generate_smart_commit_message(project_path):
 #         return False, f"Git operation failed: {str(e)}"
 
 
+PUBLISH_STAGES = ("status", "checkout", "stage", "commit", "tag", "release", "push")
+
+
+def publish_project(PROJECT_PATH, on_stage=lambda name, status, message=None: None):
+    """Commit and push all changes with version tagging for rollbacks
+
+    Returns (success, message, http status); on_stage(name, status, message) reports progress.
+    """
+    # Check if there are any changes to commit
+    on_stage("status", "running")
+    status_result = subprocess.run(['git', 'status', '--porcelain'], capture_output=True, text=True, timeout=10, cwd=PROJECT_PATH)
+    if status_result.returncode != 0:
+        logger.error(f"Git status failed: {status_result.stderr}")
+        on_stage("status", "failed", status_result.stderr)
+        return False, f"Git status failed: {status_result.stderr}", 500
+    on_stage("status", "succeeded")
+    
+    if not status_result.stdout.strip():
+        logger.info("No changes to publish")
+        return True, "No changes to publish", 200
+    
+    # Ensure we're on main branch
+    on_stage("checkout", "running")
+    subprocess.run(['git', 'checkout', 'main'], capture_output=True, text=True, timeout=10, cwd=PROJECT_PATH)
+    on_stage("checkout", "succeeded")
+    
+    # Stage all changes
+    on_stage("stage", "running")
+    result = subprocess.run(['git', 'add', '.'], capture_output=True, text=True, timeout=10, cwd=PROJECT_PATH)
+    if result.returncode != 0:
+        logger.error(f"Git add failed: {result.stderr}")
+        on_stage("stage", "failed", result.stderr)
+        return False, f"Git add failed: {result.stderr}", 500
+    on_stage("stage", "succeeded")
+    
+    # Get next version tag
+    next_tag = get_next_version_tag()
+    
+    # Generate smart commit message by analyzing changes
+    on_stage("commit", "running")
+    commit_message = generate_smart_commit_message(PROJECT_PATH)
+    result = subprocess.run(['git', 'commit', '-m', commit_message], capture_output=True, text=True, timeout=15, cwd=PROJECT_PATH)
+    if result.returncode != 0:
+        if "nothing to commit" in result.stdout:
+            on_stage("commit", "succeeded", "No changes to commit")
+            return True, "No changes to commit", 200
+        logger.error(f"Git commit failed: {result.stderr}")
+        on_stage("commit", "failed", result.stderr)
+        return False, f"Git commit failed: {result.stderr}", 500
+    on_stage("commit", "succeeded", commit_message)
+    
+    # Create version tag
+    on_stage("tag", "running")
+    result = subprocess.run(['git', 'tag', next_tag], capture_output=True, text=True, timeout=10, cwd=PROJECT_PATH)
+    if result.returncode != 0:
+        logger.error(f"Git tag failed: {result.stderr}")
+        on_stage("tag", "failed", result.stderr)
+        return False, f"Git tag failed: {result.stderr}", 500
+    on_stage("tag", "succeeded", next_tag)
+    
+    invalidate_version_history(PROJECT_PATH)
+    
+    # Switch visitors to the new version before the (slow) push
+    on_stage("release", "running")
+    try:
+        materialize_release(PROJECT_PATH, next_tag)
+        activate_release(PROJECT_PATH, next_tag)
+        on_stage("release", "succeeded", next_tag)
+    except Exception as e:
+        logger.exception("release activation failed")
+        on_stage("release", "failed", str(e))
+    
+    # Push to origin with tags
+    on_stage("push", "running")
+    result = subprocess.run(['git', 'push', 'origin', 'main', '--tags'], capture_output=True, text=True, timeout=30, cwd=PROJECT_PATH)
+    if result.returncode != 0:
+        logger.error(f"Git push failed: {result.stderr}")
+        on_stage("push", "failed", result.stderr)
+        return False, f"Push failed: {result.stderr}", 500
+    on_stage("push", "succeeded")
+    
+    return True, f"Successfully published all changes to GitHub as {next_tag}", 200
+
+
+def _publish_lock_paths(project_path):
+    key = project_key(project_path)
+    return (
+        JOBS_DIR / f"publish-{key}.queue.lock",  # guards the pending marker
+        JOBS_DIR / f"publish-{key}.pending",  # id of the queued job new requests coalesce into
+        JOBS_DIR / f"publish-{key}.run.lock",  # held while a publish runs
+    )
+
+
+def submit_publish_job(project_path):
+    """Queue a publish, or join the one already waiting to run; returns (job, coalesced)"""
+    queue_lock, pending_path, _ = _publish_lock_paths(project_path)
+    with file_lock(queue_lock):
+        try:
+            pending = load_job(pending_path.read_text().strip())
+        except OSError:
+            pending = None
+        if pending and pending["status"] == "queued":
+            return pending, True
+
+        job = create_job("publish", project_path, PUBLISH_STAGES)
+        pending_path.write_text(job["id"])
+
+    start_job_thread(job, run_publish_job)
+    return job, False
+
+
+def run_publish_job(job: dict):
+    queue_lock, pending_path, run_lock = _publish_lock_paths(job["project"])
+    try:
+        # One publish per project at a time, across all worker processes
+        with file_lock(run_lock):
+            # From here on new requests must queue a fresh job, since they may carry newer edits
+            with file_lock(queue_lock):
+                try:
+                    if pending_path.read_text().strip() == job["id"]:
+                        pending_path.unlink()
+                except OSError:
+                    pass
+            job["status"] = "running"
+            save_job(job)
+
+            success, message, _ = publish_project(job["project"], lambda name, status, msg=None: set_job_stage(job, name, status, msg))
+        if success:
+            finish_job(job, True, message=message)
+        else:
+            finish_job(job, False, error=message)
+    except Exception as e:
+        logger.exception("publish job error")
+        finish_job(job, False, error=f"Publish failed: {str(e)}")
+
+
 @app.route("/api/publish", methods=["POST"])
 def publish_changes():
-    """Commit and push all changes to GitHub with version tagging for rollbacks"""
+    """Queue a commit-and-push of all changes; poll /api/publish/<job_id> for progress"""
     try:
-        PROJECT_PATH = "projects/jbswebpage"
-        
-        # Check if there are any changes to commit
-        status_result = subprocess.run(['git', 'status', '--porcelain'], capture_output=True, text=True, timeout=10, cwd=PROJECT_PATH)
-        if status_result.returncode != 0:
-            logger.error(f"Git status failed: {status_result.stderr}")
-            return jsonify({"success": False, "error": f"Git status failed: {status_result.stderr}"}), 500
-        
-        if not status_result.stdout.strip():
-            logger.info("No changes to publish")
-            return jsonify({"success": True, "message": "No changes to publish"})
-        
-        # Ensure we're on main branch
-        subprocess.run(['git', 'checkout', 'main'], capture_output=True, text=True, timeout=10, cwd=PROJECT_PATH)
-        
-        # Stage all changes
-        result = subprocess.run(['git', 'add', '.'], capture_output=True, text=True, timeout=10, cwd=PROJECT_PATH)
-        if result.returncode != 0:
-            logger.error(f"Git add failed: {result.stderr}")
-            return jsonify({"success": False, "error": f"Git add failed: {result.stderr}"}), 500
-        
-        # Get next version tag
-        next_tag = get_next_version_tag()
-        
-        # Generate smart commit message by analyzing changes
-        commit_message = generate_smart_commit_message(PROJECT_PATH)
-        result = subprocess.run(['git', 'commit', '-m', commit_message], capture_output=True, text=True, timeout=15, cwd=PROJECT_PATH)
-        if result.returncode != 0:
-            if "nothing to commit" in result.stdout:
-                return jsonify({"success": True, "message": "No changes to commit"})
-            logger.error(f"Git commit failed: {result.stderr}")
-            return jsonify({"success": False, "error": f"Git commit failed: {result.stderr}"}), 500
-        
-        # Create version tag
-        result = subprocess.run(['git', 'tag', next_tag], capture_output=True, text=True, timeout=10, cwd=PROJECT_PATH)
-        if result.returncode != 0:
-            logger.error(f"Git tag failed: {result.stderr}")
-            return jsonify({"success": False, "error": f"Git tag failed: {result.stderr}"}), 500
-        
-        # Push to origin with tags
-        result = subprocess.run(['git', 'push', 'origin', 'main', '--tags'], capture_output=True, text=True, timeout=30, cwd=PROJECT_PATH)
-        if result.returncode != 0:
-            logger.error(f"Git push failed: {result.stderr}")
-            return jsonify({"success": False, "error": f"Push failed: {result.stderr}"}), 500
-        
-        return jsonify({"success": True, "message": f"Successfully published all changes to GitHub as {next_tag}"})
+        PROJECT_PATH = DEFAULT_PROJECT_PATH
+        job, coalesced = submit_publish_job(PROJECT_PATH)
+        return jsonify({
+            "success": True,
+            "job_id": job["id"],
+            "status": job["status"],
+            "coalesced": coalesced,
+            "status_url": f"/api/publish/{job['id']}"
+        }), 202
     except Exception as e:
         logger.exception("publish_changes error")
         return jsonify({"success": False, "error": f"Publish failed: {str(e)}"}), 500
 
 
+@app.route("/api/publish/<job_id>", methods=["GET"])
+def publish_status(job_id):
+    """Report the status and per-stage progress of a publish job"""
+    job = load_job(job_id)
+    if not job or job["kind"] != "publish":
+        return jsonify({"success": False, "error": "Publish job not found"}), 404
+    return jsonify({"success": True, "job": job})
+
+
 # 🟢 git tag and git push +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 
 
@@ -202,59 +555,105 @@ def publish_changes():
 
 
 
-def get_version_history():
-    """Get list of version tags with commit info, including initial state option"""
-    try:
-        PROJECT_PATH = "projects/jbswebpage"
-        # Get all tags
-        result = subprocess.run(['git', 'tag', '--list'], capture_output=True, text=True, timeout=10, cwd=PROJECT_PATH)
-        if result.returncode != 0:
-            return []
-        
-        tags = result.stdout.strip().split('\n') if result.stdout.strip() else []
-        version_tags = [tag for tag in tags if tag.startswith('v') and tag[1:].isdigit()]
-        version_tags.sort(key=lambda x: int(x[1:]), reverse=True)  # Sort by version number, newest first
-        
-        history = []
-        
-        # Add "Initial State" option if there are any version tags
-        if version_tags:
-            # Get the commit before the first version tag (v1)
-            first_tag = sorted(version_tags, key=lambda x: int(x[1:]))[0]  # Get v1, v2, etc. in ascending order
-            try:
-                # Get the commit before the first tag
-                result = subprocess.run([
-                    'git', 'log', '--format=%H|%s|%ai', f'{first_tag}^1', '-1'
-                ], capture_output=True, text=True, timeout=10, cwd=PROJECT_PATH)
-                
-                if result.returncode == 0 and result.stdout.strip():
-                    commit_hash, message, date = result.stdout.strip().split('|', 2)
-                    history.append({
-                        'tag': 'initial',
-                        'message': 'Initial State (before any versions)',
-                        'date': date,
-                        'hash': commit_hash[:8]
-                    })
-            except Exception as e:
-                logger.warning(f"Could not get initial state commit: {e}")
-        
-        # Add all version tags
-        for tag in version_tags:
-            # Get commit info for tag
+# One line per tag; starred fields describe the tagged commit when the tag is annotated
+VERSION_REFS_FORMAT = "%00".join([
+    "%(refname:short)",
+    "%(objectname)", "%(*objectname)",
+    "%(subject)", "%(*subject)",
+    "%(authordate:iso)", "%(*authordate:iso)",
+    "%(parent)", "%(*parent)",
+])
+
+# Project path -> (refs key, history, tag -> position); see get_version_history_index()
+_version_history_cache = {}
+_version_history_lock = threading.Lock()
+
+
+def _version_refs_key(project_path: str):
+    git_dir = Path(project_path) / ".git"
+    return (_stat_key(git_dir / "refs" / "tags"), _stat_key(git_dir / "packed-refs"))
+
+
+def invalidate_version_history(project_path: str):
+    with _version_history_lock:
+        _version_history_cache.pop(str(project_path), None)
+
+
+def build_version_history(project_path: str):
+    """Read every version tag with a single for-each-ref call (plus one log for the initial state)"""
+    result = subprocess.run(
+        ['git', 'for-each-ref', 'refs/tags', f'--format={VERSION_REFS_FORMAT}'],
+        capture_output=True, text=True, timeout=10, cwd=project_path,
+    )
+    if result.returncode != 0:
+        logger.error(f"Git for-each-ref failed: {result.stderr}")
+        return []
+
+    tags = []
+    for line in result.stdout.splitlines():
+        fields = line.split("\0")
+        if len(fields) != 9:
+            continue
+        tag, obj, deref_obj, subject, deref_subject, date, deref_date, parents, deref_parents = fields
+        if not (tag.startswith('v') and tag[1:].isdigit()):
+            continue
+        if deref_obj:
+            obj, subject, date, parents = deref_obj, deref_subject, deref_date, deref_parents
+        tags.append({
+            'tag': tag,
+            'message': subject,
+            'date': date,
+            'hash': obj[:8],
+            'parent': parents.split()[0] if parents.strip() else None,
+        })
+    tags.sort(key=lambda x: int(x['tag'][1:]), reverse=True)  # Sort by version number, newest first
+
+    history = []
+
+    # Add "Initial State" option: the commit before the first version tag (v1)
+    if tags and tags[-1]['parent']:
+        try:
             result = subprocess.run([
-                'git', 'log', '--format=%H|%s|%ai', '-1', tag
-            ], capture_output=True, text=True, timeout=10, cwd=PROJECT_PATH)
-            
+                'git', 'log', '--format=%H|%ai', '-1', tags[-1]['parent']
+            ], capture_output=True, text=True, timeout=10, cwd=project_path)
+
             if result.returncode == 0 and result.stdout.strip():
-                commit_hash, message, date = result.stdout.strip().split('|', 2)
+                commit_hash, date = result.stdout.strip().split('|', 1)
                 history.append({
-                    'tag': tag,
-                    'message': message,
+                    'tag': 'initial',
+                    'message': 'Initial State (before any versions)',
                     'date': date,
                     'hash': commit_hash[:8]
                 })
-        
-        return history
+        except Exception as e:
+            logger.warning(f"Could not get initial state commit: {e}")
+
+    for entry in tags:
+        entry.pop('parent')
+        history.append(entry)
+    return history
+
+
+def get_version_history_index(project_path=DEFAULT_PROJECT_PATH):
+    """Return (history, tag -> position), rebuilt only when tags change"""
+    key = _version_refs_key(project_path)
+    with _version_history_lock:
+        cached = _version_history_cache.get(str(project_path))
+        if cached is not None and cached[0] == key:
+            return cached[1], cached[2]
+
+    history = build_version_history(project_path)
+    positions = {entry['tag']: i for i, entry in enumerate(history)}
+    with _version_history_lock:
+        _version_history_cache[str(project_path)] = (key, history, positions)
+    return history, positions
+
+
+def get_version_history():
+    """Get list of version tags with commit info, including initial state option"""
+    try:
+        history, _ = get_version_history_index()
+        return list(history)
     except Exception as e:
         logger.error(f"Error getting version history: {e}")
         return []
@@ -262,10 +661,33 @@ def get_version_history():
 
 @app.route("/api/version-history", methods=["GET"])
 def version_history():
-    """Get version history for the admin UI"""
+    """Get version history for the admin UI
+
+    Optional ?limit=N returns one page; pass the returned next_cursor back as ?cursor= for the next one.
+    """
     try:
-        history = get_version_history()
-        return jsonify({"success": True, "history": history})
+        history, positions = get_version_history_index()
+        limit = request.args.get("limit", type=int)
+        cursor = request.args.get("cursor", "").strip()
+
+        start = 0
+        if cursor:
+            if cursor not in positions:
+                return jsonify({"success": False, "error": f"Unknown cursor: {cursor}"}), 400
+            start = positions[cursor] + 1
+
+        if limit is None or limit <= 0:
+            page = history[start:]
+        else:
+            page = history[start:start + limit]
+        has_more = start + len(page) < len(history)
+
+        return jsonify({
+            "success": True,
+            "history": page,
+            "total": len(history),
+            "next_cursor": page[-1]['tag'] if page and has_more else None
+        })
     except Exception as e:
         logger.exception("version_history error")
         return jsonify({"success": False, "error": f"Failed to get version history: {str(e)}"}), 500
@@ -285,65 +707,199 @@ def version_history():
 
 
 
+# 🔵 release directories +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+# Each published tag is extracted once into RELEASES_DIR/<project>/<tag>/ and never modified;
+# RELEASES_DIR/<project>/current is a symlink swapped atomically to publish or roll back.
+RELEASES_DIR = Path(os.getenv("RELEASES_DIR", BASE_DIR / "releases")).resolve()
+RELEASES_KEEP = int(os.getenv("RELEASES_KEEP", "10"))
+
+
+def release_root(project_path) -> Path:
+    return RELEASES_DIR / project_key(project_path)
+
+
+def materialize_release(project_path, tag: str, rev: str = None) -> Path:
+    """Extract rev (default: tag) into the tag's release directory unless it already exists"""
+    root = release_root(project_path)
+    target = root / tag
+    if target.is_dir():
+        return target
+
+    root.mkdir(parents=True, exist_ok=True)
+    tmp_dir = root / f".tmp-{tag}-{os.getpid()}-{threading.get_ident()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    proc = subprocess.Popen(['git', 'archive', '--format=tar', rev or tag], stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=str(project_path))
+    try:
+        with tarfile.open(fileobj=proc.stdout, mode="r|") as archive:
+            if hasattr(tarfile, "data_filter"):
+                archive.extractall(tmp_dir, filter="data")
+            else:
+                archive.extractall(tmp_dir)
+    finally:
+        proc.stdout.close()
+        stderr = proc.stderr.read().decode("utf-8", "replace")
+        proc.wait(timeout=60)
+    if proc.returncode != 0:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise RuntimeError(f"git archive {rev or tag} failed: {stderr}")
+
+    try:
+        os.rename(tmp_dir, target)
+    except OSError:
+        # Another worker materialized the same tag first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if not target.is_dir():
+            raise
+    return target
+
+
+def activate_release(project_path, tag: str):
+    """Atomically point the project's "current" release at tag"""
+    root = release_root(project_path)
+    tmp_link = root / f".current-{os.getpid()}-{threading.get_ident()}"
+    tmp_link.unlink(missing_ok=True)
+    os.symlink(tag, tmp_link)
+    os.replace(tmp_link, root / "current")
+    logger.info(f"Release {tag} is now current for {project_path}")
+    prune_releases(project_path)
+
+
+def prune_releases(project_path):
+    """Keep the RELEASES_KEEP most recent release directories plus the current one"""
+    root = release_root(project_path)
+    try:
+        current = os.readlink(root / "current")
+        releases = sorted(
+            (p for p in root.iterdir() if p.is_dir() and not p.is_symlink() and not p.name.startswith(".")),
+            key=lambda p: p.stat().st_mtime,
+            reverse=True,
+        )
+        for old in releases[RELEASES_KEEP:]:
+            if old.name != current:
+                shutil.rmtree(old, ignore_errors=True)
+    except OSError as e:
+        logger.warning(f"Could not prune releases: {e}")
+
+
+def current_release_path(relative_path: str):
+    """Map a projects/-relative path to the current release of its project, or None"""
+    segments = relative_path.strip("/").split("/")
+    depth = 2 if segments[0].startswith("user_") and len(segments) >= 2 else 1
+    project_path = PROJECTS_DIR / "/".join(segments[:depth])
+    try:
+        current = os.readlink(release_root(project_path) / "current")
+    except OSError:
+        return None
+    release_dir = release_root(project_path) / current
+    candidate = safe_join(str(release_dir), "/".join(segments[depth:])) if len(segments) > depth else str(release_dir)
+    return Path(candidate) if candidate else None
+
+# 🔵 release directories +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+
+
+
+
+
+
+
 # 🔵 git rollback +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 
 
 
 
-def rollback_to_version(tag: str):
-    """Rollback to specific version tag or initial state following git.txt instructions"""
+# Working-tree side of a rollback; runs in the background after the release pointer has moved
+ROLLBACK_STAGES = ("checkout", "reset", "push")
+
+
+def resolve_rollback_rev(PROJECT_PATH, tag: str):
+    """Map a rollback target to a git revision; returns (rev, error)"""
+    history, positions = get_version_history_index(PROJECT_PATH)
+    version_tags = [entry['tag'] for entry in history if entry['tag'] != 'initial']
+    if tag == 'initial':
+        # Special handling for initial state - rollback to commit before first version tag
+        if not version_tags:
+            return None, "No version tags found"
+        first_tag = min(version_tags, key=lambda x: int(x[1:]))
+        return f'{first_tag}^1', None
+    if tag not in positions:
+        return None, f"Tag {tag} not found"
+    return tag, None
+
+
+def submit_rollback_job(PROJECT_PATH, tag: str, rev: str) -> dict:
+    job = create_job("rollback", PROJECT_PATH, ROLLBACK_STAGES)
+    start_job_thread(job, run_rollback_job, tag, rev)
+    return job
+
+
+def run_rollback_job(job: dict, tag: str, rev: str):
+    """Reset the working tree to rev and force push, following git.txt instructions"""
+    PROJECT_PATH = job["project"]
+    _, _, run_lock = _publish_lock_paths(PROJECT_PATH)
     try:
-        PROJECT_PATH = "projects/jbswebpage"
-        # Ensure we're on main branch
-        subprocess.run(['git', 'checkout', 'main'], capture_output=True, text=True, timeout=10, cwd=PROJECT_PATH)
-        
-        if tag == 'initial':
-            # Special handling for initial state - rollback to commit before first version tag
-            # Get the first version tag
-            result = subprocess.run(['git', 'tag', '--list'], capture_output=True, text=True, timeout=10, cwd=PROJECT_PATH)
+        # Never interleave with a publish of the same project
+        with file_lock(run_lock):
+            job["status"] = "running"
+            save_job(job)
+
+            # Ensure we're on main branch
+            set_job_stage(job, "checkout", "running")
+            subprocess.run(['git', 'checkout', 'main'], capture_output=True, text=True, timeout=10, cwd=PROJECT_PATH)
+            set_job_stage(job, "checkout", "succeeded")
+
+            set_job_stage(job, "reset", "running")
+            result = subprocess.run(['git', 'reset', '--hard', rev], capture_output=True, text=True, timeout=15, cwd=PROJECT_PATH)
             if result.returncode != 0:
-                return False, "Could not get tag list"
-            
-            tags = result.stdout.strip().split('\n') if result.stdout.strip() else []
-            version_tags = [tag for tag in tags if tag.startswith('v') and tag[1:].isdigit()]
-            
-            if not version_tags:
-                return False, "No version tags found"
-            
-            # Get the first tag (v1)
-            first_tag = sorted(version_tags, key=lambda x: int(x[1:]))[0]
-            
-            # Reset to commit before first tag
-            result = subprocess.run(['git', 'reset', '--hard', f'{first_tag}^1'], capture_output=True, text=True, timeout=15, cwd=PROJECT_PATH)
+                logger.error(f"Git reset failed: {result.stderr}")
+                set_job_stage(job, "reset", "failed", result.stderr)
+                finish_job(job, False, error=f"Git reset failed: {result.stderr}")
+                return
+            set_job_stage(job, "reset", "succeeded")
+            invalidate_version_history(PROJECT_PATH)
+            clear_journal(PROJECT_PATH)
+
+            # Force push to origin
+            set_job_stage(job, "push", "running")
+            result = subprocess.run(['git', 'push', 'origin', 'main', '--force'], capture_output=True, text=True, timeout=30, cwd=PROJECT_PATH)
             if result.returncode != 0:
-                logger.error(f"Git reset to initial state failed: {result.stderr}")
-                return False, f"Git reset to initial state failed: {result.stderr}"
-            
+                logger.warning(f"Git push failed: {result.stderr}")
+                # Continue even if push fails
+                set_job_stage(job, "push", "failed", result.stderr)
+            else:
+                set_job_stage(job, "push", "succeeded")
+
+        finish_job(job, True, message=f"Working tree reset to {tag}")
+    except Exception as e:
+        logger.exception("rollback job error")
+        finish_job(job, False, error=f"Rollback failed: {str(e)}")
+
+
+def rollback_to_version(tag: str):
+    """Rollback to specific version tag or initial state
+
+    Visitors are switched to the tag's release directory immediately; the git reset
+    and force push run as a background job. Returns (success, message, job id).
+    """
+    try:
+        PROJECT_PATH = DEFAULT_PROJECT_PATH
+        rev, error = resolve_rollback_rev(PROJECT_PATH, tag)
+        if error:
+            return False, error, None
+
+        materialize_release(PROJECT_PATH, tag, rev)
+        activate_release(PROJECT_PATH, tag)
+        job = submit_rollback_job(PROJECT_PATH, tag, rev)
+
+        if tag == 'initial':
             rollback_message = "Successfully rolled back to initial state (before any versions)"
         else:
-            # Verify tag exists
-            result = subprocess.run(['git', 'tag', '--list', tag], capture_output=True, text=True, timeout=10, cwd=PROJECT_PATH)
-            if result.returncode != 0 or not result.stdout.strip():
-                return False, f"Tag {tag} not found"
-            
-            # Reset branch to desired version tag
-            result = subprocess.run(['git', 'reset', '--hard', tag], capture_output=True, text=True, timeout=15, cwd=PROJECT_PATH)
-            if result.returncode != 0:
-                logger.error(f"Git reset failed: {result.stderr}")
-                return False, f"Git reset failed: {result.stderr}"
-            
             rollback_message = f"Successfully rolled back to {tag}"
-        
-        # Force push to origin
-        result = subprocess.run(['git', 'push', 'origin', 'main', '--force'], capture_output=True, text=True, timeout=30, cwd=PROJECT_PATH)
-        if result.returncode != 0:
-            logger.warning(f"Git push failed: {result.stderr}")
-            # Continue even if push fails
-        
-        return True, rollback_message
+        return True, rollback_message, job["id"]
     except Exception as e:
         logger.error(f"Error in rollback_to_version: {e}")
-        return False, f"Rollback failed: {str(e)}"
+        return False, f"Rollback failed: {str(e)}", None
 
 
 
@@ -364,12 +920,14 @@ def rollback():
         if tag != 'initial' and (not tag.startswith('v') or not tag[1:].isdigit()):
             return jsonify({"success": False, "error": "Invalid tag format. Expected format: v1, v2, v3, etc. or 'initial'"}), 400
         
-        rollback_success, rollback_message = rollback_to_version(tag)
+        rollback_success, rollback_message, job_id = rollback_to_version(tag)
         
         return jsonify({
             "success": rollback_success,
             "message": rollback_message,
-            "rolledback_to": tag if rollback_success else None
+            "rolledback_to": tag if rollback_success else None,
+            "job_id": job_id,
+            "status_url": f"/api/rollback/{job_id}" if job_id else None
         })
         
     except Exception as e:
@@ -377,6 +935,15 @@ def rollback():
         return jsonify({"success": False, "error": f"Rollback failed: {str(e)}"}), 500
 
 
+@app.route("/api/rollback/<job_id>", methods=["GET"])
+def rollback_status(job_id):
+    """Report progress of the background reset and force push behind a rollback"""
+    job = load_job(job_id)
+    if not job or job["kind"] != "rollback":
+        return jsonify({"success": False, "error": "Rollback job not found"}), 404
+    return jsonify({"success": True, "job": job})
+
+
 
 
 # 🔵 git rollback +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
@@ -408,132 +975,1223 @@ def safe_join_projects(path_fragment: str) -> Path:
 
 
 
-# 🔵 git direct text edit - manual editing +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+# 📄 document cache +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 
+# Edit endpoints share one parsed copy of each page; entries are keyed by resolved path and
+# checked against (mtime, size), and saves write through so the next edit skips the parse
+DOCUMENT_CACHE_MAX_BYTES = int(os.getenv("DOCUMENT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# Rough memory cost of a BeautifulSoup tree relative to its source text
+DOCUMENT_SOUP_OVERHEAD = 10
 
+# Resolved path -> (version key, CachedDocument)
+document_cache = LRUCache(DOCUMENT_CACHE_MAX_BYTES)
 
 
-@app.route("/api/direct-text-edit", methods=["POST"])
-def direct_text_edit():
-    try:
-        data = request.get_json(force=True, silent=True) or {}
-        url = data.get("url", "")
-        element_selector = data.get("elementSelector", "")
-        new_text = data.get("newText", "")
-        original_text = data.get("originalText", "")
+class CachedDocument:
+    """Raw text of a page plus a lazily built BeautifulSoup tree; hold .lock while mutating .soup"""
 
-        if not (url and element_selector and new_text):
-            return jsonify({"success": False, "error": "Missing url, elementSelector, newText"}), 400
+    def __init__(self, file_path: Path, text: str, soup=None):
+        self.file_path = file_path
+        self.text = text
+        self._soup = soup
+        self.lock = threading.RLock()
 
-        parts = url.strip("/").split("/")
-        logger.info(f"Direct text edit - URL: {url}, Parts: {parts}")
-        
-        # Handle both formats: /user_xxx/project and /project
-        if len(parts) >= 2 and parts[0].startswith("user_"):
-            # Format: /user_xxx/project_name
-            user_dir = parts[0]
-            project_dir = parts[1]
-            project_path = safe_join_projects(f"{user_dir}/{project_dir}")
-            logger.info(f"Using user format - Path: {project_path}")
-        elif len(parts) >= 1 and parts[0]:  # Check if first part is not empty
-            # Format: /project_name (direct project)
-            project_dir = parts[0]
-            project_path = safe_join_projects(project_dir)
-            logger.info(f"Using direct format - Path: {project_path}")
-        else:
-            logger.error(f"Cannot parse URL: {url}, parts: {parts}")
-            return jsonify({"success": False, "error": "Cannot determine project path from URL"}), 400
+    @property
+    def soup(self):
+        if self._soup is None:
+            from bs4 import BeautifulSoup
+            self._soup = BeautifulSoup(self.text, 'html.parser')
+            # Re-account the entry now that it also holds a tree
+            _cache_document(self)
+        return self._soup
 
-        if parts[-1].endswith(".html"):
-            html_file_path = project_path / parts[-1]
-        else:
-            html_file_path = project_path / "index.html"
+    @property
+    def size(self) -> int:
+        return len(self.text) * (1 + (DOCUMENT_SOUP_OVERHEAD if self._soup is not None else 0))
 
-        if not html_file_path.exists():
-            return jsonify({"success": False, "error": f"HTML file not found: {html_file_path}"}), 404
 
-        html = html_file_path.read_text(encoding="utf-8")
+def _cache_document(document: CachedDocument):
+    version = _stat_key(document.file_path)
+    if version is None:
+        document_cache.pop(document.file_path)
+        return
+    document_cache.put(document.file_path, (version, document), document.size)
 
-        if original_text and original_text in html:
-            updated = html.replace(original_text, new_text)
-        else:
-            updated = html
-            if original_text:
-                import re
-                escaped = re.escape(original_text.strip())
-                pattern = re.sub(r"\\\s+", r"\\s+", escaped)
-                m = re.search(pattern, html, re.IGNORECASE | re.MULTILINE)
-                if m:
-                    updated = html.replace(m.group(0), new_text)
-                else:
-                    return jsonify({"success": False, "error": "Original text not found"}), 404
-            else:
-                return jsonify({"success": False, "error": "originalText required for replacement"}), 400
 
-        html_file_path.write_text(updated, encoding="utf-8")
-        
-        # Note: Changes are saved to file but not committed to git
-        # User will use "Save Changes" button to commit and push all edits at once
-        
-        response = {
-            "success": True, 
-            "message": f"Updated {html_file_path.name}", 
-            "file_path": str(html_file_path),
-            "git_status": False,
-            "git_message": "Changes saved locally (not committed)"
-        }
-        
-        return jsonify(response)
+def load_document(file_path: Path) -> CachedDocument:
+    """Cached document for file_path, re-read only when the file changed on disk"""
+    file_path = Path(file_path).resolve()
+    version = _stat_key(file_path)
+    entry = document_cache.get(file_path)
+    if entry is None:
+        document = CachedDocument(file_path, file_path.read_text(encoding="utf-8"))
+        _cache_document(document)
+        return document
+    if version is not None and entry[0] == version:
+        return entry[1]
 
-    except Exception as e:
-        logger.exception("direct_text_edit error")
-        return jsonify({"success": False, "error": f"Internal error: {e}"}), 500
+    # Refresh in place: every request for a page must share one document, and so one lock
+    document = entry[1]
+    with document.lock:
+        entry = document_cache.get(file_path)
+        if entry is None or entry[1] is not document or entry[0] != _stat_key(file_path):
+            document.text = file_path.read_text(encoding="utf-8")
+            document._soup = None
+            _cache_document(document)
+    return document
 
 
-@app.route("/api/undo", methods=["POST"])
-def undo_changes():
-    """Undo all uncommitted changes by resetting to HEAD"""
+def store_document(file_path: Path, text: str, soup=None):
+    """Write-through: remember text (and the tree it was serialized from) as the file's current content"""
+    file_path = Path(file_path).resolve()
+    entry = document_cache.get(file_path)
+    if entry is None:
+        _cache_document(CachedDocument(file_path, text, soup))
+        return
+    # Update in place so requests already waiting on this document's lock see the new content
+    document = entry[1]
+    if not document.lock.acquire(blocking=False):
+        # Held by another request (callers hold their own page's lock, so this entry is not theirs);
+        # waiting could deadlock against the journal lock, so start a fresh entry instead
+        _cache_document(CachedDocument(file_path, text, soup))
+        return
     try:
-        PROJECT_PATH = "projects/jbswebpage"
-        
-        # Check if there are any changes to undo
-        status_result = subprocess.run(['git', 'status', '--porcelain'], capture_output=True, text=True, timeout=10, cwd=PROJECT_PATH)
-        if status_result.returncode != 0:
-            logger.error(f"Git status failed: {status_result.stderr}")
-            return jsonify({"success": False, "error": f"Git status failed: {status_result.stderr}"}), 500
-        
-        if not status_result.stdout.strip():
-            logger.info("No changes to undo")
-            return jsonify({"success": True, "message": "No changes to undo"})
-        
-        # Reset all changes to HEAD (undo all uncommitted changes)
-        result = subprocess.run(['git', 'checkout', '--', '.'], capture_output=True, text=True, timeout=15, cwd=PROJECT_PATH)
-        if result.returncode != 0:
-            logger.error(f"Git checkout failed: {result.stderr}")
-            return jsonify({"success": False, "error": f"Undo failed: {result.stderr}"}), 500
-        
-        # Also remove any untracked files that might have been created
-        result = subprocess.run(['git', 'clean', '-fd'], capture_output=True, text=True, timeout=10, cwd=PROJECT_PATH)
-        if result.returncode != 0:
-            logger.warning(f"Git clean failed: {result.stderr}")
-            # Continue even if clean fails - checkout is the main operation
-        
-        return jsonify({"success": True, "message": "Successfully undid all uncommitted changes"})
-    except Exception as e:
-        logger.exception("undo_changes error")
-        return jsonify({"success": False, "error": f"Undo failed: {str(e)}"}), 500
+        document.text = text
+        document._soup = soup
+        _cache_document(document)
+    finally:
+        document.lock.release()
 
 
-@app.route("/api/get-file-content", methods=["GET"])
-def get_file_content():
-    """Get current file content for preview after AI edit"""
-    try:
-        url = request.args.get('url')
+def forget_document(file_path: Path):
+    document_cache.pop(Path(file_path).resolve())
+
+# 📄 document cache +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+
+
+
+
+
+# 🔎 element index +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+# One tokenizer pass per page maps element ids, tag/class signatures and normalized text runs
+# to source offsets (str indices), so edits jump to their span instead of scanning the page.
+# Text-only edits are recorded as splices on the existing index instead of forcing a rebuild.
+ELEMENT_INDEX_CACHE_MAX_BYTES = int(os.getenv("ELEMENT_INDEX_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+# Rough memory cost of an index relative to its source text
+ELEMENT_INDEX_OVERHEAD = 3
+# Splices an index absorbs before the next lookup rebuilds it
+ELEMENT_INDEX_MAX_SPLICES = 256
+# How many ancestors of a text run are compared against the element hints
+ELEMENT_HINT_DEPTH = 3
+
+VOID_ELEMENTS = frozenset((
+    "area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "param",
+    "source", "track", "wbr",
+))
+RAW_TEXT_ELEMENTS = frozenset(("script", "style", "template", "textarea", "title"))
+# Opening one of these closes an unclosed sibling of the same tag
+SELF_CLOSING_SIBLINGS = frozenset(("li", "p", "option", "dt", "dd", "tr", "td", "th"))
+
+_HTML_TOKEN_RE = re.compile(
+    r"<!--.*?(?:-->|$)|<(/?)([a-zA-Z][^\s/>]*)((?:[^>\"']|\"[^\"]*\"|'[^']*')*)>|<![^>]*>|<\?[^>]*>",
+    re.S,
+)
+_ID_CLASS_ATTR_RE = re.compile(r"""(?:^|\s)(id|class)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))""", re.I)
+_INDEXED_ATTR_RE = re.compile(r"""(?:^|\s)(id|class|src)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))""", re.I)
+# Attribute name -> compiled value matcher, for reading/rewriting one attribute inside a start tag
+_attribute_res = {}
+
+# hash(text) -> (text, ElementIndex); str hashes are cached, so repeat lookups are O(1)
+element_index_cache = LRUCache(ELEMENT_INDEX_CACHE_MAX_BYTES)
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(html_lib.unescape(text).split()).casefold()
+
+
+class IndexedElement:
+    __slots__ = ("tag", "id", "classes", "src", "parent", "start", "content_start", "content_end", "end")
+
+    def __init__(self, tag, element_id, classes, src, parent, start, content_start):
+        self.tag = tag
+        self.id = element_id
+        self.classes = classes
+        self.src = src
+        self.parent = parent
+        self.start = start
+        self.content_start = content_start
+        self.content_end = content_start
+        self.end = content_start
+
+    @property
+    def signature(self) -> str:
+        return ".".join((self.tag,) + self.classes)
+
+
+class TextRun:
+    __slots__ = ("start", "end", "key", "parent")
+
+    def __init__(self, start, end, key, parent):
+        self.start = start
+        self.end = end
+        self.key = key
+        self.parent = parent
+
+
+class ElementIndex:
+    """Elements and text runs of one HTML string, in document order
+
+    Offsets are stored as of the build; splice() derives the index of an edited text by
+    recording text-only edits, and position() maps stored offsets into that text. An index is
+    never modified once built, so readers holding an older text keep consistent offsets.
+    """
+
+    def __init__(self, html: str):
+        self.html = html
+        self.elements = []
+        self.ids = {}
+        self.signatures = {}
+        # src attribute value -> [IndexedElement], for <img>, <source>, <script>, ...
+        self.sources = {}
+        self.runs = []
+        # normalized text -> [TextRun]
+        self.text_runs = {}
+        # (start, end, length delta) of each splice, in the coordinates of the text it was applied to
+        self.splices = []
+        # Spliced indexes share TextRun / IndexedElement objects; their changed keys and srcs live here
+        self.run_keys = {}
+        self.element_srcs = {}
+        self._build()
+        self._run_starts = [run.start for run in self.runs]
+        self._element_starts = [element.start for element in self.elements]
+        # Same tag sequence => same element ordinals, in every worker process
+        self.structure = hashlib.sha1(" ".join(element.tag for element in self.elements).encode("utf-8")).hexdigest()[:8]
+
+    def _build(self):
+        html = self.html
+        stack = []
+        pos = 0
+        while True:
+            m = _HTML_TOKEN_RE.search(html, pos)
+            start = m.start() if m else len(html)
+            if start > pos:
+                self._add_run(pos, start, stack[-1] if stack else None)
+            if not m:
+                break
+            pos = m.end()
+            tag = (m.group(2) or "").lower()
+            if not tag:
+                continue
+            if m.group(1):
+                # Close implicitly ended children along with the matching element
+                for depth in range(len(stack) - 1, -1, -1):
+                    if stack[depth].tag == tag:
+                        for element in stack[depth:]:
+                            element.content_end = start
+                            element.end = pos
+                        del stack[depth:]
+                        break
+                continue
+
+            if tag in SELF_CLOSING_SIBLINGS and stack and stack[-1].tag == tag:
+                stack[-1].content_end = stack[-1].end = start
+                stack.pop()
+            attrs = m.group(3) or ""
+            element_id, classes, src = "", (), None
+            for attr in _INDEXED_ATTR_RE.finditer(attrs):
+                name = attr.group(1).lower()
+                value = html_lib.unescape(attr.group(2) or attr.group(3) or attr.group(4) or "")
+                if name == "id":
+                    element_id = element_id or value
+                elif name == "class":
+                    classes = tuple(value.split())
+                elif src is None:
+                    src = value
+            element = IndexedElement(tag, element_id, classes, src, stack[-1] if stack else None, start, pos)
+            self.elements.append(element)
+            if element_id:
+                self.ids.setdefault(element_id, element)
+            if src is not None:
+                self.sources.setdefault(src, []).append(element)
+            self.signatures.setdefault(element.signature, []).append(element)
+
+            if tag in VOID_ELEMENTS or attrs.rstrip().endswith("/"):
+                continue
+            if tag in RAW_TEXT_ELEMENTS:
+                # Skip script/style bodies; they never hold editable text
+                close = re.compile(rf"</{re.escape(tag)}\s*>", re.I).search(html, pos)
+                element.content_end = close.start() if close else len(html)
+                element.end = pos = close.end() if close else len(html)
+                continue
+            stack.append(element)
+
+        for element in stack:
+            element.content_end = element.end = len(html)
+
+    def _add_run(self, start: int, end: int, parent):
+        raw = self.html[start:end]
+        key = normalize_text(raw)
+        if not key:
+            return
+        start += len(raw) - len(raw.lstrip())
+        end -= len(raw) - len(raw.rstrip())
+        run = TextRun(start, end, key, parent)
+        self.runs.append(run)
+        self.text_runs.setdefault(key, []).append(run)
+
+    def position(self, offset: int) -> int:
+        """Map a stored offset into the current text"""
+        for start, end, delta in self.splices:
+            if offset >= end:
+                offset += delta
+        return offset
+
+    def _stored_offset(self, position: int) -> int:
+        for start, end, delta in reversed(self.splices):
+            if position >= end + delta:
+                position -= delta
+        return position
+
+    def span(self, item):
+        """Current (start, end) of an IndexedElement or TextRun"""
+        return self.position(item.start), self.position(item.end)
+
+    def find_text(self, text: str, hints: dict = None):
+        """Current span of the run whose normalized text equals text, preferring elements matching hints"""
+        candidates = self.text_runs.get(normalize_text(text))
+        if not candidates:
+            return None
+        if hints and len(candidates) > 1:
+            best = max(candidates, key=lambda run: _hint_score(run.parent, hints))
+        else:
+            best = candidates[0]
+        return self.span(best)
+
+    def find_text_in(self, element: IndexedElement, text: str):
+        """Current span of a run with this text inside element, or None"""
+        element_start, element_end = self.span(element)
+        for run in self.text_runs.get(normalize_text(text), ()):
+            run_start, run_end = self.span(run)
+            if element_start <= run_start and run_end <= element_end:
+                return run_start, run_end
+        return None
+
+    def _src(self, element: IndexedElement):
+        return self.element_srcs.get(element, element.src)
+
+    def _derive(self, new_html: str, splice: tuple) -> "ElementIndex":
+        """Shallow copy describing new_html; callers replace, never mutate, the tables they change"""
+        index = copy.copy(self)
+        index.html = new_html
+        index.splices = self.splices + [splice]
+        return index
+
+    def _rekey_source(self, element: IndexedElement):
+        """Move element to its current src after an attribute splice, on a freshly derived index"""
+        sources = dict(self.sources)
+        old_src = self._src(element)
+        remaining = [e for e in sources[old_src] if e is not element]
+        if remaining:
+            sources[old_src] = remaining
+        else:
+            del sources[old_src]
+        attribute = start_tag_attribute(self.html, self, element, "src")
+        src = attribute[2] if attribute else None
+        if src is not None:
+            sources[src] = sorted(sources.get(src, []) + [element], key=lambda e: e.start)
+        self.sources = sources
+        self.element_srcs = {**self.element_srcs, element: src}
+
+    def lw_id(self, ordinal: int) -> str:
+        return f"{self.structure}-{ordinal}"
+
+    def resolve_lw_id(self, lw_id: str, tag: str = ""):
+        """Element a data-lw-id from this page version names, or None if the page structure changed"""
+        structure, _, ordinal = str(lw_id).partition("-")
+        if structure != self.structure or not ordinal.isdigit() or int(ordinal) >= len(self.elements):
+            return None
+        element = self.elements[int(ordinal)]
+        if tag and element.tag != tag.lower():
+            return None
+        return element
+
+    def splice(self, start: int, end: int, replacement: str, new_html: str):
+        """Index of new_html, where html[start:end] became replacement; None if it can't follow the edit"""
+        removed = self.html[start:end]
+        if "<" in removed or ">" in removed or "<" in replacement or ">" in replacement:
+            return None
+        if len(self.splices) >= ELEMENT_INDEX_MAX_SPLICES:
+            return None
+        stored = self._stored_offset(start)
+        delta = len(replacement) - (end - start)
+
+        # Attribute edits strictly inside one start tag only shift offsets, unless they touch id/class
+        j = bisect.bisect_right(self._element_starts, stored) - 1
+        if j >= 0:
+            element = self.elements[j]
+            tag_start, tag_end = self.position(element.start), self.position(element.content_start)
+            if tag_start < start and end < tag_end:
+                if _ID_CLASS_ATTR_RE.search(removed) or _ID_CLASS_ATTR_RE.search(replacement):
+                    return None
+                index = self._derive(new_html, (start, end, delta))
+                if self._src(element) is not None:
+                    index._rekey_source(element)
+                return index
+
+        # Otherwise the edit must stay inside one text run, whose key changes
+        i = bisect.bisect_right(self._run_starts, stored) - 1
+        if i < 0:
+            return None
+        run = self.runs[i]
+        run_start, run_end = self.span(run)
+        if not (run_start <= start and end <= run_end):
+            return None
+
+        text = new_html[run_start:run_end + delta]
+        key = normalize_text(text)
+        if not key or text != text.strip():
+            # Emptied or re-padded runs would need their bounds recomputed
+            return None
+
+        index = self._derive(new_html, (start, end, delta))
+        old_key = self.run_keys.get(run, run.key)
+        text_runs = dict(self.text_runs)
+        remaining = [r for r in text_runs[old_key] if r is not run]
+        if remaining:
+            text_runs[old_key] = remaining
+        else:
+            del text_runs[old_key]
+        text_runs[key] = sorted(text_runs.get(key, []) + [run], key=lambda r: r.start)
+        index.text_runs = text_runs
+        index.run_keys = {**self.run_keys, run: key}
+        return index
+
+
+def _hint_score(element, hints: dict) -> int:
+    """id match beats tag+classes beats tag; nearer ancestors beat farther ones"""
+    hint_id = hints.get("id") or ""
+    hint_tag = (hints.get("tag") or "").lower()
+    hint_classes = set((hints.get("classes") or "").split())
+    score = 0
+    for depth in range(ELEMENT_HINT_DEPTH):
+        if element is None:
+            break
+        if hint_id and element.id == hint_id:
+            match = 3
+        elif hint_tag and element.tag == hint_tag and set(element.classes) == hint_classes:
+            match = 2
+        elif hint_tag and element.tag == hint_tag:
+            match = 1
+        else:
+            match = 0
+        if match:
+            score = max(score, match * ELEMENT_HINT_DEPTH - depth)
+        element = element.parent
+    return score
+
+
+def _element_index_key(html: str):
+    return hash(html), len(html)
+
+
+def get_element_index(html: str) -> ElementIndex:
+    """Index for html, built once per distinct page content"""
+    entry = element_index_cache.get(_element_index_key(html))
+    if entry is not None and (entry[0] is html or entry[0] == html):
+        return entry[1]
+    index = ElementIndex(html)
+    element_index_cache.put(_element_index_key(html), (html, index), len(html) * ELEMENT_INDEX_OVERHEAD)
+    return index
+
+
+def splice_text(html: str, start: int, end: int, replacement: str) -> str:
+    """html with [start, end) replaced; carries an existing index over to the result when possible"""
+    updated = html[:start] + replacement + html[end:]
+    entry = element_index_cache.pop(_element_index_key(html))
+    index = entry[1].splice(start, end, replacement, updated) if entry is not None and entry[0] is html else None
+    if index is not None:
+        element_index_cache.put(_element_index_key(updated), (updated, index), len(updated) * ELEMENT_INDEX_OVERHEAD)
+    return updated
+
+
+def splice_many(html: str, edits) -> str:
+    """html with each non-overlapping (start, end, replacement) applied, built in one pass"""
+    edits = sorted(edits)
+    if len(edits) == 1:
+        return splice_text(html, *edits[0])
+    chunks = []
+    pos = 0
+    for start, end, replacement in edits:
+        chunks.append(html[pos:start])
+        chunks.append(replacement)
+        pos = end
+    chunks.append(html[pos:])
+    # Several edits at once: let the next lookup rebuild the index instead of replaying them
+    element_index_cache.pop(_element_index_key(html))
+    return "".join(chunks)
+
+
+def selector_hints(selector: str) -> dict:
+    """Element hints from a toolbar selector of the form tag#id.class1.class2"""
+    m = re.match(r"^([\w-]*)(?:#([^.\s]+))?((?:\.[^.\s]+)*)$", (selector or "").strip())
+    if not m:
+        return {}
+    return {"tag": m.group(1), "id": m.group(2) or "", "classes": " ".join(filter(None, m.group(3).split(".")))}
+
+
+def locate_text(html: str, original_text: str, hints: dict = None):
+    """Source span of original_text: indexed text runs first, then the old relaxed scan"""
+    span = get_element_index(html).find_text(original_text, hints)
+    if span is not None:
+        return span
+
+    # Text crossing inline tags is not a single run; fall back to scanning
+    start = html.find(original_text)
+    if start >= 0:
+        return start, start + len(original_text)
+    escaped = re.escape(original_text.strip())
+    pattern = re.sub(r"\\\s+", r"\\s+", escaped)
+    m = re.search(pattern, html, re.IGNORECASE | re.MULTILINE)
+    return m.span() if m else None
+
+
+def element_for_edit(html: str, data: dict, tag: str = ""):
+    """(index, element) addressed by the request's lwId, or (index, None) when absent or stale"""
+    lw_id = data.get("lwId")
+    if not lw_id:
+        return None, None
+    index = get_element_index(html)
+    return index, index.resolve_lw_id(lw_id, tag or data.get("elementTag", ""))
+
+
+def start_tag_attribute(html: str, index: ElementIndex, element: IndexedElement, name: str):
+    """(value start, value end, unescaped value) of an attribute in element's start tag, quotes included in the span"""
+    tag_start, tag_end = index.position(element.start), index.position(element.content_start)
+    attribute_re = _attribute_res.get(name)
+    if attribute_re is None:
+        attribute_re = _attribute_res[name] = re.compile(rf"""\s{re.escape(name)}\s*=\s*("[^"]*"|'[^']*'|[^\s"'>]+)""", re.I)
+    m = attribute_re.search(html, tag_start, tag_end)
+    if not m:
+        return None
+    value = m.group(1)
+    if value[:1] in "\"'":
+        value = value[1:-1]
+    return m.start(1), m.end(1), html_lib.unescape(value)
+
+
+def set_attribute(html: str, index: ElementIndex, element: IndexedElement, name: str, value: str) -> str:
+    """Rewrite (or add) one attribute of element's start tag in the source, leaving the rest untouched"""
+    quoted = '"' + html_lib.escape(value, quote=True) + '"'
+    attribute = start_tag_attribute(html, index, element, name)
+    if attribute is not None:
+        return splice_text(html, attribute[0], attribute[1], quoted)
+    tag_end = index.position(element.content_start)
+    if html[tag_end - 1:tag_end] != ">":
+        raise EditError(409, f"Could not locate the <{element.tag}> start tag; reload the page and retry")
+    insert_at = tag_end - 2 if html[tag_end - 2:tag_end] == "/>" else tag_end - 1
+    return splice_text(html, insert_at, insert_at, f" {name}={quoted}")
+
+# 🔎 element index +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+
+
+
+
+
+# 🟡 edit journal +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+# Every write endpoint appends a patch (character index into the page, removed text, inserted
+# text) to STATE_DIR/journal/<project>.jsonl; <project>.json holds the undo/redo stacks as the
+# byte positions of those lines, so undoing or redoing one edit never touches git or rescans the
+# tree. Entries that fall off the undo stack are compacted out of the .jsonl file.
+JOURNAL_DIR = STATE_DIR / "journal"
+JOURNAL_MAX_EDITS = int(os.getenv("JOURNAL_MAX_EDITS", "200"))
+
+
+class JournalConflict(Exception):
+    """The file no longer matches the journal entry (edited outside the journal)"""
+
+
+def _journal_paths(project_path):
+    key = project_key(project_path)
+    return JOURNAL_DIR / f"{key}.jsonl", JOURNAL_DIR / f"{key}.json", JOURNAL_DIR / f"{key}.lock"
+
+
+def _load_journal_state(state_path: Path) -> dict:
+    try:
+        return json.loads(state_path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {"undo": [], "redo": []}
+
+
+def make_patch(old_text: str, new_text: str):
+    """Smallest single-span patch turning old_text into new_text: (offset, removed, inserted)"""
+    limit = min(len(old_text), len(new_text))
+    start = 0
+    while start < limit and old_text[start] == new_text[start]:
+        start += 1
+    end = 0
+    while end < limit - start and old_text[-1 - end] == new_text[-1 - end]:
+        end += 1
+    return start, old_text[start:len(old_text) - end], new_text[start:len(new_text) - end]
+
+
+def resolve_project_path(url: str):
+    """Project directory for an admin page URL (/user_xxx/project/... or /project/...), or None"""
+    parts = url.strip("/").split("/")
+    if len(parts) >= 2 and parts[0].startswith("user_"):
+        return safe_join_projects(f"{parts[0]}/{parts[1]}")
+    if parts[0]:
+        return safe_join_projects(parts[0])
+    return None
+
+
+def journaled_write(project_path, file_path: Path, old_text: str, new_text: str, action: str, soup=None):
+    """Write new_text to file_path and journal the reverse patch; returns the entry (or None if unchanged)
+
+    soup, when given, is the tree new_text was serialized from and is kept in the document cache.
+    """
+    if new_text == old_text:
+        return None
+    project_root = Path(project_path).resolve()
+    offset, removed, inserted = make_patch(old_text, new_text)
+    entry = {
+        "file": Path(file_path).resolve().relative_to(project_root).as_posix(),
+        "action": action,
+        "offset": offset,
+        "removed": removed,
+        "inserted": inserted,
+        "at": time.time(),
+    }
+    journal_path, state_path, lock_path = _journal_paths(project_root)
+    with file_lock(lock_path):
+        try:
+            _write_atomic(Path(file_path), new_text.encode("utf-8"))
+        except OSError:
+            forget_document(file_path)
+            raise
+        store_document(file_path, new_text, soup)
+        state = _load_journal_state(state_path)
+        with open(journal_path, "ab") as journal:
+            position = journal.tell()
+            journal.write(json.dumps(entry).encode("utf-8") + b"\n")
+        state["undo"].append(position)
+        # A new edit invalidates anything that was undone before it
+        state["redo"] = []
+        if len(state["undo"]) > JOURNAL_MAX_EDITS:
+            state["undo"] = state["undo"][-JOURNAL_MAX_EDITS:]
+            # Rewrite once the dead lines reach the live ones, so compaction stays amortized O(1)
+            if state["undo"][0] >= journal_path.stat().st_size // 2:
+                _compact_journal(journal_path, state)
+        _write_atomic(state_path, json.dumps(state).encode("utf-8"))
+    return entry
+
+
+def _compact_journal(journal_path: Path, state: dict):
+    """Drop lines no stack refers to and remap the stacks; caller holds the journal lock"""
+    lines, moved = [], {}
+    size = 0
+    with open(journal_path, "rb") as journal:
+        for position in sorted(set(state["undo"] + state["redo"])):
+            journal.seek(position)
+            line = journal.readline()
+            moved[position] = size
+            lines.append(line)
+            size += len(line)
+    _write_atomic(journal_path, b"".join(lines))
+    for stack in ("undo", "redo"):
+        state[stack] = [moved[position] for position in state[stack]]
+
+
+def _read_journal_entry(journal_path: Path, position: int) -> dict:
+    with open(journal_path, "rb") as journal:
+        journal.seek(position)
+        return json.loads(journal.readline())
+
+
+def _peek_journal_file(project_root: Path, journal_path: Path, state_path: Path, stack: str):
+    """File the top entry of stack refers to, read without the journal lock; only a hint"""
+    try:
+        state = _load_journal_state(state_path)
+        if state[stack]:
+            return (project_root / _read_journal_entry(journal_path, state[stack][-1])["file"]).resolve()
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+
+
+def step_journal(project_path, direction: str):
+    """Undo ("undo") or redo ("redo") the most recent journaled edit; returns (entry, depths) or (None, depths)"""
+    project_root = Path(project_path).resolve()
+    journal_path, state_path, lock_path = _journal_paths(project_root)
+    source, target = ("undo", "redo") if direction == "undo" else ("redo", "undo")
+    file_path = _peek_journal_file(project_root, journal_path, state_path, source)
+    while True:
+        document = load_document(file_path) if file_path is not None else None
+        # Same lock order as the edit endpoints: the page's document lock, then the journal flock
+        with document.lock if document is not None else nullcontext():
+            with file_lock(lock_path):
+                state = _load_journal_state(state_path)
+                if not state[source]:
+                    return None, journal_depths(state)
+                position = state[source][-1]
+                entry = _read_journal_entry(journal_path, position)
+                file_path = (project_root / entry["file"]).resolve()
+                if document is None or document.file_path != file_path:
+                    # The journal moved on since the peek; retry holding the page it names now
+                    continue
+
+                # Undo swaps the inserted span back for the removed one; redo does the opposite
+                expected, replacement = (entry["inserted"], entry["removed"]) if direction == "undo" else (entry["removed"], entry["inserted"])
+                text = document.text
+                offset = entry["offset"]
+                if text[offset:offset + len(expected)] != expected:
+                    raise JournalConflict(f"{entry['file']} changed outside the edit journal; cannot {direction} {entry['action']}")
+                text = text[:offset] + replacement + text[offset + len(expected):]
+                _write_atomic(file_path, text.encode("utf-8"))
+                # Update the document we hold rather than via store_document, which may lock another one
+                document.text = text
+                document._soup = None
+                _cache_document(document)
+                state[source].pop()
+                state[target].append(position)
+                _write_atomic(state_path, json.dumps(state).encode("utf-8"))
+                return entry, journal_depths(state)
+
+
+def journal_depths(state: dict) -> dict:
+    return {"undo_depth": len(state["undo"]), "redo_depth": len(state["redo"])}
+
+
+def clear_journal(project_path):
+    """Forget all journaled edits, e.g. after the working tree was reset by git"""
+    journal_path, state_path, lock_path = _journal_paths(project_path)
+    with file_lock(lock_path):
+        journal_path.unlink(missing_ok=True)
+        state_path.unlink(missing_ok=True)
+
+
+def _journal_step_response(direction: str):
+    try:
+        data = request.get_json(force=True, silent=True) or {}
+        url = data.get("url", "")
+        project_path = resolve_project_path(url) if url else DEFAULT_PROJECT_PATH
+        if project_path is None:
+            return jsonify({"success": False, "error": "Cannot determine project path from URL"}), 400
+
+        entry, depths = step_journal(project_path, direction)
+        if entry is None:
+            return jsonify({"success": True, "message": f"Nothing to {direction}", **depths})
+
+        return jsonify({
+            "success": True,
+            "message": f"{direction.capitalize()} {entry['action']} in {entry['file']}",
+            "file": entry["file"],
+            "action": entry["action"],
+            **depths
+        })
+    except JournalConflict as e:
+        return jsonify({"success": False, "error": str(e)}), 409
+    except Exception as e:
+        logger.exception(f"edit {direction} error")
+        return jsonify({"success": False, "error": f"{direction.capitalize()} failed: {str(e)}"}), 500
+
+
+@app.route("/api/edit-undo", methods=["POST"])
+def edit_undo():
+    """Undo the most recent journaled edit without touching git"""
+    return _journal_step_response("undo")
+
+
+@app.route("/api/edit-redo", methods=["POST"])
+def edit_redo():
+    """Re-apply the most recently undone edit"""
+    return _journal_step_response("redo")
+
+# 🟡 edit journal +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+
+
+
+
+
+# ✏️ edit operations +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+# Each operation takes the page and the request fields and returns the updated page plus a
+# result dict; the single-edit endpoints and /api/batch-edit share them. Text operations work
+# on the HTML string, tree operations on a BeautifulSoup tree that they modify in place.
+BATCH_EDIT_MAX_OPS = int(os.getenv("BATCH_EDIT_MAX_OPS", "500"))
+
+
+class EditError(Exception):
+    """An edit that cannot be applied; carries the HTTP status to report"""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def resolve_edit_target(url: str):
+    """(project path, HTML file path) for an admin page URL"""
+    parts = url.strip("/").split("/")
+    project_path = resolve_project_path(url)
+    if project_path is None:
+        logger.error(f"Cannot parse URL: {url}, parts: {parts}")
+        raise EditError(400, "Cannot determine project path from URL")
+
+    if parts[-1].endswith(".html"):
+        html_file_path = project_path / parts[-1]
+    else:
+        html_file_path = project_path / "index.html"
+
+    if not html_file_path.exists():
+        raise EditError(404, f"HTML file not found: {html_file_path}")
+    return project_path, html_file_path
+
+
+def edit_text(html: str, data: dict):
+    new_text = data.get("newText", "")
+    original_text = data.get("originalText", "")
+    if not new_text:
+        raise EditError(400, "Missing newText")
+    if not original_text:
+        raise EditError(400, "originalText required for replacement")
+
+    # An lwId pins the edit to one element; otherwise search the page with the selector as a hint
+    index, element = element_for_edit(html, data)
+    span = index.find_text_in(element, original_text) if element is not None else None
+    if span is None:
+        span = locate_text(html, original_text, selector_hints(data.get("elementSelector", "")))
+    if span is None:
+        raise EditError(404, "Original text not found")
+    start, end = span
+    return splice_text(html, start, end, strip_element_ids(new_text)), {}
+
+
+def _source_pairs(data: dict, old_key: str, new_key: str = None):
+    """[(old, new)] from a single old/new pair or a "replacements"/"imageSrcs" list in data"""
+    if new_key is None:
+        sources = data.get("imageSrcs") or ([data[old_key]] if data.get(old_key) else [])
+        return [(src, None) for src in sources if isinstance(src, str) and src]
+    replacements = data.get("replacements")
+    if isinstance(replacements, dict):
+        return [(old, new) for old, new in replacements.items() if old and new]
+    if isinstance(replacements, list):
+        return [(item.get(old_key), item.get(new_key)) for item in replacements
+                if isinstance(item, dict) and item.get(old_key) and item.get(new_key)]
+    if data.get(old_key) and data.get(new_key):
+        return [(data[old_key], data[new_key])]
+    return []
+
+
+def replace_image_src(html: str, data: dict):
+    """Point every element whose src is one of the old sources at its new source, in one pass"""
+    pairs = _source_pairs(data, "oldImageSrc", "newImageSrc")
+    if not pairs:
+        raise EditError(400, "Missing oldImageSrc or newImageSrc")
+
+    index, element = element_for_edit(html, data, "img")
+    if element is not None and len(pairs) == 1:
+        old_image_src, new_image_src = pairs[0]
+        src = start_tag_attribute(html, index, element, "src")
+        if src is not None and src[2] == old_image_src:
+            html = set_attribute(html, index, element, "src", new_image_src)
+            return html, {"old_src": old_image_src, "new_src": new_image_src, "replaced": {old_image_src: 1}}
+
+    index = get_element_index(html)
+    spans, replaced, missing, unresolved = [], {}, [], []
+    for old_src, new_src in pairs:
+        elements = index.sources.get(old_src, ())
+        # An indexed src whose attribute can't be re-read from the start tag is reported, not guessed at
+        attributes = [a for a in (start_tag_attribute(html, index, target, "src") for target in elements) if a is not None]
+        if not attributes:
+            missing.append(old_src)
+            if elements:
+                unresolved.append(old_src)
+            continue
+        quoted = '"' + html_lib.escape(new_src, quote=True) + '"'
+        spans.extend((attribute[0], attribute[1], quoted) for attribute in attributes)
+        replaced[old_src] = len(attributes)
+    if not spans:
+        if unresolved:
+            raise EditError(409, f"Could not locate the src attribute for '{unresolved[0]}'; reload the page and retry")
+        raise EditError(404, f"Image source '{missing[0]}' not found in HTML")
+
+    html = splice_many(html, set(spans))
+    result = {"replaced": replaced, "missing": missing}
+    if len(pairs) == 1:
+        result.update(old_src=pairs[0][0], new_src=pairs[0][1])
+    return html, result
+
+
+def delete_image_tags(html: str, data: dict):
+    """Remove every <img> whose src is one of the given sources, in one pass"""
+    sources = [src for src, _ in _source_pairs(data, "imageSrc")]
+    if not sources:
+        raise EditError(400, "Missing imageSrc")
+
+    index, element = element_for_edit(html, data, "img")
+    if element is not None and len(sources) == 1:
+        src = start_tag_attribute(html, index, element, "src")
+        if src is not None and src[2] == sources[0]:
+            start, end = index.span(element)
+            return splice_text(html, start, end, ""), {"deleted_src": sources[0], "removed": 1}
+
+    index = get_element_index(html)
+    spans, removed, missing = [], {}, []
+    for image_src in sources:
+        images = [target for target in index.sources.get(image_src, ()) if target.tag == "img"]
+        if not images:
+            missing.append(image_src)
+            continue
+        spans.extend(index.span(target) for target in images)
+        removed[image_src] = len(images)
+    if not spans:
+        raise EditError(404, f"Image tag with source '{missing[0]}' not found in HTML")
+
+    html = splice_many(html, {(start, end, "") for start, end in spans})
+    logger.info(f"Removed {len(spans)} img tag(s) for {len(removed)} source(s)")
+    result = {"removed": sum(removed.values()), "removed_by_src": removed, "missing": missing}
+    if len(sources) == 1:
+        result["deleted_src"] = sources[0]
+    return html, result
+
+
+def insert_image_html(html: str, data: dict):
+    image_html = strip_element_ids(data.get("imageHTML", ""))
+    insertion_method = data.get("insertionMethod", "append")
+    if not image_html:
+        raise EditError(400, "Missing imageHTML")
+
+    if insertion_method == "append":
+        # Append before closing body tag
+        if "</body>" in html:
+            html = html.replace("</body>", f"{image_html}\n</body>")
+        else:
+            # Fallback: append before closing html tag
+            html = html.replace("</html>", f"{image_html}\n</html>")
+    elif insertion_method == "prepend":
+        # Prepend after opening body tag
+        if "<body>" in html:
+            html = html.replace("<body>", f"<body>\n{image_html}")
+        else:
+            # Fallback: prepend after opening html tag
+            html = html.replace("<html>", f"<html>\n{image_html}")
+    return html, {}
+
+
+def merge_position_style(existing_style: str, position: dict) -> str:
+    """existing_style with its position/left/top/z-index replaced by the dragged position"""
+    # Build style string from position data
+    style_additions = []
+    if position.get('position'):
+        style_additions.append(f"position: {position['position']}")
+    if position.get('left'):
+        style_additions.append(f"left: {position['left']}")
+    if position.get('top'):
+        style_additions.append(f"top: {position['top']}")
+    if position.get('zIndex'):
+        style_additions.append(f"z-index: {position['zIndex']}")
+
+    if not existing_style:
+        return "; ".join(style_additions)
+
+    # Remove any existing position-related styles
+    style_dict = {}
+    for style_item in existing_style.split(';'):
+        style_item = style_item.strip()
+        if ':' in style_item:
+            key, value = style_item.split(':', 1)
+            key = key.strip().lower()
+            # Skip position-related styles as we'll add them fresh
+            if key not in ['position', 'left', 'top', 'z-index']:
+                style_dict[key] = value.strip()
+
+    # Add new position styles
+    for style_item in style_additions:
+        key, value = style_item.split(':', 1)
+        style_dict[key.strip()] = value.strip()
+
+    return '; '.join([f"{k}: {v}" for k, v in style_dict.items()])
+
+
+def set_element_position(soup, data: dict):
+    """Merge position styles into the matching element of soup (modified in place)"""
+    position = data.get("position", {})
+    element_tag = data.get("elementTag", "")
+    element_id = data.get("elementId", "")
+    element_classes = data.get("elementClasses", "")
+    if not position:
+        raise EditError(400, "Missing position")
+
+    # Try to find element by ID first
+    target_element = None
+    if element_id:
+        target_element = soup.find(id=element_id)
+
+    # If not found by ID, try by tag and classes
+    if not target_element and element_classes:
+        class_list = element_classes.split()
+        target_element = soup.find(element_tag, class_=class_list)
+
+    # If still not found, try just by tag
+    if not target_element:
+        target_element = soup.find(element_tag)
+
+    if not target_element:
+        raise EditError(404, f"Could not find element with selector: {data.get('elementSelector', '')}")
+
+    new_style = merge_position_style(target_element.get('style', ''), position)
+    target_element['style'] = new_style
+    return {"style": new_style}
+
+
+def set_element_position_in_source(html: str, data: dict):
+    """Position edit for an element addressed by lwId: rewrites only its style attribute"""
+    position = data.get("position", {})
+    if not position:
+        raise EditError(400, "Missing position")
+    index, element = element_for_edit(html, data)
+    if element is None:
+        raise EditError(404, f"Could not find element with id: {data.get('lwId')}")
+
+    style = start_tag_attribute(html, index, element, "style")
+    new_style = merge_position_style(style[2] if style else "", position)
+    return set_attribute(html, index, element, "style", new_style), {"style": new_style}
+
+
+# Operation name (the matching endpoint's path) -> text operation
+TEXT_EDIT_OPS = {
+    "direct-text-edit": edit_text,
+    "replace-image": replace_image_src,
+    "delete-image": delete_image_tags,
+    "save-image-to-html": insert_image_html,
+}
+# Operation name -> tree operation
+TREE_EDIT_OPS = {
+    "save-element-position": set_element_position,
+}
+
+
+def edit_operation(op_type: str, html, data: dict):
+    """("text", fn) or ("tree", fn) for op_type; position edits addressed by a valid lwId run on the source"""
+    if op_type == "save-element-position" and html is not None and element_for_edit(html, data)[1] is not None:
+        return "text", set_element_position_in_source
+    if op_type in TREE_EDIT_OPS:
+        return "tree", TREE_EDIT_OPS[op_type]
+    if op_type in TEXT_EDIT_OPS:
+        return "text", TEXT_EDIT_OPS[op_type]
+    raise EditError(400, f"Unknown operation type: {op_type!r}")
+
+
+def apply_single_edit(url: str, op_type: str, data: dict):
+    """Read-modify-write one page with a single operation; returns (file path, result)"""
+    project_path, html_file_path = resolve_edit_target(url)
+    action = op_type.replace("-", "_")
+    document = load_document(html_file_path)
+    with document.lock:
+        html = document.text
+        kind, operation = edit_operation(op_type, html, data)
+        if kind == "tree":
+            soup = document.soup
+            try:
+                result = operation(soup, data)
+                journaled_write(project_path, html_file_path, html, str(soup), action, soup=soup)
+            except EditError:
+                raise
+            except Exception:
+                # The cached tree may already be modified; make the next request re-parse from disk
+                forget_document(html_file_path)
+                raise
+        else:
+            updated, result = operation(html, data)
+            journaled_write(project_path, html_file_path, html, updated, action)
+    return html_file_path, result
+
+
+def apply_batch_edit(project_path, html_file_path: Path, operations: list):
+    """Apply operations in order to one in-memory copy of the page and write it once
+
+    Failed operations are reported and skipped; the rest still apply. Returns per-operation results.
+    """
+    results = []
+    document = load_document(html_file_path)
+    with document.lock:
+        original = document.text
+        # Exactly one of text / soup holds the current page; convert only when the operation kind changes
+        text, soup = original, None
+        try:
+            for index, data in enumerate(operations):
+                op_type = data.get("type", "") if isinstance(data, dict) else ""
+                try:
+                    kind, operation = edit_operation(op_type, text, data)
+                    if kind == "tree":
+                        if soup is None:
+                            # The cached tree is only valid while nothing has been changed yet
+                            if text is original:
+                                soup = document.soup
+                            else:
+                                from bs4 import BeautifulSoup
+                                soup = BeautifulSoup(text, 'html.parser')
+                            text = None
+                        result = operation(soup, data)
+                    else:
+                        if text is None:
+                            text, soup = str(soup), None
+                        text, result = operation(text, data)
+                    results.append({"index": index, "type": op_type, "success": True, **result})
+                except EditError as e:
+                    results.append({"index": index, "type": op_type, "success": False, "status": e.status, "error": e.message})
+
+            if not any(result["success"] for result in results):
+                # Nothing applied; a tree round trip would still reformat the page, so leave it alone
+                if soup is not None:
+                    # A failed operation may have touched the cached tree; re-parse on next use
+                    document._soup = None
+                return results
+            updated = text if text is not None else str(soup)
+            journaled_write(project_path, html_file_path, original, updated, "batch_edit", soup=soup)
+        except Exception:
+            # The cached tree may already be modified; make the next request re-parse from disk
+            forget_document(html_file_path)
+            raise
+    return results
+
+
+@app.route("/api/batch-edit", methods=["POST"])
+def batch_edit():
+    """Apply an ordered list of edits to one page with a single file write
+
+    Body: {"url": ..., "operations": [{"type": "direct-text-edit", "originalText": ..., "newText": ...}, ...]}
+    where each type names the single-edit endpoint whose fields it takes.
+    """
+    try:
+        data = request.get_json(force=True, silent=True) or {}
+        url = data.get("url", "")
+        operations = data.get("operations", [])
+
+        if not (url and isinstance(operations, list) and operations):
+            return jsonify({"success": False, "error": "Missing url or operations"}), 400
+        if len(operations) > BATCH_EDIT_MAX_OPS:
+            return jsonify({"success": False, "error": f"Too many operations (max {BATCH_EDIT_MAX_OPS})"}), 400
+
+        project_path, html_file_path = resolve_edit_target(url)
+        results = apply_batch_edit(project_path, html_file_path, operations)
+        applied = sum(1 for result in results if result["success"])
+
+        logger.info(f"Batch edit of {html_file_path}: {applied}/{len(results)} operations applied")
+
+        return jsonify({
+            "success": applied == len(results),
+            "message": f"Applied {applied} of {len(results)} operations to {html_file_path.name}",
+            "file_path": str(html_file_path),
+            "applied": applied,
+            "results": results,
+            "git_status": False,
+            "git_message": "Changes saved locally (not committed)"
+        })
+
+    except EditError as e:
+        return jsonify({"success": False, "error": e.message}), e.status
+    except Exception as e:
+        logger.exception("batch_edit error")
+        return jsonify({"success": False, "error": f"Internal error: {e}"}), 500
+
+# ✏️ edit operations +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+
+
+
+
+
+# 🔵 git direct text edit - manual editing +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+
+
+
+@app.route("/api/direct-text-edit", methods=["POST"])
+def direct_text_edit():
+    try:
+        data = request.get_json(force=True, silent=True) or {}
+        url = data.get("url", "")
+        element_selector = data.get("elementSelector", "")
+        new_text = data.get("newText", "")
+
+        if not (url and element_selector and new_text):
+            return jsonify({"success": False, "error": "Missing url, elementSelector, newText"}), 400
+
+        logger.info(f"Direct text edit - URL: {url}")
+        html_file_path, _ = apply_single_edit(url, "direct-text-edit", data)
+        
+        # Note: Changes are saved to file but not committed to git
+        # User will use "Save Changes" button to commit and push all edits at once
+        
+        response = {
+            "success": True, 
+            "message": f"Updated {html_file_path.name}", 
+            "file_path": str(html_file_path),
+            "git_status": False,
+            "git_message": "Changes saved locally (not committed)"
+        }
+        
+        return jsonify(response)
+
+    except EditError as e:
+        return jsonify({"success": False, "error": e.message}), e.status
+    except Exception as e:
+        logger.exception("direct_text_edit error")
+        return jsonify({"success": False, "error": f"Internal error: {e}"}), 500
+
+
+@app.route("/api/undo", methods=["POST"])
+def undo_changes():
+    """Undo all uncommitted changes by resetting to HEAD"""
+    try:
+        PROJECT_PATH = DEFAULT_PROJECT_PATH
+        
+        # Check if there are any changes to undo
+        status_result = subprocess.run(['git', 'status', '--porcelain'], capture_output=True, text=True, timeout=10, cwd=PROJECT_PATH)
+        if status_result.returncode != 0:
+            logger.error(f"Git status failed: {status_result.stderr}")
+            return jsonify({"success": False, "error": f"Git status failed: {status_result.stderr}"}), 500
+        
+        if not status_result.stdout.strip():
+            logger.info("No changes to undo")
+            clear_journal(PROJECT_PATH)
+            return jsonify({"success": True, "message": "No changes to undo"})
+        
+        # Reset all changes to HEAD (undo all uncommitted changes)
+        result = subprocess.run(['git', 'checkout', '--', '.'], capture_output=True, text=True, timeout=15, cwd=PROJECT_PATH)
+        if result.returncode != 0:
+            logger.error(f"Git checkout failed: {result.stderr}")
+            return jsonify({"success": False, "error": f"Undo failed: {result.stderr}"}), 500
+        
+        # Also remove any untracked files that might have been created
+        result = subprocess.run(['git', 'clean', '-fd'], capture_output=True, text=True, timeout=10, cwd=PROJECT_PATH)
+        if result.returncode != 0:
+            logger.warning(f"Git clean failed: {result.stderr}")
+            # Continue even if clean fails - checkout is the main operation
+        
+        clear_journal(PROJECT_PATH)
+        return jsonify({"success": True, "message": "Successfully undid all uncommitted changes"})
+    except Exception as e:
+        logger.exception("undo_changes error")
+        return jsonify({"success": False, "error": f"Undo failed: {str(e)}"}), 500
+
+
+@app.route("/api/get-file-content", methods=["GET"])
+def get_file_content():
+    """Get current file content for preview after AI edit"""
+    try:
+        url = request.args.get('url')
         if not url:
             return jsonify({"success": False, "error": "URL parameter required"}), 400
         
         # Determine project path from URL
-        PROJECT_PATH = "projects/jbswebpage"
+        PROJECT_PATH = DEFAULT_PROJECT_PATH
         
         # Parse URL to get file path
         if url.startswith('/'):
@@ -668,74 +2326,25 @@ def replace_image():
         url = data.get("url", "")
         old_image_src = data.get("oldImageSrc", "")
         new_image_src = data.get("newImageSrc", "")
-        element_selector = data.get("elementSelector", "")
 
-        if not (url and old_image_src and new_image_src):
+        # Either one oldImageSrc/newImageSrc pair or "replacements": [{oldImageSrc, newImageSrc}, ...]
+        if not (url and ((old_image_src and new_image_src) or data.get("replacements"))):
             return jsonify({"success": False, "error": "Missing url, oldImageSrc, or newImageSrc"}), 400
 
-        parts = url.strip("/").split("/")
-        logger.info(f"Replace image - URL: {url}, Parts: {parts}")
-
-        # Handle both formats: /user_xxx/project and /project
-        if len(parts) >= 2 and parts[0].startswith("user_"):
-            user_dir = parts[0]
-            project_dir = parts[1]
-            project_path = safe_join_projects(f"{user_dir}/{project_dir}")
-        elif len(parts) >= 1 and parts[0]:
-            project_dir = parts[0]
-            project_path = safe_join_projects(project_dir)
-        else:
-            return jsonify({"success": False, "error": "Cannot determine project path from URL"}), 400
-
-        # Determine HTML file
-        if parts[-1].endswith(".html"):
-            html_file_path = project_path / parts[-1]
-        else:
-            html_file_path = project_path / "index.html"
-
-        if not html_file_path.exists():
-            return jsonify({"success": False, "error": f"HTML file not found: {html_file_path}"}), 404
-
-        # Read HTML content
-        html = html_file_path.read_text(encoding="utf-8")
-
-        # Replace the image src in the HTML
-        # Support multiple formats: src="path", src='path', src=path
-        import re
-
-        # Escape special regex characters in the old path
-        escaped_old_src = re.escape(old_image_src)
-
-        # Pattern to match src attribute with the old image path
-        patterns = [
-            f'src=["\']?{escaped_old_src}["\']?',
-            f'src="{escaped_old_src}"',
-            f"src='{escaped_old_src}'",
-        ]
-
-        replacement_found = False
-        for pattern in patterns:
-            if re.search(pattern, html):
-                html = re.sub(pattern, f'src="{new_image_src}"', html)
-                replacement_found = True
-                break
+        logger.info(f"Replace image - URL: {url}")
+        html_file_path, result = apply_single_edit(url, "replace-image", data)
 
-        if not replacement_found:
-            return jsonify({"success": False, "error": f"Image source '{old_image_src}' not found in HTML"}), 404
-
-        # Write updated HTML
-        html_file_path.write_text(html, encoding="utf-8")
-
-        logger.info(f"Image replaced in {html_file_path}: {old_image_src} -> {new_image_src}")
+        logger.info(f"Image replaced in {html_file_path}: {result['replaced']}")
 
         return jsonify({
             "success": True,
             "message": f"Image replaced in {html_file_path.name}",
             "file_path": str(html_file_path),
-            "old_src": old_image_src,
-            "new_src": new_image_src
+            **result
         })
 
+    except EditError as e:
+        return jsonify({"success": False, "error": e.message}), e.status
     except Exception as e:
         logger.exception("replace_image error")
         return jsonify({"success": False, "error": f"Internal error: {e}"}), 500
@@ -748,78 +2357,25 @@ def delete_image():
         data = request.get_json(force=True, silent=True) or {}
         url = data.get("url", "")
         image_src = data.get("imageSrc", "")
-        element_selector = data.get("elementSelector", "")
 
-        if not (url and image_src):
+        # Either one imageSrc or "imageSrcs": [...]
+        if not (url and (image_src or data.get("imageSrcs"))):
             return jsonify({"success": False, "error": "Missing url or imageSrc"}), 400
 
-        parts = url.strip("/").split("/")
-        logger.info(f"Delete image - URL: {url}, Parts: {parts}")
-
-        # Handle both formats: /user_xxx/project and /project
-        if len(parts) >= 2 and parts[0].startswith("user_"):
-            user_dir = parts[0]
-            project_dir = parts[1]
-            project_path = safe_join_projects(f"{user_dir}/{project_dir}")
-        elif len(parts) >= 1 and parts[0]:
-            project_dir = parts[0]
-            project_path = safe_join_projects(project_dir)
-        else:
-            return jsonify({"success": False, "error": "Cannot determine project path from URL"}), 400
-
-        # Determine HTML file
-        if parts[-1].endswith(".html"):
-            html_file_path = project_path / parts[-1]
-        else:
-            html_file_path = project_path / "index.html"
-
-        if not html_file_path.exists():
-            return jsonify({"success": False, "error": f"HTML file not found: {html_file_path}"}), 404
+        logger.info(f"Delete image - URL: {url}")
+        html_file_path, result = apply_single_edit(url, "delete-image", data)
 
-        # Read HTML content
-        html = html_file_path.read_text(encoding="utf-8")
-
-        # Find and remove the img tag with this src
-        import re
-
-        # Escape special regex characters in the image src
-        escaped_src = re.escape(image_src)
-
-        # Pattern to match the entire img tag with this src
-        # This pattern handles various formats of img tags
-        patterns = [
-            rf'<img[^>]*src=["\']?{escaped_src}["\']?[^>]*>',
-            rf'<img[^>]*src="{escaped_src}"[^>]*>',
-            rf'<img[^>]*src=\'{escaped_src}\'[^>]*>',
-        ]
-
-        deletion_found = False
-        original_html = html
-
-        for pattern in patterns:
-            matches = list(re.finditer(pattern, html, re.IGNORECASE))
-            if matches:
-                # Remove all matching img tags
-                html = re.sub(pattern, '', html, flags=re.IGNORECASE)
-                deletion_found = True
-                logger.info(f"Found and removed {len(matches)} img tag(s) with pattern: {pattern}")
-                break
-
-        if not deletion_found:
-            return jsonify({"success": False, "error": f"Image tag with source '{image_src}' not found in HTML"}), 404
-
-        # Write updated HTML
-        html_file_path.write_text(html, encoding="utf-8")
-
-        logger.info(f"Image deleted from {html_file_path}: {image_src}")
+        logger.info(f"Image deleted from {html_file_path}: {image_src or data.get('imageSrcs')}")
 
         return jsonify({
             "success": True,
             "message": f"Image deleted from {html_file_path.name}",
             "file_path": str(html_file_path),
-            "deleted_src": image_src
+            **result
         })
 
+    except EditError as e:
+        return jsonify({"success": False, "error": e.message}), e.status
     except Exception as e:
         logger.exception("delete_image error")
         return jsonify({"success": False, "error": f"Internal error: {e}"}), 500
@@ -834,108 +2390,13 @@ def save_element_position():
     try:
         data = request.get_json(force=True, silent=True) or {}
         url = data.get("url", "")
-        element_selector = data.get("elementSelector", "")
         position = data.get("position", {})
-        element_tag = data.get("elementTag", "")
-        element_id = data.get("elementId", "")
-        element_classes = data.get("elementClasses", "")
 
         if not (url and position):
             return jsonify({"success": False, "error": "Missing url or position"}), 400
 
-        parts = url.strip("/").split("/")
-        logger.info(f"Save element position - URL: {url}, Parts: {parts}")
-
-        # Handle both formats: /user_xxx/project and /project
-        if len(parts) >= 2 and parts[0].startswith("user_"):
-            user_dir = parts[0]
-            project_dir = parts[1]
-            project_path = safe_join_projects(f"{user_dir}/{project_dir}")
-        elif len(parts) >= 1 and parts[0]:
-            project_dir = parts[0]
-            project_path = safe_join_projects(project_dir)
-        else:
-            return jsonify({"success": False, "error": "Cannot determine project path from URL"}), 400
-
-        # Determine HTML file
-        if parts[-1].endswith(".html"):
-            html_file_path = project_path / parts[-1]
-        else:
-            html_file_path = project_path / "index.html"
-
-        if not html_file_path.exists():
-            return jsonify({"success": False, "error": f"HTML file not found: {html_file_path}"}), 404
-
-        # Read HTML content
-        html = html_file_path.read_text(encoding="utf-8")
-
-        # Build style string from position data
-        style_additions = []
-        if position.get('position'):
-            style_additions.append(f"position: {position['position']}")
-        if position.get('left'):
-            style_additions.append(f"left: {position['left']}")
-        if position.get('top'):
-            style_additions.append(f"top: {position['top']}")
-        if position.get('zIndex'):
-            style_additions.append(f"z-index: {position['zIndex']}")
-
-        style_string = "; ".join(style_additions)
-
-        # Find the element in HTML and update its style attribute
-        import re
-        from bs4 import BeautifulSoup
-
-        soup = BeautifulSoup(html, 'html.parser')
-
-        # Try to find element by ID first
-        target_element = None
-        if element_id:
-            target_element = soup.find(id=element_id)
-
-        # If not found by ID, try by tag and classes
-        if not target_element and element_classes:
-            class_list = element_classes.split()
-            target_element = soup.find(element_tag, class_=class_list)
-
-        # If still not found, try just by tag
-        if not target_element:
-            target_element = soup.find(element_tag)
-
-        if not target_element:
-            return jsonify({"success": False, "error": f"Could not find element with selector: {element_selector}"}), 404
-
-        # Update or add style attribute
-        existing_style = target_element.get('style', '')
-
-        # Remove any existing position-related styles
-        if existing_style:
-            # Parse existing styles
-            style_dict = {}
-            for style_item in existing_style.split(';'):
-                style_item = style_item.strip()
-                if ':' in style_item:
-                    key, value = style_item.split(':', 1)
-                    key = key.strip().lower()
-                    # Skip position-related styles as we'll add them fresh
-                    if key not in ['position', 'left', 'top', 'z-index']:
-                        style_dict[key] = value.strip()
-
-            # Add new position styles
-            for style_item in style_additions:
-                key, value = style_item.split(':', 1)
-                style_dict[key.strip()] = value.strip()
-
-            # Rebuild style string
-            new_style = '; '.join([f"{k}: {v}" for k, v in style_dict.items()])
-        else:
-            new_style = style_string
-
-        target_element['style'] = new_style
-
-        # Write updated HTML
-        updated_html = str(soup)
-        html_file_path.write_text(updated_html, encoding="utf-8")
+        logger.info(f"Save element position - URL: {url}")
+        html_file_path, result = apply_single_edit(url, "save-element-position", data)
 
         logger.info(f"Element position saved in {html_file_path}")
 
@@ -943,9 +2404,11 @@ def save_element_position():
             "success": True,
             "message": f"Position saved to {html_file_path.name}",
             "file_path": str(html_file_path),
-            "style": new_style
+            "style": result["style"]
         })
 
+    except EditError as e:
+        return jsonify({"success": False, "error": e.message}), e.status
     except Exception as e:
         logger.exception("save_element_position error")
         return jsonify({"success": False, "error": f"Internal error: {e}"}), 500
@@ -958,56 +2421,12 @@ def save_image_to_html():
         data = request.get_json(force=True, silent=True) or {}
         url = data.get("url", "")
         image_html = data.get("imageHTML", "")
-        target_selector = data.get("targetSelector", "body")
-        insertion_method = data.get("insertionMethod", "append")
 
         if not (url and image_html):
             return jsonify({"success": False, "error": "Missing url or imageHTML"}), 400
 
-        parts = url.strip("/").split("/")
-        logger.info(f"Save image to HTML - URL: {url}, Parts: {parts}")
-
-        # Handle both formats: /user_xxx/project and /project
-        if len(parts) >= 2 and parts[0].startswith("user_"):
-            user_dir = parts[0]
-            project_dir = parts[1]
-            project_path = safe_join_projects(f"{user_dir}/{project_dir}")
-        elif len(parts) >= 1 and parts[0]:
-            project_dir = parts[0]
-            project_path = safe_join_projects(project_dir)
-        else:
-            return jsonify({"success": False, "error": "Cannot determine project path from URL"}), 400
-
-        # Determine HTML file
-        if parts[-1].endswith(".html"):
-            html_file_path = project_path / parts[-1]
-        else:
-            html_file_path = project_path / "index.html"
-
-        if not html_file_path.exists():
-            return jsonify({"success": False, "error": f"HTML file not found: {html_file_path}"}), 404
-
-        # Read HTML content
-        html = html_file_path.read_text(encoding="utf-8")
-
-        # Insert image HTML based on method
-        if insertion_method == "append":
-            # Append before closing body tag
-            if "</body>" in html:
-                html = html.replace("</body>", f"{image_html}\n</body>")
-            else:
-                # Fallback: append before closing html tag
-                html = html.replace("</html>", f"{image_html}\n</html>")
-        elif insertion_method == "prepend":
-            # Prepend after opening body tag
-            if "<body>" in html:
-                html = html.replace("<body>", f"<body>\n{image_html}")
-            else:
-                # Fallback: prepend after opening html tag
-                html = html.replace("<html>", f"<html>\n{image_html}")
-
-        # Write updated HTML
-        html_file_path.write_text(html, encoding="utf-8")
+        logger.info(f"Save image to HTML - URL: {url}")
+        html_file_path, _ = apply_single_edit(url, "save-image-to-html", data)
 
         logger.info(f"Image HTML saved to {html_file_path}")
 
@@ -1017,6 +2436,8 @@ def save_image_to_html():
             "file_path": str(html_file_path)
         })
 
+    except EditError as e:
+        return jsonify({"success": False, "error": e.message}), e.status
     except Exception as e:
         logger.exception("save_image_to_html error")
         return jsonify({"success": False, "error": f"Internal error: {e}"}), 500
@@ -1095,8 +2516,12 @@ def save_image_to_html():
 # - Return valid JSON only - no explanations or additional text
 # """
 
-def generate_qwen_selective_prompt(elements, user_request, target_file, project_path, batch_mode=False):
-    """Generate prompt for Qwen to return element-specific content updates only"""
+def generate_qwen_selective_prompt(elements, user_request, target_file, project_path, batch_mode=False, context=None):
+    """Generate prompt for Qwen to return element-specific content updates only
+
+    context is (outline, markup windows) from build_prompt_context; without it the model is
+    told to read target_file itself.
+    """
     
     # Format selected elements with detailed context
     element_details = []
@@ -1116,12 +2541,37 @@ Element {i+1}:
         batch_instruction = f"""
 BATCH MODE: Apply the user's request consistently to ALL {len(elements)} selected elements. Generate updated content for each element.
 """
-    
-    return f"""You are an AI assistant that generates element-specific HTML content updates for preview.
 
-WORKING DIRECTORY: {project_path}
+    if context is not None:
+        outline, windows = context
+        markup = []
+        for i, window in enumerate(windows):
+            if window is None:
+                markup.append(f"Element {i+1}: not found in {target_file}; rely on its description above")
+            else:
+                markup.append(f"Element {i+1}:\n{window}")
+        markup_context = "\n\n".join(markup)
+        source_section = f"""TARGET FILE: {target_file}
+
+DOCUMENT OUTLINE:
+{outline or "(no headings or landmarks)"}
+
+SOURCE AROUND EACH SELECTED ELEMENT (the element is between its "selected element" comments):
+{markup_context}
+"""
+        context_instruction = "Use the outline and source excerpts above for context; they are current, so do not open or edit any files"
+        access_requirement = ""
+    else:
+        source_section = f"""WORKING DIRECTORY: {project_path}
 TARGET FILE PATH: {target_file}
+"""
+        context_instruction = f"Read the current {target_file} to understand context around these elements"
+        access_requirement = """
+- If you cannot access the file, return {"status": "error", "message": "File access failed"}"""
+    
+    return f"""You are an AI assistant that generates element-specific HTML content updates for preview.
 
+{source_section}
 SELECTED ELEMENTS FOR EDITING:
 {elements_context}
 
@@ -1129,7 +2579,7 @@ USER REQUEST: {user_request}
 {batch_instruction}
 
 INSTRUCTIONS:
-1. Read the current {target_file} to understand context around these elements
+1. {context_instruction}
 2. Generate ONLY the inner HTML content for each selected element based on the user's request
 3. PRESERVE existing CSS classes, IDs, and styling attributes
 4. DO NOT return full HTML documents - only the content that goes INSIDE each element
@@ -1162,8 +2612,7 @@ CRITICAL REQUIREMENTS:
 - NO explanatory text before or after JSON
 - Return ONLY the inner HTML content for each element, NOT full HTML documents
 - Preserve all CSS classes and styling attributes
-- Generate content for ALL selected elements (indices 0 to {len(elements)-1})
-- If you cannot access the file, return {{"status": "error", "message": "File access failed"}}
+- Generate content for ALL selected elements (indices 0 to {len(elements)-1}){access_requirement}
 
 Begin JSON response now:"""
 
@@ -1171,353 +2620,1258 @@ Begin JSON response now:"""
 
 
 
-@app.route("/api/admin-edit", methods=["POST"])
-def admin_edit():
-    try:
-        data = request.get_json(force=True, silent=True) or {}
-        prompt = data.get("prompt", "").strip()
-        elements = data.get("elements", [])
-        url = data.get("url", "")
-        batch_mode = data.get("batchMode", False)
-        
-        logger.info(f"Received admin-edit request: prompt={prompt[:50]}..., elements={len(elements)}, url={url}, batch_mode={batch_mode}")
-        
-        if not prompt or not elements or not url:
-            return jsonify({"success": False, "error": "Missing prompt, elements, or url"}), 400
-        
-        # Parse project path from URL
-        parts = url.strip("/").split("/")
-        if len(parts) < 1:
-            return jsonify({"success": False, "error": "Cannot determine project path from URL"}), 400
-        
-        if parts[0].startswith("user_") and len(parts) >= 2:
-            # Legacy format: /user_xxx/project_name
-            user_dir = parts[0]
-            project_dir = parts[1]
-            project_path = safe_join_projects(f"{user_dir}/{project_dir}")
+# 🧭 AI prompt context +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+# Instead of letting the model open the page, the prompt carries a short outline of the document
+# and a window of source markup around each selected element, sized to a token budget
+AI_CONTEXT_TOKEN_BUDGET = int(os.getenv("AI_CONTEXT_TOKEN_BUDGET", "6000"))  # 0 = model reads the file itself
+AI_CHARS_PER_TOKEN = 4  # rough size of a token in HTML source
+AI_OUTLINE_SHARE = 0.2  # part of the budget the outline may use
+AI_OUTLINE_MAX_ITEMS = 80
+OUTLINE_ELEMENTS = frozenset({
+    "title", "header", "nav", "main", "section", "article", "aside", "footer", "form",
+    "h1", "h2", "h3", "h4", "h5", "h6",
+})
+OUTLINE_TEXT_ELEMENTS = frozenset({"title", "h1", "h2", "h3", "h4", "h5", "h6"})
+_MARKUP_RE = re.compile(r"<[^>]*>")
+
+
+def element_text(html: str, index: ElementIndex, element: IndexedElement, limit: int = None) -> str:
+    """Text content of element with tags dropped and whitespace collapsed; limit caps the source scanned"""
+    start, end = index.position(element.content_start), index.position(element.content_end)
+    if limit is not None:
+        end = min(end, start + limit)
+    return " ".join(html_lib.unescape(_MARKUP_RE.sub(" ", html[start:end])).split())
+
+
+def _element_label(element: IndexedElement) -> str:
+    label = element.tag
+    if element.id:
+        label += f"#{element.id}"
+    if element.classes:
+        label += "." + ".".join(element.classes)
+    return label
+
+
+def find_prompt_element(html: str, index: ElementIndex, el: dict):
+    """Source element for one toolbar element description, or None"""
+    tag = (el.get("tag") or "").lower()
+    if el.get("lwId"):
+        element = index.resolve_lw_id(el["lwId"], tag)
+        if element is not None:
+            return element
+    if el.get("id") and el["id"] in index.ids:
+        return index.ids[el["id"]]
+
+    text = normalize_text(el.get("originalText") or el.get("text") or "")
+    if not text:
+        return None
+    hints = {"tag": tag, "id": el.get("id") or "", "classes": el.get("classes") or ""}
+    runs = index.text_runs.get(text)
+    if runs:
+        run = max(runs, key=lambda run: _hint_score(run.parent, hints)) if len(runs) > 1 else runs[0]
+        element = run.parent
+        while element is not None and tag and element.tag != tag:
+            element = element.parent
+        if element is not None:
+            return element
+
+    # Text spanning inline markup: compare against the text of same-looking elements
+    signature = ".".join((tag,) + tuple((el.get("classes") or "").split()))
+    prefix = text[:80]
+    for candidate in index.signatures.get(signature, ()):
+        if element_text(html, index, candidate, limit=len(text) * 4 + 1024).casefold().startswith(prefix):
+            return candidate
+    return None
+
+
+def element_window(html: str, index: ElementIndex, element: IndexedElement, number: int, budget: int) -> str:
+    """Source around element, at most about budget characters, with the element marked"""
+    start, end = index.span(element)
+    open_mark = f"<!-- selected element {number} -->"
+    close_mark = f"<!-- /selected element {number} -->"
+    if end - start >= budget:
+        # Too large for its share: keep the start of the element only
+        return f"{open_mark}{html[start:start + budget]}\n<!-- ... rest of element {number} omitted ... -->"
+
+    # Spend what is left on the surroundings, snapped to tag boundaries
+    margin = (budget - (end - start)) // 2
+    before = max(0, start - margin)
+    after = min(len(html), end + margin)
+    if before > 0:
+        before = min(start, html.find("<", before))
+    if after < len(html):
+        after = max(end, html.rfind(">", end, after) + 1)
+    return f"{html[before:start]}{open_mark}{html[start:end]}{close_mark}{html[end:after]}"
+
+
+def document_outline(html: str, index: ElementIndex, budget: int) -> str:
+    """Indented landmarks and headings of the page, at most budget characters"""
+    lines, size = [], 0
+    for element in index.elements:
+        if element.tag not in OUTLINE_ELEMENTS:
+            continue
+        depth, parent = 0, element.parent
+        while parent is not None:
+            depth += parent.tag in OUTLINE_ELEMENTS
+            parent = parent.parent
+        line = "  " * depth + f"<{_element_label(element)}>"
+        if element.tag in OUTLINE_TEXT_ELEMENTS:
+            line += f" {element_text(html, index, element, limit=400)[:80]}"
+        if len(lines) >= AI_OUTLINE_MAX_ITEMS or size + len(line) + 1 > budget:
+            lines.append("  ...")
+            break
+        lines.append(line)
+        size += len(line) + 1
+    return "\n".join(lines)
+
+
+def build_prompt_context(html: str, elements: list, token_budget: int = None):
+    """(outline, [markup window or None per element]) for a prompt, or None when disabled"""
+    token_budget = AI_CONTEXT_TOKEN_BUDGET if token_budget is None else token_budget
+    if token_budget <= 0:
+        return None
+    budget = token_budget * AI_CHARS_PER_TOKEN
+    index = get_element_index(html)
+    outline = document_outline(html, index, int(budget * AI_OUTLINE_SHARE))
+
+    per_element = (budget - len(outline)) // max(1, len(elements))
+    windows = []
+    for number, el in enumerate(elements, 1):
+        element = find_prompt_element(html, index, el)
+        windows.append(element_window(html, index, element, number, per_element) if element is not None else None)
+    return outline, windows
+
+# 🧭 AI prompt context +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+
+
+
+
+# 🧩 AI response parsing +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+# Model output is scanned once for balanced {...} spans (ignoring braces inside JSON strings);
+# each candidate is then validated with json.loads, so no pattern can backtrack over the output
+AI_JSON_MAX_ATTEMPTS = int(os.getenv("AI_JSON_MAX_ATTEMPTS", "64"))
+
+
+_JSON_OBJECT_TOKEN_RE = re.compile(r'[{}"]')
+_JSON_STRING_TOKEN_RE = re.compile(r'["\\\n]')
+
+
+def find_json_objects(text: str):
+    """Spans of balanced {...} in text: outermost objects first, then their direct children, each in source order
+
+    Children cover answers wrapped in an object that never closes; deeper levels are not
+    reported, so the spans never add up to more than twice the text.
+
+    Quotes only open strings inside an object, and a raw newline ends one (JSON strings cannot
+    contain it), so stray quotes in surrounding prose cannot swallow the rest of the output.
+    """
+    outer, children = [], []
+    stack = []
+    pos = 0
+    while True:
+        if not stack:
+            # Outside any object only an opening brace matters
+            pos = text.find("{", pos)
+            if pos < 0:
+                break
+            stack.append(pos)
+            pos += 1
+            continue
+        m = _JSON_OBJECT_TOKEN_RE.search(text, pos)
+        if not m:
+            break
+        pos = m.end()
+        ch = m.group()
+        if ch == "{":
+            stack.append(m.start())
+        elif ch == "}":
+            start = stack.pop()
+            if not stack:
+                outer.append((start, pos))
+            elif len(stack) == 1:
+                children.append((start, pos))
         else:
-            # New format: /project_name
-            project_dir = parts[0]
-            project_path = safe_join_projects(project_dir)
-        
-        # Determine target HTML file
-        if parts[-1].endswith(".html"):
-            target_file = parts[-1]
+            # Skip the string body, honouring backslash escapes
+            while True:
+                m = _JSON_STRING_TOKEN_RE.search(text, pos)
+                if not m:
+                    pos = len(text)
+                    break
+                pos = m.end()
+                if m.group() == "\\":
+                    pos += 1
+                    continue
+                break
+    # Objects left open at the end still contain closed children, which were recorded as such
+    return sorted(outer) + sorted(children)
+
+
+def strip_trailing_commas(candidate: str) -> str:
+    """Drop commas directly before } or ] outside strings (a common model mistake)"""
+    out = []
+    in_string = False
+    i, n = 0, len(candidate)
+    while i < n:
+        ch = candidate[i]
+        if in_string:
+            out.append(ch)
+            if ch == "\\" and i + 1 < n:
+                out.append(candidate[i + 1])
+                i += 2
+                continue
+            if ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+            out.append(ch)
+        elif ch == ",":
+            j = i + 1
+            while j < n and candidate[j] in " \t\r\n":
+                j += 1
+            if j >= n or candidate[j] not in "}]":
+                out.append(ch)
         else:
-            target_file = "index.html"
-        
-        html_file_path = project_path / target_file
-        if not html_file_path.exists():
-            return jsonify({"success": False, "error": f"HTML file not found: {target_file}"}), 404
-        
-        # Read original content before Qwen processing
-        original_content = html_file_path.read_text(encoding="utf-8")
-        
-        # Generate selective element prompt for Qwen Code CLI
-        qwen_prompt = generate_qwen_selective_prompt(elements, prompt, target_file, str(project_path), batch_mode)
-        
-        # Log the prompt for debugging
-        logger.info(f"Sending prompt to Qwen: {qwen_prompt[:200]}...")
-        
-        # Check if Qwen CLI is available
-        import shutil
-        if not shutil.which("qwen"):
+            out.append(ch)
+        i += 1
+    return "".join(out)
+
+
+def extract_ai_response(text: str):
+    """First JSON object in model output with "status": "success", or None"""
+    attempts = 0
+    for start, end in find_json_objects(text):
+        candidate = text[start:end]
+        if '"status"' not in candidate:
+            continue
+        for attempt in (candidate, None):
+            if attempts >= AI_JSON_MAX_ATTEMPTS:
+                logger.warning(f"Gave up after {attempts} JSON candidates")
+                return None
+            attempts += 1
+            try:
+                if attempt is None:
+                    attempt = strip_trailing_commas(candidate)
+                    if attempt == candidate:
+                        break
+                response_data = json.loads(attempt)
+            except RecursionError:
+                # Nested deeper than the json module can decode; no cleanup will change that
+                logger.debug(f"JSON candidate at {start} rejected: nested too deeply")
+                break
+            except ValueError as e:
+                logger.debug(f"JSON candidate at {start} rejected: {e}")
+                continue
+            if isinstance(response_data, dict) and response_data.get("status") == "success":
+                logger.info(f"Parsed JSON object at offset {start} of model output")
+                return response_data
+            break
+    return None
+
+
+def extract_html_document(text: str):
+    """First <!DOCTYPE html> ... </html> document in text, or None"""
+    lowered = text.lower()
+    start = lowered.find("<!doctype html>")
+    if start < 0:
+        return None
+    end = lowered.find("</html>", start)
+    return text[start:end + len("</html>")] if end >= 0 else None
+
+
+def synthesize_element_updates(text: str, elements: list) -> list:
+    """Last resort: treat substantial prose lines of the output as new content for the elements"""
+    content_lines = [line.strip() for line in text.split('\n') if line.strip()]
+    meaningful_content = []
+    for line in content_lines:
+        # Skip lines that look like code or metadata
+        if not any(skip in line.lower() for skip in ['```', 'json', 'status', 'error', 'failed']):
+            if len(line) > 10:  # Only consider substantial lines
+                meaningful_content.append(line)
+    if not meaningful_content:
+        return []
+
+    # Use the first meaningful content for all elements, or cycle through if there are multiple
+    return [{
+        "element_index": i,
+        "new_content": meaningful_content[i % len(meaningful_content)],
+        "summary": f"AI suggested content for element {i+1}"
+    } for i in range(len(elements))]
+
+
+def ai_preview_response(qwen_output: str, elements: list, target_file: str, project_path):
+    """(response, HTTP status) for model output that was not a clean JSON document"""
+    result_data = extract_ai_response(qwen_output)
+    if result_data:
+        return {
+            "success": True,
+            "message": result_data.get("message", "AI preview generated successfully"),
+            "element_updates": result_data.get("element_updates", []),
+            "changes_summary": result_data.get("changes_summary", ""),
+            "qwen_response": result_data,
+            "is_selective_preview": True,
+            "target_file": target_file,
+            "project_path": str(project_path)
+        }, 200
+
+    # Try to find complete HTML document in response
+    modified_content = extract_html_document(qwen_output)
+    if modified_content:
+        logger.info(f"Extracted HTML content (first 200 chars): {modified_content[:200]}...")
+        return {
+            "success": True,
+            "message": "AI preview generated (content extracted from response)",
+            "preview_content": modified_content,
+            "changes_summary": "AI generated changes. Content extracted from non-JSON response.",
+            "is_preview": True,
+            "target_file": target_file,
+            "project_path": str(project_path)
+        }, 200
+
+    logger.info("JSON extraction failed, creating synthetic response")
+    synthetic_updates = synthesize_element_updates(qwen_output, elements)
+    if synthetic_updates:
+        return {
+            "success": True,
+            "message": "AI content extracted from text response",
+            "element_updates": synthetic_updates,
+            "changes_summary": f"Generated {len(synthetic_updates)} content suggestions from AI text output",
+            "qwen_response": {"status": "synthetic", "raw_output": qwen_output[:500]},
+            "is_selective_preview": True,
+            "target_file": target_file,
+            "project_path": str(project_path)
+        }, 200
+
+    # Final fallback: Return error with detailed debug info
+    return {
+        "success": False,
+        "error": "AI returned malformed response. Unable to extract meaningful content.",
+        "qwen_output": qwen_output[:1500],  # Show more output for debugging
+        "debug_info": {
+            "response_length": len(qwen_output),
+            "first_100_chars": qwen_output[:100],
+            "contains_json_markers": any(marker in qwen_output.lower() for marker in ['{', 'status', 'success']),
+            "line_count": len(qwen_output.split('\n')),
+            "strategies_attempted": ["json_scan", "html_document", "synthetic_response"]
+        }
+    }, 500
+
+# 🧩 AI response parsing +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+
+
+
+# 🗃️ AI preview cache +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+# A preview is a function of the prompt sent to the model and the page it read, so successful
+# responses are cached under a hash of both and replayed without running the model again
+AI_PREVIEW_CACHE_MAX_BYTES = int(os.getenv("AI_PREVIEW_CACHE_MAX_BYTES", str(8 * 1024 * 1024)))
+AI_PREVIEW_CACHE_TTL = int(os.getenv("AI_PREVIEW_CACHE_TTL", "3600"))
+# Persisted entries are shared by all worker processes and survive restarts; "0" disables
+AI_PREVIEW_CACHE_DISK = os.getenv("AI_PREVIEW_CACHE_DISK", "1") != "0"
+AI_PREVIEW_CACHE_DIR = STATE_DIR / "ai-previews"
+AI_PREVIEW_CACHE_DISK_MAX_BYTES = int(os.getenv("AI_PREVIEW_CACHE_DISK_MAX_BYTES", str(64 * 1024 * 1024)))
+AI_PREVIEW_CACHE_PRUNE_SECONDS = int(os.getenv("AI_PREVIEW_CACHE_PRUNE_SECONDS", "300"))
+
+# Bytes this process believes AI_PREVIEW_CACHE_DIR holds, resynced by every prune. Writes only add
+# to it; the directory is scanned when it passes the cap or the last scan is too old.
+_preview_disk = {"bytes": 0, "pruned_at": 0.0}
+_preview_disk_lock = threading.Lock()
+
+# Cache key -> (expiry time, response)
+ai_preview_cache = LRUCache(AI_PREVIEW_CACHE_MAX_BYTES)
+
+
+def ai_preview_cache_key(qwen_prompt: str, file_content: str) -> str:
+    content_hash = hashlib.sha256(file_content.encode("utf-8")).hexdigest()
+    return hashlib.sha256(f"{content_hash}\0{qwen_prompt}".encode("utf-8")).hexdigest()
+
+
+def get_cached_preview(key: str):
+    """Cached admin-edit response for key, or None if absent or expired"""
+    now = time.time()
+    entry = ai_preview_cache.get(key)
+    if entry is not None:
+        if entry[0] > now:
+            return entry[1]
+        ai_preview_cache.pop(key)
+    if not AI_PREVIEW_CACHE_DISK:
+        return None
+
+    cache_path = AI_PREVIEW_CACHE_DIR / f"{key}.json"
+    try:
+        data = cache_path.read_bytes()
+        expires = cache_path.stat().st_mtime + AI_PREVIEW_CACHE_TTL
+        if expires <= now:
+            cache_path.unlink(missing_ok=True)
+            return None
+        response = json.loads(data)
+    except (OSError, ValueError):
+        return None
+    ai_preview_cache.put(key, (expires, response), len(data))
+    return response
+
+
+def is_cacheable_preview(response: dict) -> bool:
+    """Only answers the model gave as JSON; HTML and prose fallbacks are guesses worth retrying"""
+    qwen_response = response.get("qwen_response")
+    return (
+        response.get("success") is True
+        and isinstance(qwen_response, dict)
+        and qwen_response.get("status") == "success"
+    )
+
+
+def cache_preview(key: str, response: dict):
+    data = json.dumps(response).encode("utf-8")
+    ai_preview_cache.put(key, (time.time() + AI_PREVIEW_CACHE_TTL, response), len(data))
+    if not AI_PREVIEW_CACHE_DISK:
+        return
+    try:
+        AI_PREVIEW_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        _write_atomic(AI_PREVIEW_CACHE_DIR / f"{key}.json", data)
+    except OSError as e:
+        logger.warning(f"Could not persist AI preview: {e}")
+        return
+
+    now = time.time()
+    with _preview_disk_lock:
+        _preview_disk["bytes"] += len(data)
+        due = (_preview_disk["bytes"] > AI_PREVIEW_CACHE_DISK_MAX_BYTES
+               or now - _preview_disk["pruned_at"] >= AI_PREVIEW_CACHE_PRUNE_SECONDS)
+        if due:
+            _preview_disk["pruned_at"] = now
+    if due:
+        _prune_cached_previews()
+
+
+def _prune_cached_previews():
+    """Drop expired previews, then the oldest ones until the directory fits AI_PREVIEW_CACHE_DISK_MAX_BYTES"""
+    cutoff = time.time() - AI_PREVIEW_CACHE_TTL
+    entries = []
+    for cache_path in AI_PREVIEW_CACHE_DIR.glob("*.json"):
+        try:
+            st = cache_path.stat()
+            if st.st_mtime < cutoff:
+                cache_path.unlink(missing_ok=True)
+            else:
+                entries.append((st.st_mtime, st.st_size, cache_path))
+        except OSError:
+            pass
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, cache_path in sorted(entries):
+        if total <= AI_PREVIEW_CACHE_DISK_MAX_BYTES:
+            break
+        cache_path.unlink(missing_ok=True)
+        total -= size
+    with _preview_disk_lock:
+        _preview_disk["bytes"] = total
+
+# 🗃️ AI preview cache +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+
+
+
+# 🚦 AI worker pool +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+# Host-wide limits shared by all worker processes: at most AI_WORKERS model processes run at
+# once and at most AI_QUEUE_MAX jobs wait for one; beyond that requests get 429 + Retry-After
+AI_WORKERS = max(1, int(os.getenv("AI_WORKERS", "2")))
+AI_QUEUE_MAX = max(0, int(os.getenv("AI_QUEUE_MAX", "16")))
+AI_QUEUE_STATE_PATH = JOBS_DIR / "ai-queue.json"
+AI_QUEUE_LOCK_PATH = JOBS_DIR / "ai-queue.lock"
+AI_QUEUE_POLL_SECONDS = 0.25
+AI_DEFAULT_JOB_SECONDS = 30.0  # duration estimate until real jobs have been timed
+
+
+class AIQueueFull(Exception):
+    """The AI queue is at capacity; retry_after is a wait estimate in seconds"""
+
+    def __init__(self, retry_after: int):
+        super().__init__("AI queue is full")
+        self.retry_after = retry_after
+
+
+@contextmanager
+def ai_queue():
+    """Queue state under the host-wide lock; entries left by dead processes are dropped"""
+    with file_lock(AI_QUEUE_LOCK_PATH):
+        try:
+            raw = AI_QUEUE_STATE_PATH.read_text(encoding="utf-8")
+            queue = json.loads(raw)
+        except (OSError, ValueError):
+            raw, queue = None, {"waiting": [], "running": [], "avg_seconds": AI_DEFAULT_JOB_SECONDS}
+        for name in ("waiting", "running"):
+            queue[name] = [entry for entry in queue[name] if _job_owner_alive(entry)]
+        yield queue
+        updated = json.dumps(queue)
+        if updated != raw:
+            _write_atomic(AI_QUEUE_STATE_PATH, updated.encode("utf-8"))
+
+
+def _ai_queue_order(queue: dict) -> list:
+    """Waiting entries in start order: projects with the fewest running jobs first, then FIFO"""
+    running = {}
+    for entry in queue["running"]:
+        running[entry["project"]] = running.get(entry["project"], 0) + 1
+    return sorted(queue["waiting"], key=lambda entry: (running.get(entry["project"], 0), entry["enqueued_at"]))
+
+
+def _ai_retry_after(queue: dict) -> int:
+    return max(1, int(queue["avg_seconds"] * (len(queue["waiting"]) / AI_WORKERS + 1)))
+
+
+def enqueue_ai_job(kind: str, project_path, stages=()) -> dict:
+    """Create a job with a place in the AI queue; raises AIQueueFull at capacity"""
+    with ai_queue() as queue:
+        idle_workers = max(0, AI_WORKERS - len(queue["running"]))
+        if len(queue["waiting"]) >= AI_QUEUE_MAX + idle_workers:
+            raise AIQueueFull(_ai_retry_after(queue))
+        job = create_job(kind, project_path, stages)
+        queue["waiting"].append({
+            "job": job["id"],
+            "project": project_key(project_path),
+            "pid": os.getpid(),
+            "enqueued_at": time.time(),
+        })
+    return job
+
+
+def wait_for_ai_slot(job: dict, cancelled=lambda: False) -> bool:
+    """Block until job may start its model process; False if it was cancelled while queued"""
+    position = None
+    while True:
+        with ai_queue() as queue:
+            order = _ai_queue_order(queue)
+            entry = next((e for e in order if e["job"] == job["id"]), None)
+            if entry is None:
+                return False
+            if cancelled():
+                queue["waiting"].remove(entry)
+                return False
+            if order[0] is entry and len(queue["running"]) < AI_WORKERS:
+                queue["waiting"].remove(entry)
+                queue["running"].append(dict(entry, started_at=time.time()))
+                new_position = 0
+            else:
+                new_position = order.index(entry) + 1
+        if new_position != position:
+            position = new_position
+            job["queue_position"] = position
+            save_job(job)
+        if position == 0:
+            return True
+        time.sleep(AI_QUEUE_POLL_SECONDS)
+
+
+def release_ai_slot(job_id: str):
+    """Give up job's running slot or queue place, timing it for Retry-After estimates"""
+    with ai_queue() as queue:
+        for entry in queue["running"]:
+            if entry["job"] == job_id:
+                elapsed = time.time() - entry["started_at"]
+                queue["avg_seconds"] = round(0.8 * queue["avg_seconds"] + 0.2 * elapsed, 3)
+        queue["running"] = [entry for entry in queue["running"] if entry["job"] != job_id]
+        queue["waiting"] = [entry for entry in queue["waiting"] if entry["job"] != job_id]
+
+
+def ai_queue_depth() -> dict:
+    with ai_queue() as queue:
+        projects = {}
+        for name in ("running", "waiting"):
+            for entry in queue[name]:
+                projects.setdefault(entry["project"], {"running": 0, "waiting": 0})[name] += 1
+        return {
+            "workers": AI_WORKERS,
+            "running": len(queue["running"]),
+            "waiting": len(queue["waiting"]),
+            "max_waiting": AI_QUEUE_MAX,
+            "avg_job_seconds": queue["avg_seconds"],
+            "retry_after": _ai_retry_after(queue),
+            "projects": projects,
+        }
+
+
+@app.route("/api/ai-queue", methods=["GET"])
+def ai_queue_status():
+    """Report AI queue depth, host-wide and per project"""
+    return jsonify({"success": True, "queue": ai_queue_depth()})
+
+# 🚦 AI worker pool +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+
+
+
+# 🔌 AI backends +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+# A backend turns a prompt into model output, streaming it into the job's output file.
+# "qwen-cli" spawns the Qwen CLI per prompt; "worker" keeps one long-lived process per
+# project that takes prompts as JSON lines (protocol in ai_stub_worker.py)
+AI_BACKEND = os.getenv("AI_BACKEND", "qwen-cli")
+QWEN_CLI_COMMAND = ["qwen", "-m", "qwen-turbo", "-p", "-y"]
+AI_WORKER_COMMAND = shlex.split(os.getenv("AI_WORKER_COMMAND", "")) or [sys.executable, str(BASE_DIR / "ai_stub_worker.py")]
+AI_POLL_SECONDS = 0.25
+# A worker that has not finished a cancelled prompt by then is killed and restarted
+AI_WORKER_CANCEL_GRACE_SECONDS = 5
+
+_qwen_envs = {}
+
+
+def qwen_env(project_path: Path) -> dict:
+    """Environment for model processes in project_path, built once per project"""
+    env = _qwen_envs.get(str(project_path))
+    if env is None:
+        # Get current environment and ensure PATH is available
+        env = os.environ.copy()
+        env['PWD'] = str(project_path)
+        _qwen_envs[str(project_path)] = env
+    return env
+
+
+def _pump_output(stream, sink: list, output_file=None):
+    for chunk in iter(lambda: os.read(stream.fileno(), 4096), b""):
+        sink.append(chunk)
+        if output_file is not None:
+            output_file.write(chunk)
+            output_file.flush()
+
+
+class QwenCLIBackend:
+    """Spawns a CLI per prompt, passing the prompt on stdin and streaming its stdout"""
+
+    def __init__(self, command):
+        self.command = command
+
+    def check(self):
+        """Error message if the backend cannot run, else None"""
+        if not shutil.which(self.command[0]):
             logger.error("Qwen CLI not found in PATH")
-            return jsonify({"success": False, "error": "Qwen CLI not found. Please install Qwen CLI and ensure it's in your PATH."}), 500
-        
-        # Execute AI editing with subprocess timeout
-        import subprocess
-        import json as json_lib
-        
+            return "Qwen CLI not found. Please install Qwen CLI and ensure it's in your PATH."
+        return None
+
+    def run(self, prompt: str, project_path: Path, output_file, should_stop):
+        """Returns (returncode, stdout, stderr, outcome); outcome is "exited" or what should_stop() reported"""
         logger.info(f"Executing Qwen CLI with cwd: {project_path}")
-        logger.info(f"Target file exists: {html_file_path.exists()}")
-        logger.info(f"Target file readable: {os.access(html_file_path, os.R_OK)}")
-        logger.info(f"Prompt length: {len(qwen_prompt)} characters")
-        
+        logger.info(f"Prompt length: {len(prompt)} characters")
+
+        stdout_chunks, stderr_chunks = [], []
+        process = subprocess.Popen(
+            self.command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            cwd=str(project_path),
+            env=qwen_env(project_path),
+            start_new_session=True,  # own process group, so a kill also reaches tools the CLI spawned
+        )
+        readers = [
+            threading.Thread(target=_pump_output, args=(process.stdout, stdout_chunks, output_file), daemon=True),
+            threading.Thread(target=_pump_output, args=(process.stderr, stderr_chunks), daemon=True),
+        ]
+        for reader in readers:
+            reader.start()
         try:
-            # Get current environment and ensure PATH is available
-            env = os.environ.copy()
-            env['PWD'] = str(project_path)
-            
-            result = subprocess.run([
-                "qwen", "-m", "qwen-turbo", "-p", "-y"
-            ], 
-            input=qwen_prompt, 
-            cwd=str(project_path), 
-            env=env,
-            capture_output=True, 
-            text=True, 
-            timeout=180)
-        except subprocess.TimeoutExpired:
-            logger.error("Qwen CLI timeout")
-            return jsonify({"success": False, "error": "AI processing timeout"}), 500
-        except Exception as e:
-            logger.exception("Qwen CLI execution error")
-            return jsonify({"success": False, "error": f"AI processing failed: {str(e)}"}), 500
-        
-        logger.info(f"Qwen CLI result: returncode={result.returncode}, stdout={result.stdout[:200]}..., stderr={result.stderr[:200]}...")
-        
-        if result.returncode == 0:
+            process.stdin.write(prompt.encode("utf-8"))
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+
+        # Poll rather than block so a cancel request from any worker process is noticed
+        outcome = "exited"
+        while True:
             try:
-                # Try to parse JSON response
-                response_data = json_lib.loads(result.stdout)
-                if response_data.get("status") == "success":
-                    # Return element-specific updates - no file saving yet
-                    response = {
-                        "success": True, 
-                        "message": response_data.get("message", "AI preview generated successfully"),
-                        "element_updates": response_data.get("element_updates", []),
-                        "changes_summary": response_data.get("changes_summary", ""),
-                        "qwen_response": response_data,
-                        "is_selective_preview": True,
-                        "target_file": target_file,
-                        "project_path": str(project_path)
-                    }
-                    
-                    return jsonify(response)
-                else:
-                    return jsonify({
-                        "success": False, 
-                        "error": response_data.get("message", "AI processing failed"),
-                        "qwen_response": response_data
-                    }), 500
-            except json_lib.JSONDecodeError:
-                # Fallback for non-JSON response - try to extract content manually
-                logger.warning("Qwen returned non-JSON response, attempting to parse manually")
-                
-                # Try to find HTML content in the response
-                qwen_output = result.stdout
-                
-                # Check if file was modified first
-                try:
-                    current_content = html_file_path.read_text(encoding="utf-8")
-                    
-                    if current_content != original_content:
-                        # Qwen modified the file despite preview instructions
-                        # Use the modified content as preview and restore original
-                        modified_content = current_content
-                        
-                        # Restore original content since this should be preview-only
-                        html_file_path.write_text(original_content, encoding="utf-8")
-                        logger.info("Restored original file content after unauthorized modification")
-                        
-                        response = {
-                            "success": True,
-                            "message": "AI preview generated (file modification detected)",
-                            "preview_content": modified_content,
-                            "changes_summary": "AI generated changes. File was modified but restored for preview.",
-                            "is_preview": True,
-                            "target_file": target_file,
-                            "project_path": str(project_path)
-                        }
-                        
-                        return jsonify(response)
-                        
-                except Exception as e:
-                    logger.error(f"Failed to check file modifications: {e}")
-                
-                # Try to extract JSON from response manually with multiple strategies
+                process.wait(timeout=AI_POLL_SECONDS)
+                break
+            except subprocess.TimeoutExpired:
+                pass
+            outcome = should_stop() or "exited"
+            if outcome == "exited":
+                continue
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            process.wait()
+            break
+        for reader in readers:
+            reader.join(timeout=5)
+
+        stdout = b"".join(stdout_chunks).decode("utf-8", errors="replace")
+        stderr = b"".join(stderr_chunks).decode("utf-8", errors="replace")
+        return process.returncode, stdout, stderr, outcome
+
+
+class AIWorkerProcess:
+    """One long-lived worker process; concurrent prompts are told apart by request id"""
+
+    def __init__(self, command, cwd):
+        self.command = command
+        self.cwd = str(cwd)
+        self._start_lock = threading.Lock()  # guards starting and replacing the process
+        self._write_lock = threading.Lock()  # keeps lines written to its stdin whole
+        self._process = None
+        self._pending = {}  # request id -> (process, Queue of messages)
+
+    def _ensure_started(self):
+        with self._start_lock:
+            if self._process is None or self._process.poll() is not None:
+                self._process = subprocess.Popen(
+                    self.command,
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE,
+                    cwd=self.cwd,
+                    env=qwen_env(self.cwd),
+                )
+                threading.Thread(target=self._read, args=(self._process,), name="ai-worker-reader", daemon=True).start()
+            return self._process
+
+    def _read(self, process):
+        for line in process.stdout:
+            try:
+                message = json.loads(line)
+                pending = self._pending.get(message.get("id"))
+            except (ValueError, AttributeError):
+                logger.warning(f"AI worker sent an invalid line: {line[:200]!r}")
+                continue
+            if pending is not None:
+                pending[1].put(message)
+        # Fail what was in flight on this process; the next prompt starts a new one
+        for request_process, messages in list(self._pending.values()):
+            if request_process is process:
+                messages.put({"done": True, "returncode": -1, "stderr": "AI worker exited"})
+
+    def _send(self, process, message: dict):
+        """Write one line from a helper thread, so a worker that stops reading cannot block the caller"""
+        def write():
+            try:
+                with self._write_lock:
+                    if process.poll() is None:
+                        process.stdin.write((json.dumps(message) + "\n").encode("utf-8"))
+                        process.stdin.flush()
+            except OSError:
+                pass  # the process is gone; its reader fails the pending requests
+        threading.Thread(target=write, name="ai-worker-writer", daemon=True).start()
+
+    def _kill(self, process):
+        """Stop a worker that stopped responding; the next prompt starts a fresh one"""
+        with self._start_lock:
+            if self._process is process:
+                self._process = None
+        try:
+            process.kill()
+        except OSError:
+            pass
+
+    def run(self, prompt: str, output_file, should_stop):
+        request_id = uuid.uuid4().hex
+        messages = Queue()
+        chunks = []
+        cancelled_at = None
+        try:
+            process = self._ensure_started()
+            self._pending[request_id] = (process, messages)
+            self._send(process, {"id": request_id, "prompt": prompt, "cwd": self.cwd})
+            while True:
                 try:
-                    import re
-                    
-                    def extract_and_parse_json(text, pattern_desc):
-                        """Helper to extract and parse JSON with detailed logging"""
-                        try:
-                            response_data = json_lib.loads(text)
-                            if response_data.get("status") == "success":
-                                logger.info(f"Successfully parsed JSON using {pattern_desc}")
-                                return response_data
-                        except json_lib.JSONDecodeError as e:
-                            logger.warning(f"Failed to parse extracted JSON from {pattern_desc}: {e}")
-                        return None
-                    
-                    # Strategy 1: Clean the response by removing common prefixes/suffixes
-                    cleaned_output = qwen_output.strip()
-                    
-                    # Remove common markdown code block markers
-                    if cleaned_output.startswith('```'):
-                        lines = cleaned_output.split('\n')
-                        if len(lines) > 2:
-                            cleaned_output = '\n'.join(lines[1:-1])
-                    
-                    # Remove "json" language identifier if present
-                    if cleaned_output.startswith('json\n'):
-                        cleaned_output = cleaned_output[5:]
-                    
-                    # Try parsing the cleaned output directly
-                    result_data = extract_and_parse_json(cleaned_output, "cleaned direct parse")
-                    if result_data:
-                        response = {
-                            "success": True, 
-                            "message": result_data.get("message", "AI preview generated successfully"),
-                            "element_updates": result_data.get("element_updates", []),
-                            "changes_summary": result_data.get("changes_summary", ""),
-                            "qwen_response": result_data,
-                            "is_selective_preview": True,
-                            "target_file": target_file,
-                            "project_path": str(project_path)
-                        }
-                        return jsonify(response)
-                    
-                    # Strategy 2: Find JSON using multiple patterns
-                    json_patterns = [
-                        # Basic JSON with status success
-                        r'\{[^{}]*"status"[^{}]*"success"[^{}]*\}',
-                        # More permissive pattern for nested JSON
-                        r'\{[\s\S]*?"status"\s*:\s*"success"[\s\S]*?\}',
-                        # Pattern that captures complete JSON objects
-                        r'\{(?:[^{}]|{[^{}]*})*\}',
-                        # Pattern for JSON that may span multiple lines
-                        r'(?s)\{.*?"status".*?"success".*?\}',
-                        # Pattern for finding the largest JSON-like structure
-                        r'(?s)\{.*\}'
-                    ]
-                    
-                    for i, pattern in enumerate(json_patterns):
-                        matches = re.findall(pattern, qwen_output, re.DOTALL | re.IGNORECASE)
-                        for match in matches:
-                            result_data = extract_and_parse_json(match, f"pattern {i+1}")
-                            if result_data:
-                                response = {
-                                    "success": True, 
-                                    "message": result_data.get("message", "AI preview generated successfully"),
-                                    "element_updates": result_data.get("element_updates", []),
-                                    "changes_summary": result_data.get("changes_summary", ""),
-                                    "qwen_response": result_data,
-                                    "is_selective_preview": True,
-                                    "target_file": target_file,
-                                    "project_path": str(project_path)
-                                }
-                                return jsonify(response)
-                    
-                    # Strategy 3: Try to fix common JSON formatting issues
-                    fixed_attempts = [
-                        # Remove trailing commas
-                        re.sub(r',\s*}', '}', qwen_output),
-                        re.sub(r',\s*]', ']', qwen_output),
-                        # Fix unescaped quotes in strings
-                        re.sub(r'(?<!\\)"(?![,\]\}:\s])', '\\"', qwen_output),
-                    ]
-                    
-                    for attempt_text in fixed_attempts:
-                        for pattern in json_patterns[:3]:  # Use first 3 patterns only
-                            matches = re.findall(pattern, attempt_text, re.DOTALL | re.IGNORECASE)
-                            for match in matches:
-                                result_data = extract_and_parse_json(match, "fixed JSON")
-                                if result_data:
-                                    response = {
-                                        "success": True, 
-                                        "message": result_data.get("message", "AI preview generated successfully"),
-                                        "element_updates": result_data.get("element_updates", []),
-                                        "changes_summary": result_data.get("changes_summary", ""),
-                                        "qwen_response": result_data,
-                                        "is_selective_preview": True,
-                                        "target_file": target_file,
-                                        "project_path": str(project_path)
-                                    }
-                                    return jsonify(response)
-                    
-                    # Try to find complete HTML document in response
-                    html_pattern = r'<!DOCTYPE html>.*?</html>'
-                    html_match = re.search(html_pattern, qwen_output, re.DOTALL | re.IGNORECASE)
-                    
-                    if html_match:
-                        modified_content = html_match.group(0)
-                        
-                        logger.info(f"Extracted HTML content (first 200 chars): {modified_content[:200]}...")
-                        logger.info(f"Original vs Modified content differ: {modified_content != original_content}")
-                        
-                        response = {
-                            "success": True,
-                            "message": "AI preview generated (content extracted from response)",
-                            "preview_content": modified_content,
-                            "changes_summary": "AI generated changes. Content extracted from non-JSON response.",
-                            "is_preview": True,
-                            "target_file": target_file,
-                            "project_path": str(project_path)
-                        }
-                        
-                        return jsonify(response)
-                    
-                    # Strategy 4: Create a synthetic response from the raw text
-                    logger.info("All JSON extraction strategies failed, creating synthetic response")
-                    
-                    # Look for any meaningful content in the response
-                    content_lines = [line.strip() for line in qwen_output.split('\n') if line.strip()]
-                    
-                    if content_lines:
-                        # Try to find lines that look like content updates
-                        meaningful_content = []
-                        for line in content_lines:
-                            # Skip lines that look like code or metadata
-                            if not any(skip in line.lower() for skip in ['```', 'json', 'status', 'error', 'failed']):
-                                if len(line) > 10:  # Only consider substantial lines
-                                    meaningful_content.append(line)
-                        
-                        if meaningful_content:
-                            # Create synthetic element updates based on the number of selected elements
-                            synthetic_updates = []
-                            for i in range(len(elements)):
-                                # Use the first meaningful content for all elements, or cycle through if there are multiple
-                                content_to_use = meaningful_content[i % len(meaningful_content)]
-                                synthetic_updates.append({
-                                    "element_index": i,
-                                    "new_content": content_to_use,
-                                    "summary": f"AI suggested content for element {i+1}"
-                                })
-                            
-                            response = {
-                                "success": True,
-                                "message": "AI content extracted from text response",
-                                "element_updates": synthetic_updates,
-                                "changes_summary": f"Generated {len(synthetic_updates)} content suggestions from AI text output",
-                                "qwen_response": {"status": "synthetic", "raw_output": qwen_output[:500]},
-                                "is_selective_preview": True,
-                                "target_file": target_file,
-                                "project_path": str(project_path)
-                            }
-                            return jsonify(response)
-                    
-                    # Final fallback: Return error with detailed debug info
-                    response = {
-                        "success": False,
-                        "error": "AI returned malformed response. Unable to extract meaningful content.", 
-                        "qwen_output": qwen_output[:1500],  # Show more output for debugging
-                        "debug_info": {
-                            "response_length": len(qwen_output),
-                            "first_100_chars": qwen_output[:100],
-                            "contains_json_markers": any(marker in qwen_output.lower() for marker in ['{', 'status', 'success']),
-                            "line_count": len(qwen_output.split('\n')),
-                            "strategies_attempted": ["direct_parse", "pattern_matching", "json_fixing", "synthetic_response"]
-                        }
-                    }
-                    
-                    return jsonify(response), 500
-                    
-                except Exception as e:
-                    logger.error(f"Failed to extract content from response: {e}")
-                    response = {
-                        "success": False,
-                        "error": f"AI processing error: {str(e)}", 
-                        "qwen_output": qwen_output[:500]
-                    }
-                    
-                    return jsonify(response), 500
-        else:
-            logger.error(f"Qwen CLI error: {result.stderr}")
-            # Provide more detailed error information
-            error_msg = result.stderr[:500] if result.stderr else "Unknown error occurred"
-            return jsonify({
-                "success": False, 
-                "error": f"AI processing failed: {error_msg}",
-                "qwen_error": result.stderr[:1000]  # Include more detailed error info
-            }), 500
-            
+                    message = messages.get(timeout=AI_POLL_SECONDS)
+                except Empty:
+                    if cancelled_at is not None:
+                        if time.monotonic() - cancelled_at > AI_WORKER_CANCEL_GRACE_SECONDS:
+                            logger.warning("AI worker did not acknowledge a cancel; restarting it")
+                            self._kill(process)
+                            return -1, "".join(chunks), "", "cancelled"
+                        continue
+                    outcome = should_stop()
+                    if outcome == "timeout":
+                        # A worker this slow may be wedged; don't let it hold up later prompts
+                        logger.warning("AI worker timed out; restarting it")
+                        self._kill(process)
+                        return -1, "".join(chunks), "", outcome
+                    if outcome:
+                        self._send(process, {"id": request_id, "cancel": True})
+                        cancelled_at = time.monotonic()
+                    continue
+                if message.get("output"):
+                    chunks.append(message["output"])
+                    output_file.write(message["output"].encode("utf-8"))
+                    output_file.flush()
+                if message.get("done"):
+                    if cancelled_at is not None:
+                        return -1, "".join(chunks), "", "cancelled"
+                    return message.get("returncode", 0), "".join(chunks), message.get("stderr", ""), "exited"
+        except OSError as e:
+            self.close()
+            return -1, "".join(chunks), f"AI worker unavailable: {e}", "exited"
+        finally:
+            self._pending.pop(request_id, None)
+
+    def close(self):
+        with self._start_lock:
+            process, self._process = self._process, None
+        if process is not None and process.poll() is None:
+            try:
+                process.stdin.close()
+                process.wait(timeout=5)
+            except (OSError, subprocess.TimeoutExpired):
+                process.kill()
+
+
+_ai_workers = {}
+_ai_workers_lock = threading.Lock()
+
+
+def get_ai_worker(command, project_path) -> AIWorkerProcess:
+    # Keyed by pid as well so forked workers never share a parent's pipes
+    key = (os.getpid(), tuple(command), str(project_path))
+    with _ai_workers_lock:
+        worker = _ai_workers.get(key)
+        if worker is None:
+            worker = _ai_workers[key] = AIWorkerProcess(command, project_path)
+        return worker
+
+
+@atexit.register
+def _close_ai_workers():
+    for (pid, _, _), worker in list(_ai_workers.items()):
+        if pid == os.getpid():
+            try:
+                worker.close()
+            except Exception:
+                pass
+
+
+class JsonLinesWorkerBackend:
+    """Sends prompts to a persistent worker process over stdin/stdout JSON lines"""
+
+    def __init__(self, command):
+        self.command = command
+
+    def check(self):
+        if not shutil.which(self.command[0]):
+            return f"AI worker command not found: {self.command[0]}"
+        return None
+
+    def run(self, prompt: str, project_path: Path, output_file, should_stop):
+        logger.info(f"Sending prompt to AI worker for {project_path} ({len(prompt)} characters)")
+        return get_ai_worker(self.command, project_path).run(prompt, output_file, should_stop)
+
+
+AI_BACKENDS = {
+    "qwen-cli": QwenCLIBackend(QWEN_CLI_COMMAND),
+    "worker": JsonLinesWorkerBackend(AI_WORKER_COMMAND),
+}
+
+
+def get_ai_backend(name: str = None):
+    backend = AI_BACKENDS.get(name or AI_BACKEND)
+    if backend is None:
+        raise EditError(500, f"Unknown AI backend: {name or AI_BACKEND}")
+    return backend
+
+# 🔌 AI backends +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+
+
+
+# 🤖 AI edit jobs +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+# The model runs in a background job. Its stdout is appended to a per-job output file so the
+# events stream can follow it from whichever worker process serves the request (see serve.py)
+AI_EDIT_STAGES = ("model", "parse")
+AI_EDIT_TIMEOUT = int(os.getenv("AI_EDIT_TIMEOUT", "180"))
+AI_EVENTS_POLL_SECONDS = 0.25
+AI_EVENTS_KEEPALIVE_SECONDS = 15
+# Streams end after this long; EventSource reconnects and resumes from Last-Event-ID
+AI_EVENTS_MAX_SECONDS = int(os.getenv("AI_EVENTS_MAX_SECONDS", "120"))
+AI_EVENTS_CHUNK_BYTES = 64 * 1024
+
+
+def _job_output_path(job_id: str) -> Path:
+    return JOBS_DIR / f"{job_id}.out"
+
+
+def _job_cancel_path(job_id: str) -> Path:
+    return JOBS_DIR / f"{job_id}.cancel"
+
+
+def prepare_ai_edit(data: dict) -> dict:
+    """Validate an admin-edit request and build the model prompt; raises EditError"""
+    prompt = data.get("prompt", "").strip()
+    elements = data.get("elements", [])
+    url = data.get("url", "")
+    batch_mode = data.get("batchMode", False)
+
+    logger.info(f"Received admin-edit request: prompt={prompt[:50]}..., elements={len(elements)}, url={url}, batch_mode={batch_mode}")
+
+    if not prompt or not elements or not url:
+        raise EditError(400, "Missing prompt, elements, or url")
+
+    project_path, html_file_path = resolve_edit_target(url)
+    target_file = html_file_path.name
+
+    # Check the configured AI backend (by default the Qwen CLI) can run
+    error = get_ai_backend().check()
+    if error:
+        raise EditError(500, error)
+
+    # Generate selective element prompt for Qwen Code CLI, with the page context it needs inline
+    context = build_prompt_context(load_document(html_file_path).text, elements)
+    qwen_prompt = generate_qwen_selective_prompt(elements, prompt, target_file, str(project_path), batch_mode, context)
+    logger.info(f"Sending prompt to Qwen: {qwen_prompt[:200]}...")
+
+    return {
+        "elements": elements,
+        "project_path": project_path,
+        "html_file_path": html_file_path,
+        "target_file": target_file,
+        "qwen_prompt": qwen_prompt,
+    }
+
+
+def _restore_if_modified(html_file_path: Path, original_content: str):
+    """Undo file edits the model made despite preview instructions; returns its version or None"""
+    current_content = html_file_path.read_text(encoding="utf-8")
+    if current_content == original_content:
+        return None
+    html_file_path.write_text(original_content, encoding="utf-8")
+    logger.info("Restored original file content after unauthorized modification")
+    return current_content
+
+
+def run_ai_backend(job_id: str, prompt: str, project_path: Path):
+    """Run prompt on the configured backend, appending output to the job's output file
+
+    Returns (returncode, stdout, stderr, outcome) where outcome is "exited", "timeout" or "cancelled".
+    """
+    deadline = time.monotonic() + AI_EDIT_TIMEOUT
+    cancel_path = _job_cancel_path(job_id)
+
+    def should_stop():
+        if cancel_path.exists():
+            return "cancelled"
+        if time.monotonic() > deadline:
+            return "timeout"
+        return None
+
+    with open(_job_output_path(job_id), "ab") as output_file:
+        return get_ai_backend().run(prompt, project_path, output_file, should_stop)
+
+
+def ai_edit_response(spec: dict, returncode: int, stdout: str, stderr: str, original_content: str):
+    """Turn the model's output into the admin-edit response; returns (response, status)"""
+    target_file = spec["target_file"]
+    project_path = spec["project_path"]
+
+    if returncode != 0:
+        logger.error(f"Qwen CLI error: {stderr}")
+        # Provide more detailed error information
+        error_msg = stderr[:500] if stderr else "Unknown error occurred"
+        return {
+            "success": False,
+            "error": f"AI processing failed: {error_msg}",
+            "qwen_error": stderr[:1000]  # Include more detailed error info
+        }, 500
+
+    try:
+        # Try to parse JSON response
+        response_data = json.loads(stdout)
+    except json.JSONDecodeError:
+        # Fallback for non-JSON response - try to extract content manually
+        logger.warning("Qwen returned non-JSON response, attempting to parse manually")
+        response_data = None
+
+    if isinstance(response_data, dict):
+        if response_data.get("status") == "success":
+            # Return element-specific updates - no file saving yet
+            return {
+                "success": True,
+                "message": response_data.get("message", "AI preview generated successfully"),
+                "element_updates": response_data.get("element_updates", []),
+                "changes_summary": response_data.get("changes_summary", ""),
+                "qwen_response": response_data,
+                "is_selective_preview": True,
+                "target_file": target_file,
+                "project_path": str(project_path)
+            }, 200
+        return {
+            "success": False,
+            "error": response_data.get("message", "AI processing failed"),
+            "qwen_response": response_data
+        }, 500
+
+    # Check if file was modified first
+    try:
+        modified_content = _restore_if_modified(spec["html_file_path"], original_content)
+        if modified_content is not None:
+            # Qwen modified the file despite preview instructions; use its version as the preview
+            return {
+                "success": True,
+                "message": "AI preview generated (file modification detected)",
+                "preview_content": modified_content,
+                "changes_summary": "AI generated changes. File was modified but restored for preview.",
+                "is_preview": True,
+                "target_file": target_file,
+                "project_path": str(project_path)
+            }, 200
+    except Exception as e:
+        logger.error(f"Failed to check file modifications: {e}")
+
+    # Scan the output for an embedded JSON answer, then an HTML document, then prose
+    try:
+        return ai_preview_response(stdout, spec["elements"], target_file, project_path)
+    except Exception as e:
+        logger.error(f"Failed to extract content from response: {e}")
+        return {
+            "success": False,
+            "error": f"AI processing error: {str(e)}",
+            "qwen_output": stdout[:500]
+        }, 500
+
+
+def submit_ai_edit_job(spec: dict) -> dict:
+    """Queue an AI edit; raises AIQueueFull when the AI queue is at capacity"""
+    job = enqueue_ai_job("ai_edit", spec["project_path"], AI_EDIT_STAGES)
+    _job_output_path(job["id"]).touch()
+    start_job_thread(job, run_ai_edit_job, spec)
+    return job
+
+
+def run_ai_edit_job(job: dict, spec: dict):
+    """Run the model for one admin-edit request and store the response in the job result"""
+    html_file_path = spec["html_file_path"]
+    try:
+        if not wait_for_ai_slot(job, _job_cancel_path(job["id"]).exists):
+            response = {"success": False, "error": "AI edit cancelled"}
+            finish_job(job, False, error=response["error"], result={"response": response, "http_status": 409}, status="cancelled")
+            return
+        job["status"] = "running"
+        set_job_stage(job, "model", "running")
+
+        # Read original content before Qwen processing
+        original_content = html_file_path.read_text(encoding="utf-8")
+        returncode, stdout, stderr, outcome = run_ai_backend(job["id"], spec["qwen_prompt"], spec["project_path"])
+        logger.info(f"Qwen CLI result: returncode={returncode}, outcome={outcome}, stdout={stdout[:200]}..., stderr={stderr[:200]}...")
+
+        if outcome != "exited":
+            _restore_if_modified(html_file_path, original_content)
+            if outcome == "cancelled":
+                set_job_stage(job, "model", "cancelled")
+                response = {"success": False, "error": "AI edit cancelled"}
+                finish_job(job, False, error=response["error"], result={"response": response, "http_status": 409}, status="cancelled")
+            else:
+                logger.error("Qwen CLI timeout")
+                set_job_stage(job, "model", "failed", "timeout")
+                response = {"success": False, "error": "AI processing timeout"}
+                finish_job(job, False, error=response["error"], result={"response": response, "http_status": 500})
+            return
+        set_job_stage(job, "model", "succeeded" if returncode == 0 else "failed")
+
+        set_job_stage(job, "parse", "running")
+        response, status = ai_edit_response(spec, returncode, stdout, stderr, original_content)
+        set_job_stage(job, "parse", "succeeded" if response.get("success") else "failed")
+        if status == 200 and is_cacheable_preview(response):
+            cache_preview(ai_preview_cache_key(spec["qwen_prompt"], original_content), response)
+        finish_job(
+            job,
+            response.get("success", False),
+            message=response.get("message"),
+            error=response.get("error"),
+            result={"response": response, "http_status": status},
+        )
+    except Exception as e:
+        logger.exception("AI edit job error")
+        response = {"success": False, "error": f"AI processing failed: {str(e)}"}
+        finish_job(job, False, error=response["error"], result={"response": response, "http_status": 500})
+    finally:
+        release_ai_slot(job["id"])
+        _job_cancel_path(job["id"]).unlink(missing_ok=True)
+
+
+def request_ai_edit_cancel(job: dict) -> bool:
+    """Ask the worker running job to stop the model; False if it already finished"""
+    if job["status"] in FINISHED_JOB_STATUSES:
+        return False
+    _job_cancel_path(job["id"]).touch()
+    return True
+
+
+def _complete_utf8(chunk: bytes) -> bytes:
+    """Drop a multi-byte character cut off at the end of chunk; it is sent with the next one"""
+    for back in range(1, min(4, len(chunk)) + 1):
+        byte = chunk[-back]
+        if byte & 0xC0 != 0x80:  # ASCII or lead byte
+            needed = 1 if byte < 0x80 else 2 if byte < 0xE0 else 3 if byte < 0xF0 else 4
+            return chunk if back >= needed else chunk[:-back]
+    return chunk
+
+
+def _sse(event: str, data, event_id=None) -> str:
+    lines = [f"id: {event_id}"] if event_id is not None else []
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data)}")
+    return "\n".join(lines) + "\n\n"
+
+
+def ai_edit_events(job_id: str, offset: int = 0):
+    """Server-Sent Events for one AI edit job
+
+    "output" events carry model output from byte offset onwards (the event id is the offset
+    after the chunk), "progress" events the job status and stages, and a final "done" event
+    the finished job including the admin-edit response.
+    """
+    output_path = _job_output_path(job_id)
+    started = last_sent = time.monotonic()
+    last_progress = None
+    yield f"retry: {int(AI_EVENTS_POLL_SECONDS * 4000)}\n\n"
+    while True:
+        # Load the job before reading output: once it is finished the output file is complete
+        job = load_job(job_id)
+        if job is None:
+            yield _sse("done", {"status": "failed", "error": "AI edit job not found"})
+            return
+
+        try:
+            with open(output_path, "rb") as output_file:
+                output_file.seek(offset)
+                chunk = _complete_utf8(output_file.read(AI_EVENTS_CHUNK_BYTES))
+        except OSError:
+            chunk = b""
+        if chunk:
+            offset += len(chunk)
+            yield _sse("output", chunk.decode("utf-8", errors="replace"), offset)
+            last_sent = time.monotonic()
+            continue
+
+        progress = (job["status"], job["stage"], job.get("queue_position"))
+        if progress != last_progress:
+            last_progress = progress
+            yield _sse("progress", {
+                "status": job["status"],
+                "stage": job["stage"],
+                "stages": job["stages"],
+                "queue_position": job.get("queue_position"),
+            })
+            last_sent = time.monotonic()
+
+        if job["status"] in FINISHED_JOB_STATUSES:
+            yield _sse("done", job)
+            return
+
+        now = time.monotonic()
+        if now - started > AI_EVENTS_MAX_SECONDS:
+            return
+        if now - last_sent > AI_EVENTS_KEEPALIVE_SECONDS:
+            yield ": keepalive\n\n"
+            last_sent = now
+        time.sleep(AI_EVENTS_POLL_SECONDS)
+
+# 🤖 AI edit jobs +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+
+
+
+@app.route("/api/admin-edit", methods=["POST"])
+def admin_edit():
+    """Start an AI edit job; follow /api/admin-edit/<job_id>/events for output and the result
+
+    Clients that cannot stream may send "wait": true to get the result in this response.
+    A preview already generated for the same prompt and page content is returned directly
+    unless "bypassCache": true is sent.
+    """
+    try:
+        data = request.get_json(force=True, silent=True) or {}
+        try:
+            spec = prepare_ai_edit(data)
+        except EditError as e:
+            return jsonify({"success": False, "error": e.message}), e.status
+
+        if not data.get("bypassCache"):
+            page = load_document(spec["html_file_path"]).text
+            cached = get_cached_preview(ai_preview_cache_key(spec["qwen_prompt"], page))
+            if cached is not None:
+                logger.info("Serving AI preview from cache")
+                return jsonify(dict(cached, cached=True))
+
+        try:
+            job = submit_ai_edit_job(spec)
+        except AIQueueFull as e:
+            response = jsonify({"success": False, "error": "Too many AI edits in progress, please retry shortly", "retry_after": e.retry_after})
+            response.headers["Retry-After"] = str(e.retry_after)
+            return response, 429
+        if data.get("wait"):
+            job_id = job["id"]
+            deadline = time.monotonic() + AI_EDIT_TIMEOUT
+            while job is not None and job["status"] not in FINISHED_JOB_STATUSES:
+                if time.monotonic() > deadline:
+                    # Still queued or running; stop it rather than leave it working for nobody
+                    request_ai_edit_cancel(job)
+                    logger.error("Qwen CLI timeout")
+                    return jsonify({"success": False, "error": "AI processing timeout", "job_id": job_id}), 500
+                time.sleep(AI_EVENTS_POLL_SECONDS)
+                job = load_job(job_id)
+            if job is None:
+                return jsonify({"success": False, "error": "AI edit job was lost before it finished", "job_id": job_id}), 500
+            result = job["result"] or {"response": {"success": False, "error": job["error"]}, "http_status": 500}
+            return jsonify(result["response"]), result["http_status"]
+
+        return jsonify({
+            "success": True,
+            "job_id": job["id"],
+            "status": job["status"],
+            "status_url": f"/api/admin-edit/{job['id']}",
+            "events_url": f"/api/admin-edit/{job['id']}/events",
+            "cancel_url": f"/api/admin-edit/{job['id']}/cancel"
+        }), 202
+
     except Exception as e:
         logger.exception("admin_edit error")
         return jsonify({"success": False, "error": f"Internal error: {str(e)[:200]}"}), 500
 
 
+def _load_ai_edit_job(job_id):
+    job = load_job(job_id)
+    return job if job and job["kind"] == "ai_edit" else None
+
+
+@app.route("/api/admin-edit/<job_id>", methods=["GET"])
+def admin_edit_status(job_id):
+    """Report the status of an AI edit job; finished jobs carry the response under result"""
+    job = _load_ai_edit_job(job_id)
+    if not job:
+        return jsonify({"success": False, "error": "AI edit job not found"}), 404
+    return jsonify({"success": True, "job": job})
+
+
+@app.route("/api/admin-edit/<job_id>/events", methods=["GET"])
+def admin_edit_events(job_id):
+    """Stream an AI edit job's model output and progress as Server-Sent Events"""
+    if not _load_ai_edit_job(job_id):
+        return jsonify({"success": False, "error": "AI edit job not found"}), 404
+    try:
+        offset = max(0, int(request.headers.get("Last-Event-ID") or request.args.get("offset") or 0))
+    except ValueError:
+        offset = 0
+    return Response(
+        ai_edit_events(job_id, offset),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.route("/api/admin-edit/<job_id>/cancel", methods=["POST"])
+def admin_edit_cancel(job_id):
+    """Stop the model behind an AI edit job"""
+    job = _load_ai_edit_job(job_id)
+    if not job:
+        return jsonify({"success": False, "error": "AI edit job not found"}), 404
+    if not request_ai_edit_cancel(job):
+        return jsonify({"success": False, "error": f"AI edit job already {job['status']}", "status": job["status"]}), 409
+    return jsonify({"success": True, "job_id": job["id"], "status": "cancelling"}), 202
+
+
 @app.route("/api/save-ai-changes", methods=["POST"])
 def save_ai_changes():
     """Save AI-generated element changes to file after user approves preview"""
@@ -1546,45 +3900,48 @@ def save_ai_changes():
         except Exception as e:
             return jsonify({"success": False, "error": f"Invalid path: {str(e)}"}), 400
         
-        # Read current file content
-        current_content = html_file_path.read_text(encoding="utf-8")
-        
-        # Apply element-specific updates using simple string replacement
-        updated_content = current_content
-        
+        # Locate every target in the unmodified page (one index), then rebuild the page once;
+        # holding the page's lock keeps direct and batch edits from landing in between
+        document = load_document(html_file_path)
         try:
-            # Apply each element update
-            for update in element_updates:
-                element_index = update.get("element_index")
-                new_content = update.get("new_content", "")
+            with document.lock:
+                current_content = document.text
+                spans = []
+                for update in element_updates:
+                    element_index = update.get("element_index")
+                    new_content = update.get("new_content", "")
                 
-                if element_index is None or element_index >= len(elements):
-                    continue
+                    if element_index is None or element_index >= len(elements):
+                        continue
                 
-                # Get element info
-                element_info = elements[element_index]
-                original_text = element_info.get('text', '').strip()
-                
-                # Simple approach: Replace the original text content with new content
-                if original_text and original_text in updated_content:
-                    # Find and replace the original text
-                    updated_content = updated_content.replace(original_text, new_content, 1)
-                    logger.info(f"Updated element {element_index} by replacing text")
-                else:
-                    # Fallback: Try to find by pattern matching
-                    import re
-                    escaped_text = re.escape(original_text)
-                    pattern = re.sub(r"\\\s+", r"\\s+", escaped_text)
-                    match = re.search(pattern, updated_content, re.IGNORECASE | re.MULTILINE)
-                    
-                    if match:
-                        updated_content = updated_content.replace(match.group(0), new_content, 1)
-                        logger.info(f"Updated element {element_index} by pattern matching")
-                    else:
+                    # Get element info
+                    element_info = elements[element_index]
+                    original_text = element_info.get('text', '').strip()
+                    span = None
+                    if original_text:
+                        index, element = element_for_edit(current_content, element_info, element_info.get('tag', ''))
+                        if element is not None:
+                            span = index.find_text_in(element, original_text)
+                        if span is None:
+                            span = locate_text(current_content, original_text, element_info)
+                    if span is None:
                         logger.warning(f"Could not find original content to replace for element {element_index}")
+                        continue
+                    spans.append((span[0], span[1], element_index, strip_element_ids(new_content)))
             
-            # Save the updated HTML
-            html_file_path.write_text(updated_content, encoding="utf-8")
+                edits = []
+                previous_end = -1
+                for start, end, element_index, new_content in sorted(spans):
+                    if start < previous_end:
+                        logger.warning(f"Element {element_index} overlaps another update; skipped")
+                        continue
+                    edits.append((start, end, new_content))
+                    previous_end = end
+                    logger.info(f"Updated element {element_index}")
+                updated_content = splice_many(current_content, edits) if edits else current_content
+            
+                # Save the updated HTML
+                journaled_write(project_path, html_file_path, current_content, updated_content, "save_ai_changes")
             
             logger.info(f"AI element changes saved to {html_file_path}")
             
@@ -1632,37 +3989,492 @@ def save_ai_changes():
 
 
 
+ADMIN_STATIC_DIRS = (BASE_DIR / "admin" / "toolbar", BASE_DIR / "admin" / "components")
+
+_admin_static_index = {"key": None, "files": {}}
+_admin_static_index_lock = threading.Lock()
+
+
+def get_admin_static_index() -> dict:
+    """Map top-level admin asset names to their paths, relisting only when a directory changes"""
+    key = tuple(_stat_key(d, cached=True) for d in ADMIN_STATIC_DIRS)
+    with _admin_static_index_lock:
+        if key != _admin_static_index["key"]:
+            files = {}
+            # Reversed so the toolbar directory wins name clashes with components
+            for admin_static_dir in reversed(ADMIN_STATIC_DIRS):
+                if admin_static_dir.is_dir():
+                    files.update({p.name: p for p in admin_static_dir.iterdir() if p.is_file()})
+            _admin_static_index.update(key=key, files=files)
+        return _admin_static_index["files"]
+
+
+def resolve_admin_static(filename: str):
+    if filename in get_admin_dist_files():
+        return ADMIN_DIST_DIR / filename
+    file_path = get_admin_static_index().get(filename)
+    if file_path:
+        return file_path
+    # Nested paths are not indexed; first try the toolbar directory, then the components directory
+    if "/" in filename:
+        for admin_static_dir in ADMIN_STATIC_DIRS:
+            file_path = safe_join(str(admin_static_dir), filename)
+            if file_path and os.path.isfile(file_path):
+                return Path(file_path)
+    return None
+
+
 @app.route("/admin-static/<path:filename>")
 def admin_static(filename):
-    # First try the toolbar directory
-    admin_static_dir = BASE_DIR / "admin" / "toolbar"
-    if admin_static_dir.exists():
-        file_path = admin_static_dir / filename
-        if file_path.exists():
-            return send_from_directory(str(admin_static_dir), filename)
-    
-    # Then try the components directory
-    admin_components_dir = BASE_DIR / "admin" / "components"
-    if admin_components_dir.exists():
-        file_path = admin_components_dir / filename
-        if file_path.exists():
-            return send_from_directory(str(admin_components_dir), filename)
+    if filename.startswith(ADMIN_BUNDLE_PREFIX) and filename.endswith(".js") and filename not in get_admin_dist_files():
+        body, bundle_hash = get_admin_bundle()
+        current = f"{ADMIN_BUNDLE_PREFIX}{bundle_hash}.js"
+        if filename != current:
+            # Page was rendered against an older bundle; point it at the current one without caching the hop
+            response = redirect(f"/admin-static/{current}", 302)
+            response.headers["Cache-Control"] = "no-cache"
+            return response
+        return send_bytes(body, "text/javascript", bundle_hash, cache_control=IMMUTABLE_CACHE_CONTROL)
+
+    file_path = resolve_admin_static(filename)
+    if file_path:
+        # Built files have the content hash in their name and never change
+        immutable = file_path.parent == ADMIN_DIST_DIR
+        return send_static_file(file_path, cache_control=IMMUTABLE_CACHE_CONTROL if immutable else None)
     
     return "Admin static file not found", 404
 
 
 
+ADMIN_TEMPLATE_PATH = BASE_DIR / "admin" / "templates" / "admin-inject.html"
+
+
 def load_admin_template() -> str:
-    template_path = BASE_DIR / "admin" / "templates" / "admin-inject.html"
     try:
-        return template_path.read_text(encoding="utf-8")
+        return ADMIN_TEMPLATE_PATH.read_text(encoding="utf-8")
     except Exception as e:
         logger.warning(f"Admin template not found or failed to read: {e}")
         return ""
 
 
-# Load template dynamically in development mode instead of caching
-ADMIN_INJECT = load_admin_template() if not app.debug else ""
+_admin_template = {"key": None, "text": "", "hash": ""}
+_admin_template_lock = threading.Lock()
+
+
+def get_admin_template():
+    """Return (template, hash), re-reading the template only when it or the asset manifest changes
+
+    References to built admin assets are rewritten to their content-hashed names.
+    """
+    manifest = get_admin_manifest()
+    try:
+        st = ADMIN_TEMPLATE_PATH.stat()
+        key = (st.st_mtime_ns, st.st_size, tuple(sorted(manifest.items())))
+    except OSError:
+        key = None
+    with _admin_template_lock:
+        if key is None or key != _admin_template["key"]:
+            text = load_admin_template()
+            for name, hashed_name in manifest.items():
+                text = text.replace(f"/admin-static/{name}", f"/admin-static/{hashed_name}")
+            _admin_template.update(
+                key=key,
+                text=text,
+                hash=hashlib.sha1(text.encode("utf-8")).hexdigest()[:16],
+            )
+        return _admin_template["text"], _admin_template["hash"]
+
+
+# 🟤 admin loader bundle +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+# "inline" pastes the whole template into every page; "loader" injects one <script> tag
+# pointing at a content-hashed bundle of the same template that browsers cache forever
+ADMIN_INJECT_MODE = os.getenv("ADMIN_INJECT_MODE", "inline").lower()
+ADMIN_BUNDLE_PREFIX = "admin-bundle."
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+_TEMPLATE_PART_RE = re.compile(
+    r"<script\b([^>]*)>(.*?)</script\s*>|<style\b[^>]*>(.*?)</style\s*>|<!--.*?-->",
+    re.S | re.I,
+)
+_SCRIPT_SRC_RE = re.compile(r"""\bsrc\s*=\s*["']([^"']+)["']""", re.I)
+
+_admin_bundle = {"key": None, "files": (), "body": b"", "hash": ""}
+_admin_bundle_lock = threading.Lock()
+
+
+def _stat_key(file_path: Path, cached: bool = False):
+    try:
+        st = cached_stat(file_path) if cached else file_path.stat()
+        return (st.st_mtime_ns, st.st_size)
+    except OSError:
+        return None
+
+
+def build_admin_bundle(template: str):
+    """Convert the admin template into a single script; returns (body, inlined asset paths)
+
+    Scripts keep their order, /admin-static/ sources are inlined, styles and any
+    leftover markup are added to the document when the bundle runs.
+    """
+    chunks = []
+    files = []
+
+    def add_markup(markup: str):
+        if markup.strip():
+            chunks.append(f"document.body.insertAdjacentHTML('beforeend', {json.dumps(markup)});")
+
+    pos = 0
+    for m in _TEMPLATE_PART_RE.finditer(template):
+        add_markup(template[pos:m.start()])
+        pos = m.end()
+        attrs, script, style = m.group(1), m.group(2), m.group(3)
+        if style is not None:
+            chunks.append(
+                "(function () { var s = document.createElement('style'); "
+                f"s.textContent = {json.dumps(style)}; document.head.appendChild(s); }})();"
+            )
+        elif attrs is not None:
+            src = _SCRIPT_SRC_RE.search(attrs)
+            if not src:
+                chunks.append(script)
+                continue
+            url = src.group(1)
+            asset = None
+            if url.startswith("/admin-static/"):
+                asset = resolve_admin_static(url[len("/admin-static/"):].split("?", 1)[0])
+            if asset:
+                files.append(asset)
+                chunks.append(asset.read_text(encoding="utf-8"))
+            else:
+                chunks.append(
+                    "(function () { var s = document.createElement('script'); "
+                    f"s.src = {json.dumps(url)}; document.head.appendChild(s); }})();"
+                )
+    add_markup(template[pos:])
+    return minify_asset("bundle.js", "\n;\n".join(chunks)).encode("utf-8"), tuple(files)
+
+
+def get_admin_bundle():
+    """Return (bundle body, bundle hash), rebuilding when the template or an inlined asset changes"""
+    template, template_hash = get_admin_template()
+    with _admin_bundle_lock:
+        key = (template_hash, tuple(_stat_key(p) for p in _admin_bundle["files"]))
+        if key != _admin_bundle["key"]:
+            body, files = build_admin_bundle(template)
+            _admin_bundle.update(
+                key=(template_hash, tuple(_stat_key(p) for p in files)),
+                files=files,
+                body=body,
+                hash=hashlib.sha1(body).hexdigest()[:12],
+            )
+        return _admin_bundle["body"], _admin_bundle["hash"]
+
+
+def get_admin_inject():
+    """Return (snippet, version) to splice into pages for the configured ADMIN_INJECT_MODE"""
+    if ADMIN_INJECT_MODE == "loader":
+        _, bundle_hash = get_admin_bundle()
+        snippet = (
+            "<!-- Admin Toolbar Injection Template (loader) -->\n"
+            f'<script src="/admin-static/{ADMIN_BUNDLE_PREFIX}{bundle_hash}.js"></script>\n'
+        )
+        return snippet, bundle_hash
+    return get_admin_template()
+
+# 🟤 admin loader bundle +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+
+# ⚫ admin asset build +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+ADMIN_DIST_DIR = BASE_DIR / "admin" / "dist"
+ADMIN_MANIFEST_PATH = ADMIN_DIST_DIR / "manifest.json"
+ADMIN_MINIFY = os.getenv("ADMIN_MINIFY", "1").lower() not in ("0", "false", "no")
+ADMIN_BUILD_ON_STARTUP = os.getenv("ADMIN_BUILD_ON_STARTUP", "1").lower() not in ("0", "false", "no")
+
+# A "/" after one of these (or after a keyword below) starts a regex literal, otherwise it divides
+_JS_REGEX_PRECEDERS = set("(,=:[!&|?{};+-*%<>~^}")
+_JS_REGEX_KEYWORDS = {
+    "return", "typeof", "case", "do", "else", "in", "of", "new",
+    "delete", "void", "throw", "instanceof", "yield", "await",
+}
+
+
+def _is_js_word_char(ch: str) -> bool:
+    return ch.isalnum() or ch in "_$\\" or ord(ch) > 127
+
+
+def _scan_js_string(source: str, i: int, quote: str) -> int:
+    n = len(source)
+    j = i + 1
+    while j < n:
+        c = source[j]
+        if c == "\\":
+            j += 2
+            continue
+        if c == quote or c == "\n":
+            return j + 1
+        j += 1
+    return n
+
+
+def _scan_js_template(source: str, i: int):
+    """Scan template literal text from i; returns (end, "`" or "${")"""
+    n = len(source)
+    while i < n:
+        c = source[i]
+        if c == "\\":
+            i += 2
+            continue
+        if c == "`":
+            return i + 1, "`"
+        if c == "$" and source.startswith("${", i):
+            return i + 2, "${"
+        i += 1
+    return n, "`"
+
+
+def _scan_js_regex(source: str, i: int) -> int:
+    """Return the end of the regex literal starting at i, or -1 if it is not one"""
+    n = len(source)
+    j = i + 1
+    in_class = False
+    while j < n:
+        c = source[j]
+        if c == "\\":
+            j += 2
+            continue
+        if c == "\n":
+            return -1
+        if in_class:
+            if c == "]":
+                in_class = False
+        elif c == "[":
+            in_class = True
+        elif c == "/":
+            j += 1
+            while j < n and _is_js_word_char(source[j]):
+                j += 1
+            return j
+        j += 1
+    return -1
+
+
+def minify_js(source: str) -> str:
+    """Conservative JS minifier: drops comments and indentation, copies strings, templates and regexes verbatim
+
+    Line breaks are kept wherever automatic semicolon insertion could depend on them.
+    """
+    out = []
+    n = len(source)
+    i = 0
+    template_braces = []  # open "{" count inside each enclosing ${ ... } expression
+    prev = ""  # last character written
+    prev_word = ""  # last identifier/keyword written
+    gap = ""  # whitespace skipped since the last token: "", " " or "\n"
+
+    while i < n:
+        ch = source[i]
+        nxt = source[i + 1] if i + 1 < n else ""
+
+        if ch in " \t\r\n\f\v\ufeff":
+            if ch == "\n":
+                gap = "\n"
+            elif not gap:
+                gap = " "
+            i += 1
+            continue
+        if ch == "/" and nxt == "/":
+            j = source.find("\n", i)
+            i = n if j == -1 else j
+            continue
+        if ch == "/" and nxt == "*":
+            j = source.find("*/", i + 2)
+            i = n if j == -1 else j + 2
+            if not gap:
+                gap = " "
+            continue
+
+        if gap and prev:
+            if gap == "\n" and prev not in "{;,([=:" and ch not in ")]},;:.?":
+                out.append("\n")
+            elif _is_js_word_char(prev) and _is_js_word_char(ch):
+                out.append(" ")
+            elif prev in "+-/" and ch == prev:
+                out.append(" ")
+            elif prev.isdigit() and ch == ".":
+                out.append(" ")
+        gap = ""
+
+        if ch in "'\"":
+            j = _scan_js_string(source, i, ch)
+            out.append(source[i:j])
+            prev, prev_word, i = source[j - 1], "", j
+            continue
+        if ch == "`" or (ch == "}" and template_braces and template_braces[-1] == 0):
+            if ch == "}":
+                template_braces.pop()
+            j, end = _scan_js_template(source, i + 1)
+            if end == "${":
+                template_braces.append(0)
+            out.append(source[i:j])
+            prev, prev_word, i = source[j - 1], "", j
+            continue
+        if ch == "/" and (not prev or prev in _JS_REGEX_PRECEDERS or prev_word in _JS_REGEX_KEYWORDS):
+            j = _scan_js_regex(source, i)
+            if j != -1:
+                out.append(source[i:j])
+                prev, prev_word, i = source[j - 1], "", j
+                continue
+        if _is_js_word_char(ch):
+            j = i + 1
+            while j < n and _is_js_word_char(source[j]):
+                j += 1
+            prev_word = source[i:j]
+            out.append(prev_word)
+            prev, i = source[j - 1], j
+            continue
+
+        if template_braces:
+            if ch == "{":
+                template_braces[-1] += 1
+            elif ch == "}":
+                template_braces[-1] -= 1
+        out.append(ch)
+        prev, prev_word, i = ch, "", i + 1
+
+    return "".join(out)
+
+
+def minify_css(source: str) -> str:
+    """Strip comments and collapse whitespace outside of strings"""
+    out = []
+    n = len(source)
+    i = 0
+    gap = False
+    while i < n:
+        ch = source[i]
+        if ch == "/" and source.startswith("/*", i):
+            j = source.find("*/", i + 2)
+            i = n if j == -1 else j + 2
+            gap = True
+            continue
+        if ch.isspace():
+            gap = True
+            i += 1
+            continue
+        if gap and out and out[-1][-1] not in "{};,>" and ch not in "{};,>":
+            out.append(" ")
+        gap = False
+        if ch in "'\"":
+            j = _scan_js_string(source, i, ch)
+            out.append(source[i:j])
+            i = j
+            continue
+        out.append(ch)
+        i += 1
+    return "".join(out)
+
+
+def minify_asset(name: str, text: str) -> str:
+    if not ADMIN_MINIFY:
+        return text
+    if name.endswith(".js"):
+        return minify_js(text)
+    if name.endswith(".css"):
+        return minify_css(text)
+    return text
+
+
+def _write_atomic(file_path: Path, data: bytes):
+    tmp_path = file_path.with_name(f"{file_path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, file_path)
+
+
+_admin_manifest = {"key": None, "assets": {}, "files": frozenset()}
+_admin_manifest_lock = threading.Lock()
+
+
+def _load_admin_manifest():
+    key = _stat_key(ADMIN_MANIFEST_PATH, cached=True)
+    with _admin_manifest_lock:
+        if key != _admin_manifest["key"]:
+            assets, files = {}, set()
+            if key is not None:
+                try:
+                    manifest = json.loads(ADMIN_MANIFEST_PATH.read_text(encoding="utf-8"))
+                    assets = manifest.get("assets", {})
+                    files = {entry["file"] for entry in assets.values()}
+                    if manifest.get("bundle"):
+                        files.add(manifest["bundle"])
+                except Exception as e:
+                    logger.warning(f"Ignoring unreadable admin manifest: {e}")
+            _admin_manifest.update(key=key, assets=assets, files=frozenset(files))
+        return _admin_manifest
+
+
+def get_admin_manifest() -> dict:
+    """Return {asset name: hashed file} for built assets whose source is unchanged since the build"""
+    fresh = {}
+    for name, entry in _load_admin_manifest()["assets"].items():
+        if _stat_key(BASE_DIR / entry["source"], cached=True) == (entry["mtime_ns"], entry["size"]):
+            fresh[name] = entry["file"]
+    return fresh
+
+
+def get_admin_dist_files() -> frozenset:
+    return _load_admin_manifest()["files"]
+
+
+def build_admin_assets() -> dict:
+    """Minify admin assets into admin/dist/ under content-hashed names and write manifest.json"""
+    ADMIN_DIST_DIR.mkdir(parents=True, exist_ok=True)
+
+    assets = {}
+    for name, source in sorted(get_admin_static_index().items()):
+        if source.suffix not in (".js", ".css"):
+            continue
+        st = source.stat()
+        body = minify_asset(name, source.read_text(encoding="utf-8")).encode("utf-8")
+        hashed_name = f"{source.stem}.{hashlib.sha1(body).hexdigest()[:12]}{source.suffix}"
+        _write_atomic(ADMIN_DIST_DIR / hashed_name, body)
+        assets[name] = {
+            "file": hashed_name,
+            "source": str(source.relative_to(BASE_DIR)),
+            "mtime_ns": st.st_mtime_ns,
+            "size": st.st_size,
+        }
+
+    # Publish the assets first so the template and bundle pick up their hashed URLs
+    manifest = {"assets": assets, "bundle": None}
+    _write_atomic(ADMIN_MANIFEST_PATH, json.dumps(manifest, indent=2).encode("utf-8"))
+    stat_cache.pop(str(ADMIN_MANIFEST_PATH))
+
+    body, bundle_hash = get_admin_bundle()
+    manifest["bundle"] = f"{ADMIN_BUNDLE_PREFIX}{bundle_hash}.js"
+    _write_atomic(ADMIN_DIST_DIR / manifest["bundle"], body)
+    _write_atomic(ADMIN_MANIFEST_PATH, json.dumps(manifest, indent=2).encode("utf-8"))
+    stat_cache.pop(str(ADMIN_MANIFEST_PATH))
+
+    keep = {entry["file"] for entry in assets.values()} | {manifest["bundle"], ADMIN_MANIFEST_PATH.name}
+    for stale in ADMIN_DIST_DIR.iterdir():
+        if stale.name not in keep:
+            stale.unlink(missing_ok=True)
+
+    logger.info(f"Built {len(assets)} admin assets into {ADMIN_DIST_DIR}")
+    return manifest
+
+
+@app.cli.command("build-admin-assets")
+def build_admin_assets_command():
+    """Minify admin assets into admin/dist/ and write the manifest"""
+    manifest = build_admin_assets()
+    for name, entry in manifest["assets"].items():
+        print(f"{name} -> {entry['file']}")
+    print(f"bundle -> {manifest['bundle']}")
+
+# ⚫ admin asset build +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 
 
 def is_admin_route(path: str) -> bool:
@@ -1672,13 +4484,32 @@ def is_admin_route(path: str) -> bool:
     return "/admin" in p or "admin=true" in p
 
 
+# Set on admin pages so their relative assets (/site/style.css from /site/admin) come from the working tree
+ADMIN_SESSION_COOKIE = os.getenv("ADMIN_SESSION_COOKIE", "lw_admin")
+
+
+def is_admin_session() -> bool:
+    """True when the request comes from an admin page: the admin cookie, or an admin Referer"""
+    if request.cookies.get(ADMIN_SESSION_COOKIE) == "1":
+        return True
+    return is_admin_route(urlparse(request.referrer or "").path)
+
+
+def mark_admin_response(response, admin: bool):
+    """Tag a working-tree response: admin pages set the session cookie, anything else is kept out of shared caches"""
+    if admin:
+        response.set_cookie(ADMIN_SESSION_COOKIE, "1", path="/", httponly=True, samesite="Lax")
+    else:
+        response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
 def inject_admin_toolbar(html_content: str, admin: bool) -> str:
     if not admin:
         return html_content
     
-    # Load template dynamically in debug mode for hot reloading
-    admin_inject = ADMIN_INJECT if not app.debug else load_admin_template()
-    
+    admin_inject, _ = get_admin_inject()
+
     if not admin_inject:
         return html_content
     if "Admin Toolbar Injection Template" in html_content:
@@ -1690,13 +4521,557 @@ def inject_admin_toolbar(html_content: str, admin: bool) -> str:
     return html_content + admin_inject
 
 
+# 🟣 response compression +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "1024"))
+COMPRESS_CACHE_MAX_BYTES = int(os.getenv("COMPRESS_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+# Precompressed copies of static files live outside projects/ so `git add .` in publish never picks them up
+COMPRESS_CACHE_DIR = Path(os.getenv("COMPRESS_CACHE_DIR", BASE_DIR / ".cache" / "compressed")).resolve()
+
+COMPRESSIBLE_MIMETYPES = {
+    "application/javascript",
+    "application/json",
+    "application/xml",
+    "image/svg+xml",
+    "text/javascript",
+}
+ENCODING_SUFFIXES = {"gzip": "gz", "deflate": "zz"}
+
+# (content hash, encoding) -> compressed bytes
+compressed_cache = LRUCache(COMPRESS_CACHE_MAX_BYTES)
+
+
+def is_compressible(mimetype: str) -> bool:
+    return bool(mimetype) and (mimetype.startswith("text/") or mimetype in COMPRESSIBLE_MIMETYPES)
+
+
+def negotiate_encoding(mimetype: str):
+    """Pick gzip or deflate from Accept-Encoding, or None to send the identity body"""
+    if not is_compressible(mimetype) or request.range is not None:
+        return None
+    return request.accept_encodings.best_match(["gzip", "deflate"])
+
+
+def compress_bytes(data: bytes, encoding: str) -> bytes:
+    if encoding == "gzip":
+        return gzip.compress(data, compresslevel=6, mtime=0)
+    # HTTP "deflate" is the zlib container, not raw deflate
+    return zlib.compress(data, 6)
+
+
+def get_compressed_variant(data: bytes, content_hash: str, encoding: str) -> bytes:
+    """Compress each (content, encoding) pair once and serve it from memory afterwards"""
+    key = (content_hash, encoding)
+    variant = compressed_cache.get(key)
+    if variant is None:
+        variant = compress_bytes(data, encoding)
+        compressed_cache.put(key, variant, len(variant))
+    return variant
+
+
+def precompressed_sibling(file_path: Path, st: os.stat_result, encoding: str):
+    """Return the path of a compressed copy of file_path, building it on first access"""
+    prefix = hashlib.sha1(str(file_path).encode("utf-8")).hexdigest()[:16]
+    sibling = COMPRESS_CACHE_DIR / f"{prefix}-{st.st_mtime_ns}-{st.st_size}.{ENCODING_SUFFIXES[encoding]}"
+    if sibling.exists():
+        return sibling
+    try:
+        COMPRESS_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        data = compress_bytes(file_path.read_bytes(), encoding)
+        tmp_path = sibling.with_name(f"{sibling.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, sibling)
+        # Drop copies built from older versions of the same file
+        for stale in COMPRESS_CACHE_DIR.glob(f"{prefix}-*.{ENCODING_SUFFIXES[encoding]}"):
+            if stale != sibling:
+                stale.unlink(missing_ok=True)
+        return sibling
+    except Exception as e:
+        logger.warning(f"Could not precompress {file_path}: {e}")
+        return None
+
+
+def send_static_file(file_path: Path, mimetype: str = None, cache_control: str = None):
+    """send_file() with a negotiated precompressed variant for text assets"""
+    mime = mimetype or mimetypes.guess_type(str(file_path))[0] or "application/octet-stream"
+    encoding = negotiate_encoding(mime)
+    if encoding:
+        st = file_path.stat()
+        sibling = precompressed_sibling(file_path, st, encoding) if st.st_size >= COMPRESS_MIN_BYTES else None
+        if sibling:
+            response = send_file(
+                sibling,
+                mimetype=mime,
+                download_name=file_path.name,
+                etag=f"{st.st_mtime_ns:x}-{st.st_size:x}-{encoding}",
+                last_modified=st.st_mtime,
+                conditional=True,
+            )
+            response.headers["Content-Encoding"] = encoding
+            response.vary.add("Accept-Encoding")
+            if cache_control:
+                response.headers["Cache-Control"] = cache_control
+            return response
+
+    response = send_file_range(file_path, mime, cache_control)
+    if is_compressible(mime):
+        response.vary.add("Accept-Encoding")
+    return response
+
+def send_bytes(body: bytes, mimetype: str, etag: str, last_modified=None, cache_control: str = "no-cache"):
+    """Conditional response for an in-memory body, compressed once per content hash"""
+    encoding = negotiate_encoding(mimetype)
+    if encoding and len(body) >= COMPRESS_MIN_BYTES:
+        body = get_compressed_variant(body, etag, encoding)
+        etag = f"{etag}-{encoding}"
+    else:
+        encoding = None
+
+    response = Response(body, mimetype=mimetype)
+    response.set_etag(etag)
+    response.vary.add("Accept-Encoding")
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.headers["Cache-Control"] = cache_control
+    return response.make_conditional(request)
+
+# 🟣 response compression +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+
+# 🟤 static file fast path +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+# Large chunks keep big media transfers from being split into thousands of 8 KB writes
+STATIC_CHUNK_SIZE = int(os.getenv("STATIC_CHUNK_SIZE", str(256 * 1024)))
+STAT_CACHE_TTL = float(os.getenv("STAT_CACHE_TTL", "1.0"))
+STAT_CACHE_MAX_ENTRIES = int(os.getenv("STAT_CACHE_MAX_ENTRIES", "4096"))
+
+# Hand the file to a fronting nginx/Apache via X-Sendfile instead of streaming it from Python
+app.use_x_sendfile = os.getenv("USE_X_SENDFILE", "").lower() in ("1", "true", "yes")
+
+# Resolved path -> (stat result, expiry); each entry counts as 1 towards the limit
+stat_cache = LRUCache(STAT_CACHE_MAX_ENTRIES)
+
+
+def cached_stat(file_path: Path) -> os.stat_result:
+    """stat() with a short TTL, used for routing checks; missing files are never cached"""
+    key = str(file_path)
+    now = time.monotonic()
+    cached = stat_cache.get(key)
+    if cached is not None and cached[1] > now:
+        return cached[0]
+    st = file_path.stat()
+    stat_cache.put(key, (st, now + STAT_CACHE_TTL), 1)
+    return st
+
+
+def send_file_range(file_path: Path, mimetype: str, cache_control: str = None):
+    """Stream a file through wsgi.file_wrapper with Range/If-Range support (206/416)"""
+    if app.use_x_sendfile:
+        response = send_file(file_path, mimetype=mimetype, conditional=True)
+        if cache_control:
+            response.headers["Cache-Control"] = cache_control
+        return response
+
+    f = open(file_path, "rb")
+    try:
+        # fstat the open descriptor so length and validators always match the bytes we send
+        st = os.fstat(f.fileno())
+    except Exception:
+        f.close()
+        raise
+
+    # wrap_file() uses the server's wsgi.file_wrapper when present (sendfile() under gunicorn/uWSGI)
+    data = wrap_file(request.environ, f, buffer_size=STATIC_CHUNK_SIZE)
+    response = Response(data, mimetype=mimetype, direct_passthrough=True)
+    response.content_length = st.st_size
+    response.last_modified = st.st_mtime
+    response.set_etag(f"{st.st_mtime_ns:x}-{st.st_size:x}")
+    response.headers["Cache-Control"] = cache_control or "no-cache"
+    try:
+        return response.make_conditional(request, accept_ranges=True, complete_length=st.st_size)
+    except Exception:
+        # e.g. 416 for an unsatisfiable range; release the descriptor before propagating
+        response.close()
+        raise
+
+# 🟤 static file fast path +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+
+# 🏷️ element ids +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+# Admin pages tag each element with data-lw-id="<structure>-<ordinal>" (see ElementIndex) so the
+# toolbar can address edits to exactly one element; ids stay valid across text and style edits
+ADMIN_ELEMENT_IDS = os.getenv("ADMIN_ELEMENT_IDS", "1").lower() not in ("0", "false", "no")
+UNANNOTATED_ELEMENTS = frozenset(("html", "head", "body")) | RAW_TEXT_ELEMENTS
+
+_LW_ID_ATTR_RE = re.compile(r"""\sdata-lw-id\s*=\s*(?:"[^"]*"|'[^']*'|[^\s>]+)""", re.I)
+
+
+def annotate_element_ids(html: str) -> str:
+    """html with a data-lw-id attribute after the tag name of every element outside <head>"""
+    index = get_element_index(html)
+    head = index.signatures.get("head", [None])[0]
+    head_span = index.span(head) if head is not None else (0, 0)
+    chunks = []
+    pos = 0
+    for ordinal, element in enumerate(index.elements):
+        if element.tag in UNANNOTATED_ELEMENTS:
+            continue
+        start = index.position(element.start)
+        if head_span[0] <= start < head_span[1]:
+            continue
+        insert_at = start + 1 + len(element.tag)
+        chunks.append(html[pos:insert_at])
+        chunks.append(f' data-lw-id="{index.lw_id(ordinal)}"')
+        pos = insert_at
+    chunks.append(html[pos:])
+    return "".join(chunks)
+
+
+def strip_element_ids(fragment: str) -> str:
+    """Drop data-lw-id attributes from client-supplied HTML before it reaches a project file"""
+    return _LW_ID_ATTR_RE.sub("", fragment) if "data-lw-id" in fragment else fragment
+
+# 🏷️ element ids +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+
+# ⚪ rendered page cache +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+RENDER_CACHE_MAX_BYTES = int(os.getenv("RENDER_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+
+# Resolved path -> (version key, injected page bytes); one entry per page
+render_cache = LRUCache(RENDER_CACHE_MAX_BYTES)
+
+# Visitors (non-/admin URLs) skip injection entirely; set VISITOR_FAST_PATH=0 to inject on every page again
+VISITOR_FAST_PATH = os.getenv("VISITOR_FAST_PATH", "1").lower() not in ("0", "false", "no")
+PUBLIC_HTML_MAX_AGE = int(os.getenv("PUBLIC_HTML_MAX_AGE", "3600"))
+PUBLIC_HTML_CACHE_CONTROL = f"public, max-age={PUBLIC_HTML_MAX_AGE}"
+ADMIN_HTML_CACHE_CONTROL = "no-cache, no-store, must-revalidate"
+
+
+def render_html_page(file_path: Path):
+    """Return (body, etag, last_modified) for the injected page, re-rendering only when the page or template changes"""
+    st = file_path.stat()
+    _, inject_version = get_admin_inject()
+    version = (st.st_mtime_ns, st.st_size, inject_version)
+    cache_key = str(file_path)
+
+    cached = render_cache.get(cache_key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    html = load_document(file_path).text
+    if ADMIN_ELEMENT_IDS:
+        html = annotate_element_ids(html)
+    # Always inject admin template for HTML files - client-side will determine visibility
+    body = inject_admin_toolbar(html, True).encode("utf-8")
+    # Strong validator over the final bytes, so template changes produce a new ETag as well
+    etag = hashlib.sha1(body).hexdigest()
+    last_modified = datetime.fromtimestamp(st.st_mtime, tz=timezone.utc)
+    page = (body, etag, last_modified)
+    render_cache.put(cache_key, (version, page), len(body))
+    return page
+
+
+def serve_html_file(file_path: Path, admin: bool = True):
+    if not admin and VISITOR_FAST_PATH:
+        # Public visitors get the project file untouched, cacheable and revalidated with validators
+        return send_static_file(file_path, "text/html", cache_control=PUBLIC_HTML_CACHE_CONTROL)
+
+    if file_path.stat().st_size >= STREAM_HTML_THRESHOLD:
+        return stream_html_file(file_path)
+
+    body, etag, last_modified = render_html_page(file_path)
+    return send_bytes(body, "text/html", etag, last_modified=last_modified, cache_control=ADMIN_HTML_CACHE_CONTROL)
+
+# ⚪ rendered page cache +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+
+# 🔶 streamed admin pages +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+# Pages at least this large are streamed from disk instead of being rendered into memory
+STREAM_HTML_THRESHOLD = int(os.getenv("STREAM_HTML_THRESHOLD", str(1024 * 1024)))
+STREAM_CHUNK_SIZE = int(os.getenv("STREAM_CHUNK_SIZE", str(64 * 1024)))
+
+ADMIN_INJECT_MARKER = b"Admin Toolbar Injection Template"
+
+# Resolved path -> (version key, (injection offset, already injected)); tiny entries
+injection_point_cache = LRUCache(4096)
+
+
+def scan_injection_point(f, size: int):
+    """Find where inject_admin_toolbar() would splice the snippet, reading f in chunks
+
+    Returns (offset, already_injected): the start of the last </body>, else the
+    last </html>, else the end of the file.
+    """
+    last_body = last_html = -1
+    already_injected = False
+    overlap = max(len(b"</body>"), len(ADMIN_INJECT_MARKER)) - 1
+    carry = b""
+    base = 0  # file offset of carry[0]
+    f.seek(0)
+    while True:
+        chunk = f.read(STREAM_CHUNK_SIZE)
+        if not chunk:
+            break
+        window = carry + chunk
+        pos = window.rfind(b"</body>")
+        if pos != -1:
+            last_body = base + pos
+        pos = window.rfind(b"</html>")
+        if pos != -1:
+            last_html = base + pos
+        if not already_injected and ADMIN_INJECT_MARKER in window:
+            already_injected = True
+        carry = window[-overlap:]
+        base += len(window) - len(carry)
+    f.seek(0)
+    if last_body != -1:
+        return last_body, already_injected
+    if last_html != -1:
+        return last_html, already_injected
+    return size, already_injected
+
+
+def _stream_injected(f, offset: int, snippet: bytes, compressor=None):
+    def emit(data):
+        return compressor.compress(data) if compressor else data
+
+    remaining = offset
+    while remaining > 0:
+        chunk = f.read(min(STREAM_CHUNK_SIZE, remaining))
+        if not chunk:
+            break
+        remaining -= len(chunk)
+        yield emit(chunk)
+    if snippet:
+        yield emit(snippet)
+    while True:
+        chunk = f.read(STREAM_CHUNK_SIZE)
+        if not chunk:
+            break
+        yield emit(chunk)
+    if compressor:
+        yield compressor.flush()
+
+
+def stream_html_file(file_path: Path):
+    """Serve a large admin page as a generator, splicing the admin snippet in on the way out
+
+    Memory per request stays at one chunk regardless of page size.
+    """
+    f = open(file_path, "rb")
+    try:
+        st = os.fstat(f.fileno())
+        snippet_text, inject_version = get_admin_inject()
+        version = (st.st_mtime_ns, st.st_size)
+        cached = injection_point_cache.get(str(file_path))
+        if cached is not None and cached[0] == version:
+            offset, already_injected = cached[1]
+        else:
+            offset, already_injected = scan_injection_point(f, st.st_size)
+            injection_point_cache.put(str(file_path), (version, (offset, already_injected)), 1)
+        snippet = b"" if already_injected else snippet_text.encode("utf-8")
+
+        encoding = negotiate_encoding("text/html")
+        etag = f"{st.st_mtime_ns:x}-{st.st_size:x}-{inject_version}"
+        compressor = None
+        if encoding:
+            etag = f"{etag}-{encoding}"
+            # wbits 31 writes a gzip container, 15 the zlib container HTTP calls "deflate"
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 31 if encoding == "gzip" else 15)
+
+        response = Response(_stream_injected(f, offset, snippet, compressor), mimetype="text/html")
+        response.call_on_close(f.close)
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+        else:
+            response.content_length = st.st_size + len(snippet)
+        response.set_etag(etag)
+        response.last_modified = st.st_mtime
+        response.vary.add("Accept-Encoding")
+        response.headers["Cache-Control"] = ADMIN_HTML_CACHE_CONTROL
+        return response.make_conditional(request)
+    except Exception:
+        f.close()
+        raise
+
+# 🔶 streamed admin pages +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+
+
+
+# 🟤 version previews +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+# /<project>@v12/about.html serves about.html as committed at tag v12, straight from git objects
+_PREVIEW_SEGMENT_RE = re.compile(r"^(?P<project>[^@/]+)@(?P<rev>v\d+)$")
+PREVIEW_CACHE_CONTROL = "private, max-age=3600"
+GIT_BLOB_CACHE_MAX_BYTES = int(os.getenv("GIT_BLOB_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+
+# Object id -> blob bytes; objects are immutable so entries never go stale
+git_blob_cache = LRUCache(GIT_BLOB_CACHE_MAX_BYTES)
+
+
+class GitObjectReader:
+    """Long-lived `git cat-file` processes for one repository
+
+    --batch-check resolves "<rev>:<path>" to an object id, --batch reads blob
+    contents, so serving a file costs a pipe round trip instead of a process spawn.
+    """
+
+    def __init__(self, repo_path):
+        self.repo_path = str(repo_path)
+        self._lock = threading.Lock()
+        self._check = None
+        self._batch = None
+
+    def _spawn(self, mode: str):
+        return subprocess.Popen(
+            ['git', 'cat-file', mode],
+            cwd=self.repo_path,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+
+    def _request(self, proc_attr: str, mode: str, line: str):
+        proc = getattr(self, proc_attr)
+        if proc is None or proc.poll() is not None:
+            proc = self._spawn(mode)
+            setattr(self, proc_attr, proc)
+        proc.stdin.write(f"{line}\n".encode("utf-8"))
+        proc.stdin.flush()
+        header = proc.stdout.readline().decode("utf-8").rstrip("\n")
+        if not header:
+            raise RuntimeError(f"git cat-file {mode} exited unexpectedly")
+        return proc, header
+
+    def resolve(self, spec: str):
+        """Return (object id, type, size) for spec, or None if it does not exist"""
+        if "\n" in spec:
+            return None
+        with self._lock:
+            try:
+                _, header = self._request("_check", "--batch-check", spec)
+            except Exception:
+                self._reset()
+                raise
+        parts = header.split()
+        if len(parts) != 3 or parts[1] in ("missing", "ambiguous"):
+            return None
+        return parts[0], parts[1], int(parts[2])
+
+    def read_blob(self, spec: str):
+        """Return (object id, bytes) for the blob at spec, or None"""
+        info = self.resolve(spec)
+        if info is None or info[1] != "blob":
+            return None
+        oid, _, size = info
+        data = git_blob_cache.get(oid)
+        if data is not None:
+            return oid, data
+        with self._lock:
+            try:
+                proc, header = self._request("_batch", "--batch", oid)
+                if header.endswith("missing"):
+                    return None
+                data = proc.stdout.read(size)
+                proc.stdout.read(1)  # trailing newline after the contents
+            except Exception:
+                self._reset()
+                raise
+        git_blob_cache.put(oid, data, len(data))
+        return oid, data
+
+    def _reset(self):
+        for proc in (self._check, self._batch):
+            if proc is not None and proc.poll() is None:
+                proc.kill()
+        self._check = self._batch = None
+
+    def close(self):
+        with self._lock:
+            for proc in (self._check, self._batch):
+                if proc is not None and proc.poll() is None:
+                    proc.stdin.close()
+                    proc.wait(timeout=5)
+            self._check = self._batch = None
+
+
+_git_readers = {}
+_git_readers_lock = threading.Lock()
+
+
+def get_git_reader(repo_path: Path) -> GitObjectReader:
+    # Keyed by pid as well so forked workers never share a parent's pipes
+    key = (os.getpid(), str(repo_path))
+    with _git_readers_lock:
+        reader = _git_readers.get(key)
+        if reader is None:
+            reader = _git_readers[key] = GitObjectReader(repo_path)
+        return reader
+
+
+@atexit.register
+def _close_git_readers():
+    for (pid, _), reader in list(_git_readers.items()):
+        if pid == os.getpid():
+            try:
+                reader.close()
+            except Exception:
+                pass
+
+
+def split_preview_path(filename: str):
+    """Split "<project>@vN/<path>" (or "user_x/<project>@vN/<path>") into (project, rev, path)"""
+    segments = filename.split("/")
+    for i, segment in enumerate(segments[:2]):
+        m = _PREVIEW_SEGMENT_RE.match(segment)
+        if m:
+            project = "/".join(segments[:i] + [m.group("project")])
+            return project, m.group("rev"), "/".join(segments[i + 1:])
+    return None
+
+
+def serve_version_preview(project: str, rev: str, inner_path: str):
+    """Serve a file as committed at rev without touching the working tree"""
+    repo_path = safe_join_projects(project)
+    if not (repo_path / ".git").exists():
+        return "Not found", 404
+    if not inner_path and not request.path.endswith("/"):
+        # Relative links in the page must resolve under the @rev segment
+        return redirect(f"{request.path}/", 302)
+
+    inner_path = posixpath.normpath(inner_path or "index.html").lstrip("/")
+    if inner_path.startswith(".."):
+        return "Forbidden", 403
+
+    reader = get_git_reader(repo_path)
+    blob = reader.read_blob(f"{rev}:{inner_path}")
+    if blob is None and (reader.resolve(f"{rev}:{inner_path}") or (None, None))[1] == "tree":
+        inner_path = f"{inner_path}/index.html"
+        blob = reader.read_blob(f"{rev}:{inner_path}")
+    if blob is None:
+        return "Not found", 404
+
+    oid, data = blob
+    mime = mimetypes.guess_type(inner_path)[0] or "application/octet-stream"
+    return send_bytes(data, mime, oid, cache_control=PREVIEW_CACHE_CONTROL)
+
+# 🟤 version previews +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 
 
 @app.route("/", defaults={"filename": ""})
 @app.route("/<path:filename>")
 def serve_any(filename: str):
     try:
+        preview = split_preview_path(filename) if "@" in filename else None
+        if preview:
+            return serve_version_preview(*preview)
+
         admin = is_admin_route(request.path) or is_admin_route(request.url)
         actual_filename = filename
         
@@ -1727,39 +5102,27 @@ def serve_any(filename: str):
                 return redirect(f"/{project_part}/{target_file}", 302)
 
         file_path = safe_join_projects(actual_filename)
+        # Visitors see the published release; admins, and the assets their pages load, the working tree
+        working_tree = admin or is_admin_session()
+        if not working_tree and actual_filename.strip("/"):
+            file_path = current_release_path(actual_filename) or file_path
+        try:
+            st = cached_stat(file_path)
+        except OSError:
+            st = None
 
-        if file_path.exists() and file_path.is_file():
+        if st is not None and stat.S_ISREG(st.st_mode):
             if file_path.suffix.lower() == ".html":
-                html = file_path.read_text(encoding="utf-8")
-                # Always inject admin template for HTML files - client-side will determine visibility
-                response_html = inject_admin_toolbar(html, True)
-                
-                # Add cache control headers to prevent caching in admin mode
-                headers = {
-                    "Content-Type": "text/html; charset=utf-8",
-                    "Cache-Control": "no-cache, no-store, must-revalidate",
-                    "Pragma": "no-cache",
-                    "Expires": "0"
-                }
-                return response_html, 200, headers
-            mime, _ = mimetypes.guess_type(str(file_path))
-            return send_from_directory(str(file_path.parent), file_path.name, mimetype=mime or "application/octet-stream")
-
-        if file_path.exists() and file_path.is_dir():
+                response = serve_html_file(file_path, admin)
+            else:
+                response = send_static_file(file_path)
+            return mark_admin_response(response, admin) if working_tree else response
+
+        if st is not None and stat.S_ISDIR(st.st_mode):
             index_file = file_path / "index.html"
             if index_file.exists():
-                html = index_file.read_text(encoding="utf-8")
-                # Always inject admin template for HTML files - client-side will determine visibility
-                response_html = inject_admin_toolbar(html, True)
-                
-                # Add cache control headers to prevent caching in admin mode
-                headers = {
-                    "Content-Type": "text/html; charset=utf-8",
-                    "Cache-Control": "no-cache, no-store, must-revalidate",
-                    "Pragma": "no-cache",
-                    "Expires": "0"
-                }
-                return response_html, 200, headers
+                response = serve_html_file(index_file, admin)
+                return mark_admin_response(response, admin) if working_tree else response
 
             entries = []
             for p in sorted(file_path.iterdir(), key=lambda p: (not p.is_dir(), p.name.lower())):
@@ -1788,13 +5151,29 @@ def serve_any(filename: str):
         return "Not found", 404
     except PermissionError:
         return "Forbidden", 403
+    except FileNotFoundError:
+        # Removed after its cached stat was taken
+        return "Not found", 404
+    except HTTPException as e:
+        return e
     except Exception as e:
         logger.exception("serve_any error")
         return f"Internal server error: {e}", 500
 
 
 
+def warm_up():
+    """Build admin assets and load the admin template/bundle into this process's caches"""
+    if ADMIN_BUILD_ON_STARTUP:
+        try:
+            build_admin_assets()
+        except Exception:
+            logger.exception("Admin asset build failed; serving unbuilt assets")
+    get_admin_inject()
+
+
 if __name__ == "__main__":
     port = int(os.getenv("PORT", "47261"))
     print(f"Serving projects from: {PROJECTS_DIR}")
+    warm_up()
     app.run(host="0.0.0.0", port=port, debug=True, threaded=True)
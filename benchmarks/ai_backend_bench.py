@@ -0,0 +1,51 @@
+"""Benchmark: AI edit backends, process per prompt vs persistent JSON-lines worker
+
+    python benchmarks/ai_backend_bench.py [prompts] [startup seconds]
+
+Both backends run the offline stub (ai_stub_worker.py): once per prompt in CLI mode, as
+with the Qwen CLI, and as one long-lived worker. startup simulates model/CLI start-up
+cost (default 0, i.e. interpreter start-up only).
+"""
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from app import BASE_DIR, JsonLinesWorkerBackend, QwenCLIBackend, generate_qwen_selective_prompt  # noqa: E402
+
+ELEMENTS = [{"tag": "h1", "text": "Welcome to our site"}, {"tag": "p", "classes": "lead", "text": "We build things."}]
+
+
+def bench(backend, prompts: int, prompt: str) -> list:
+    timings = []
+    with open(os.devnull, "ab") as output_file:
+        for _ in range(prompts):
+            started = time.perf_counter()
+            returncode, stdout, _, _ = backend.run(prompt, BASE_DIR, output_file, lambda: None)
+            timings.append(time.perf_counter() - started)
+            assert returncode == 0 and '"element_updates"' in stdout, stdout
+    return timings
+
+
+def report(name: str, timings: list):
+    ordered = sorted(timings)
+    print(f"{name:<22} first {timings[0] * 1000:8.1f} ms   median {ordered[len(ordered) // 2] * 1000:8.1f} ms   "
+          f"total {sum(timings):7.2f} s")
+
+
+def main():
+    prompts = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    if len(sys.argv) > 2:
+        os.environ["AI_STUB_STARTUP"] = sys.argv[2]
+    stub = str(BASE_DIR / "ai_stub_worker.py")
+    prompt = generate_qwen_selective_prompt(ELEMENTS, "make it friendlier", "index.html", str(BASE_DIR), batch_mode=True)
+
+    print(f"{prompts} prompts, simulated start-up {os.getenv('AI_STUB_STARTUP', '0')} s")
+    report("process per prompt", bench(QwenCLIBackend([sys.executable, stub, "--once"]), prompts, prompt))
+    report("persistent worker", bench(JsonLinesWorkerBackend([sys.executable, stub]), prompts, prompt))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""Benchmark: JSON extraction from model output, single-pass scanner vs the old regex cascade
+
+    python benchmarks/json_extract_bench.py [size]
+
+size scales the adversarial inputs (default 4000). The legacy cascade is reproduced here
+verbatim so the comparison keeps working after it was removed from app.py.
+"""
+import json
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from app import extract_ai_response  # noqa: E402
+
+ANSWER = {"status": "success", "message": "ok", "element_updates": [{"element_index": 0, "new_content": "Hi {there}"}]}
+
+LEGACY_PATTERNS = [
+    r'\{[^{}]*"status"[^{}]*"success"[^{}]*\}',
+    r'\{[\s\S]*?"status"\s*:\s*"success"[\s\S]*?\}',
+    r'\{(?:[^{}]|{[^{}]*})*\}',
+    r'(?s)\{.*?"status".*?"success".*?\}',
+    r'(?s)\{.*\}',
+]
+
+
+def legacy_extract(qwen_output):
+    def parse(text):
+        try:
+            data = json.loads(text)
+            if data.get("status") == "success":
+                return data
+        except (json.JSONDecodeError, AttributeError):
+            pass
+        return None
+
+    cleaned_output = qwen_output.strip()
+    if cleaned_output.startswith('```'):
+        lines = cleaned_output.split('\n')
+        if len(lines) > 2:
+            cleaned_output = '\n'.join(lines[1:-1])
+    if cleaned_output.startswith('json\n'):
+        cleaned_output = cleaned_output[5:]
+    data = parse(cleaned_output)
+    if data:
+        return data
+
+    for pattern in LEGACY_PATTERNS:
+        for match in re.findall(pattern, qwen_output, re.DOTALL | re.IGNORECASE):
+            data = parse(match)
+            if data:
+                return data
+
+    fixed_attempts = [
+        re.sub(r',\s*}', '}', qwen_output),
+        re.sub(r',\s*]', ']', qwen_output),
+        re.sub(r'(?<!\\)"(?![,\]\}:\s])', '\\"', qwen_output),
+    ]
+    for attempt_text in fixed_attempts:
+        for pattern in LEGACY_PATTERNS[:3]:
+            for match in re.findall(pattern, attempt_text, re.DOTALL | re.IGNORECASE):
+                data = parse(match)
+                if data:
+                    return data
+    return None
+
+
+def cases(size):
+    answer = json.dumps(ANSWER)
+    return {
+        "markdown-wrapped answer": "Sure! Here is the result:\n```json\n" + json.dumps(ANSWER, indent=2) + "\n```\nDone.",
+        "long preamble then answer": "I looked at the file. " * size + answer,
+        "unclosed braces in prose": "{ " * size + "and then " + answer,
+        "many status keys, no close": '{"status" "success" ' * (size // 4) + "\n" + answer,
+        "braces inside strings": json.dumps({"status": "success", "message": "{" * size, "element_updates": []}),
+        "trailing commas": answer[:-1] + ", }",
+        "no JSON at all": "The model refused to answer. " * size,
+    }
+
+
+def bench(fn, text, budget):
+    start = time.perf_counter()
+    runs = 0
+    result = None
+    while True:
+        result = fn(text)
+        runs += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= budget or runs >= 50:
+            return elapsed / runs, result
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 4000
+    print(f"{'case':32} {'chars':>8} {'scanner':>12} {'legacy':>12}  found")
+    for name, text in cases(size).items():
+        new_time, new_result = bench(extract_ai_response, text, 0.2)
+        old_time, old_result = bench(legacy_extract, text, 0.2)
+        found = f"{'yes' if new_result else 'no'}/{'yes' if old_result else 'no'}"
+        print(f"{name:32} {len(text):>8} {new_time * 1000:>10.2f}ms {old_time * 1000:>10.2f}ms  {found}")
+
+
+if __name__ == "__main__":
+    main()
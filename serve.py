@@ -0,0 +1,150 @@
+"""Production launcher for the admin server.
+
+Pre-loads the app and the admin template/assets once, then forks WEB_WORKERS
+worker processes that share one listening socket. Each worker runs a threaded
+Werkzeug server without the debugger or reloader.
+
+    WEB_WORKERS=4 BIND=0.0.0.0:47261 python serve.py
+
+Environment:
+    BIND              host:port to listen on (default 0.0.0.0:$PORT, PORT defaults to 47261)
+    WEB_WORKERS       number of worker processes (default: CPU count)
+    LISTEN_BACKLOG    listen() backlog of the shared socket (default 128)
+    GRACEFUL_TIMEOUT  seconds workers get to finish in-flight requests and jobs on shutdown (default 30)
+
+SIGTERM/SIGINT stop accepting connections, let workers drain, then exit. Publish, rollback and AI
+edit jobs still running when the time is up are marked failed.
+Workers that die unexpectedly are restarted.
+"""
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+from werkzeug.serving import make_server
+
+import app as admin_app
+
+logger = admin_app.logger
+
+
+def parse_bind(bind: str):
+    host, _, port = bind.rpartition(":")
+    return (host or "0.0.0.0").strip("[]"), int(port)
+
+
+def run_worker(listen_sock: socket.socket, host: str, port: int, graceful_timeout: float):
+    """Serve requests from the inherited socket until SIGTERM, then wait for background jobs"""
+    server = make_server(host, port, admin_app.app, threaded=True, fd=listen_sock.fileno())
+    # Join in-flight request threads on shutdown instead of killing them
+    server.daemon_threads = False
+    server.block_on_close = True
+
+    stop_requested = []
+
+    def stop(signum, frame):
+        stop_requested.append(time.monotonic())
+        # shutdown() blocks until serve_forever() returns, so it cannot run on the serving thread
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    logger.info(f"Worker {os.getpid()} serving on {host}:{port}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        # Jobs run on daemon threads that os._exit() would cut off; leave a second to mark leftovers failed
+        elapsed = time.monotonic() - stop_requested[0] if stop_requested else 0.0
+        admin_app.drain_jobs(max(0.0, graceful_timeout - elapsed - 1))
+    logger.info(f"Worker {os.getpid()} stopped")
+
+
+def spawn_worker(listen_sock: socket.socket, host: str, port: int, graceful_timeout: float) -> int:
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            run_worker(listen_sock, host, port, graceful_timeout)
+        except Exception:
+            logger.exception("Worker crashed")
+            code = 1
+        finally:
+            os._exit(code)
+    return pid
+
+
+def main():
+    host, port = parse_bind(os.getenv("BIND", f"0.0.0.0:{os.getenv('PORT', '47261')}"))
+    workers = max(1, int(os.getenv("WEB_WORKERS", str(os.cpu_count() or 1))))
+    backlog = int(os.getenv("LISTEN_BACKLOG", "128"))
+    graceful_timeout = float(os.getenv("GRACEFUL_TIMEOUT", "30"))
+
+    # Everything loaded here is shared copy-on-write by the workers
+    admin_app.warm_up()
+
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    listen_sock = socket.socket(family, socket.SOCK_STREAM)
+    listen_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listen_sock.bind((host, port))
+    listen_sock.listen(backlog)
+    listen_sock.set_inheritable(True)
+
+    print(f"Serving projects from: {admin_app.PROJECTS_DIR}")
+    logger.info(f"Listening on {host}:{port} with {workers} workers")
+
+    children = {spawn_worker(listen_sock, host, port, graceful_timeout) for _ in range(workers)}
+    stopping = False
+
+    def request_stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    while not stopping:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            pid = 0
+        if pid and pid in children:
+            children.discard(pid)
+            logger.warning(f"Worker {pid} exited with status {status}; restarting")
+            children.add(spawn_worker(listen_sock, host, port, graceful_timeout))
+        else:
+            time.sleep(0.5)
+
+    logger.info("Shutting down workers")
+    listen_sock.close()
+    for pid in children:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    deadline = time.monotonic() + graceful_timeout
+    while children and time.monotonic() < deadline:
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+        if pid:
+            children.discard(pid)
+        else:
+            time.sleep(0.1)
+
+    for pid in children:
+        logger.warning(f"Worker {pid} did not stop in {graceful_timeout}s; killing it")
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,52 @@
+"""Shared fixtures: app.py reads its directories from the environment at import time"""
+import os
+import subprocess
+import sys
+import tempfile
+import uuid
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+STATE = Path(tempfile.mkdtemp(prefix="lintweb-tests-"))
+os.environ["PROJECTS_DIR"] = str(STATE / "projects")
+os.environ["STATE_DIR"] = str(STATE / "state")
+os.environ["RELEASES_DIR"] = str(STATE / "releases")
+sys.path.insert(0, str(ROOT))
+
+import app as app_module  # noqa: E402
+
+PAGE = """<!doctype html>
+<html><head><link rel="stylesheet" href="style.css"></head>
+<body><h1 id="title">Welcome</h1><p class="lead">We build things.</p><img src="images/logo.png"></body></html>
+"""
+
+
+def git(project: Path, *args):
+    subprocess.run(["git", *args], cwd=project, check=True, capture_output=True)
+
+
+@pytest.fixture
+def app():
+    return app_module
+
+
+@pytest.fixture
+def client():
+    app_module.app.config["TESTING"] = True
+    return app_module.app.test_client()
+
+
+@pytest.fixture
+def project():
+    """A committed project with one page and a stylesheet"""
+    project = app_module.PROJECTS_DIR / f"site-{uuid.uuid4().hex[:8]}"
+    project.mkdir(parents=True)
+    (project / "index.html").write_text(PAGE)
+    (project / "style.css").write_text("h1 { color: black; }\n")
+    git(project, "init", "-q")
+    git(project, "-c", "user.name=t", "-c", "user.email=t@t", "add", "-A")
+    git(project, "-c", "user.name=t", "-c", "user.email=t@t", "commit", "-qm", "initial")
+    yield project
+    app_module.forget_document(project / "index.html")
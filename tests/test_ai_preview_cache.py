@@ -0,0 +1,33 @@
+import os
+import time
+
+import pytest
+
+
+@pytest.fixture
+def preview_dir(app, tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "AI_PREVIEW_CACHE_DIR", tmp_path)
+    monkeypatch.setattr(app, "AI_PREVIEW_CACHE_DISK", True)
+    monkeypatch.setattr(app, "AI_PREVIEW_CACHE_PRUNE_SECONDS", 3600)
+    monkeypatch.setattr(app, "_preview_disk", {"bytes": 0, "pruned_at": time.time()})
+    return tmp_path
+
+
+def test_cache_writes_scan_the_directory_only_past_the_byte_cap(app, preview_dir, monkeypatch):
+    response = {"success": True, "qwen_response": {"status": "success", "text": "x" * 1000}}
+    size = len(app.json.dumps(response))
+    monkeypatch.setattr(app, "AI_PREVIEW_CACHE_DISK_MAX_BYTES", size * 5)
+    prune = app._prune_cached_previews
+    scans = []
+    monkeypatch.setattr(app, "_prune_cached_previews", lambda: scans.append(1) or prune())
+
+    for n in range(5):
+        app.cache_preview(f"{n:064x}", response)
+        written_at = time.time() - 100 + n
+        os.utime(preview_dir / f"{n:064x}.json", (written_at, written_at))
+    assert scans == []
+
+    app.cache_preview(f"{5:064x}", response)
+    assert scans == [1]
+    assert sorted(p.name[:-5] for p in preview_dir.glob("*.json")) == [f"{n:064x}" for n in range(1, 6)]
+    assert app._preview_disk["bytes"] == size * 5
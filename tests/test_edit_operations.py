@@ -0,0 +1,23 @@
+import pytest
+
+from conftest import PAGE
+
+
+def test_replace_image_src_reports_sources_it_cannot_resolve(app, monkeypatch):
+    html = PAGE.replace("</body>", '<img src="images/hero.png"></body>')
+    read_attribute = app.start_tag_attribute
+
+    def start_tag_attribute(text, index, element, name):
+        # The logo's start tag no longer reads back as having a src
+        value = read_attribute(text, index, element, name)
+        return None if value and value[2] == "images/logo.png" else value
+
+    monkeypatch.setattr(app, "start_tag_attribute", start_tag_attribute)
+    data = {"replacements": {"images/logo.png": "a.png", "images/hero.png": "b.png"}}
+    updated, result = app.replace_image_src(html, data)
+    assert result["replaced"] == {"images/hero.png": 1} and result["missing"] == ["images/logo.png"]
+    assert 'src="b.png"' in updated and "images/logo.png" in updated
+
+    with pytest.raises(app.EditError) as error:
+        app.replace_image_src(html, {"oldImageSrc": "images/logo.png", "newImageSrc": "a.png"})
+    assert error.value.status == 409
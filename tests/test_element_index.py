@@ -0,0 +1,56 @@
+import re
+import threading
+
+from conftest import PAGE
+
+
+def test_splice_leaves_the_old_index_untouched(app):
+    html = PAGE.replace("Welcome", "Welcome home")
+    old = app.get_element_index(html)
+    old_span = old.find_text("Welcome home")
+
+    updated = app.splice_text(html, old_span[0], old_span[1], "Hello")
+    new = app.get_element_index(updated)
+
+    assert new is not old
+    assert old.html is html and old.splices == []
+    assert old.find_text("Welcome home") == old_span and old.find_text("Hello") is None
+    start, end = new.find_text("Hello")
+    assert updated[start:end] == "Hello"
+    assert new.find_text("We build things.") == (updated.index("We build"), updated.index(" things.") + len(" things."))
+
+
+def test_src_splice_leaves_the_old_index_untouched(app):
+    html = PAGE.replace("logo.png", "logo-v1.png")
+    old = app.get_element_index(html)
+    image = old.sources["images/logo-v1.png"][0]
+
+    updated = app.set_attribute(html, old, image, "src", "images/logo-v2.png")
+    new = app.get_element_index(updated)
+
+    assert list(old.sources) == ["images/logo-v1.png"]
+    assert list(new.sources) == ["images/logo-v2.png"]
+    assert app.start_tag_attribute(updated, new, new.sources["images/logo-v2.png"][0], "src")[2] == "images/logo-v2.png"
+
+
+def test_annotating_old_text_while_another_thread_splices_it(app, monkeypatch):
+    html = PAGE.replace("<p ", "<section>" + "<div><span>item</span></div>" * 50 + "</section><p ")
+    lookup = app.get_element_index
+
+    def get_element_index(text):
+        index = lookup(text)
+        if text is html:
+            # Another request edits the page between this reader's lookup and its use of the offsets
+            start, end = index.find_text("Welcome")
+            editor = threading.Thread(target=app.splice_text, args=(html, start, end, "Welcome back, friend"))
+            editor.start()
+            editor.join()
+        return index
+
+    monkeypatch.setattr(app, "get_element_index", get_element_index)
+    annotated = app.annotate_element_ids(html)
+
+    inserted = annotated.count(" data-lw-id=")
+    assert inserted > 50
+    assert len(re.findall(r"<[a-zA-Z][\w-]* data-lw-id=\"[^\"]+\"[\s>/]", annotated)) == inserted
+    assert app.strip_element_ids(annotated) == html
@@ -0,0 +1,25 @@
+import threading
+
+
+def test_drain_jobs_waits_for_jobs_that_finish_in_time(app, project):
+    job = app.create_job("publish", project, ("push",))
+    app.start_job_thread(job, lambda job: app.finish_job(job, True, message="done"))
+
+    assert app.drain_jobs(5) == []
+    assert app.load_job(job["id"])["status"] == "succeeded"
+
+
+def test_drain_jobs_fails_stuck_jobs_and_clears_git_locks(app, project):
+    release = threading.Event()
+    job = app.create_job("rollback", project, ("checkout",))
+    app.start_job_thread(job, lambda job: release.wait(10))
+    (project / ".git" / "index.lock").write_text("")
+
+    try:
+        stuck = app.drain_jobs(0.1)
+    finally:
+        release.set()
+
+    assert [j["id"] for j in stuck] == [job["id"]]
+    assert app.load_job(job["id"])["status"] == "failed"
+    assert not (project / ".git" / "index.lock").exists()
@@ -0,0 +1,43 @@
+import threading
+import time
+
+from conftest import PAGE
+
+
+def test_ai_save_interleaved_with_direct_edit_undoes_cleanly(app, client, project, monkeypatch):
+    page = project / "index.html"
+    url = f"/{project.name}/index.html/admin"
+    locate = app.element_for_edit
+    direct = {}
+
+    def edit_concurrently():
+        direct["response"] = client.post("/api/direct-text-edit", json={
+            "url": url, "elementSelector": "p.lead", "originalText": "We build things.", "newText": "We ship things.",
+        })
+
+    def element_for_edit(*args, **kwargs):
+        # A direct edit arrives while the AI save is between reading and writing the page
+        if "thread" not in direct:
+            direct["thread"] = threading.Thread(target=edit_concurrently)
+            direct["thread"].start()
+            time.sleep(0.2)
+        return locate(*args, **kwargs)
+
+    monkeypatch.setattr(app, "element_for_edit", element_for_edit)
+    saved = client.post("/api/save-ai-changes", json={
+        "project_path": str(project),
+        "target_file": "index.html",
+        "elements": [{"tag": "h1", "text": "Welcome", "id": "title"}],
+        "element_updates": [{"element_index": 0, "new_content": "Hello there"}],
+    })
+    direct["thread"].join(10)
+
+    assert saved.get_json()["success"], saved.get_json()
+    assert direct["response"].get_json()["success"], direct["response"].get_json()
+    text = page.read_text()
+    assert "Hello there" in text and "We ship things." in text
+
+    for _ in range(2):
+        undone = client.post("/api/edit-undo", json={"url": url})
+        assert undone.status_code == 200, undone.get_json()
+    assert page.read_text() == PAGE
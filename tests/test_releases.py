@@ -0,0 +1,38 @@
+from conftest import git
+
+
+def publish(app, project, tag="v1"):
+    git(project, "tag", tag)
+    app.materialize_release(project, tag)
+    app.activate_release(project, tag)
+
+
+def test_visitors_get_the_published_release(app, client, project):
+    publish(app, project)
+    (project / "style.css").write_text("h1 { color: red; }\n")
+
+    response = client.get(f"/{project.name}/style.css")
+    assert response.status_code == 200
+    assert b"black" in response.data
+
+
+def test_admin_page_assets_come_from_the_working_tree_after_publish(app, client, project):
+    publish(app, project)
+    (project / "style.css").write_text("h1 { color: red; }\n")
+    (project / "images").mkdir()
+    (project / "images" / "logo.png").write_bytes(b"\x89PNG new upload")
+
+    # /site/admin has no trailing slash, so the page's relative URLs resolve to /site/...
+    admin_page = client.get(f"/{project.name}/admin")
+    assert admin_page.status_code == 200
+    referer = {"Referer": f"http://localhost/{project.name}/admin"}
+
+    for headers in (referer, {}):
+        css = client.get(f"/{project.name}/style.css", headers=headers)
+        assert css.status_code == 200 and b"red" in css.data
+        assert "private" in css.headers["Cache-Control"]
+        image = client.get(f"/{project.name}/images/logo.png", headers=headers)
+        assert image.status_code == 200 and image.data == b"\x89PNG new upload"
+
+    client.delete_cookie(app.ADMIN_SESSION_COOKIE, path="/")
+    assert client.get(f"/{project.name}/images/logo.png").status_code == 404